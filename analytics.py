@@ -0,0 +1,369 @@
+"""Operational statistics from a columnar snapshot, not the live tables.
+
+Aggregates over every message or follow are the kind of query that slows
+everything else down, so they never run against the database. Instead
+the snapshot_analytics job (queued again every ANALYTICS_SNAPSHOT_SECONDS
+by the last run; start it with `flask snapshot-analytics`) copies the
+columns the statistics need into ANALYTICS_DIR:
+
+    <taken at>/manifest.json        row counts and column dtypes
+    <taken at>/messages.user_id     one raw little-endian array per column
+    ...
+    CURRENT                         name of the newest complete snapshot
+
+Tables are read with server-side cursors a chunk at a time (messages
+and likes from every shard), and each chunk is appended to its column
+files, so a snapshot never holds a table in memory. A snapshot is only
+pointed at by CURRENT once it's complete; the previous one is kept for
+readers that still have it open.
+
+/admin/stats (for ADMIN_USER_IDS) and `flask analytics-stats` memory-map
+the current snapshot's columns and compute everything with vectorized
+NumPy: daily active posters, messages per hour, the follower-count
+distribution and like ratios. Results are cached per snapshot.
+"""
+
+import json
+import logging
+import os
+import shutil
+from datetime import datetime
+from functools import lru_cache
+
+import numpy as np
+from flask import current_app
+
+from jobs import enqueue, job_handler
+from models import db, Follows, Like, Message, User
+
+logger = logging.getLogger(__name__)
+
+ANALYTICS_SNAPSHOT_SECONDS = 60 * 60
+
+# Rows read per round trip, and appended to the column files at a time
+SNAPSHOT_CHUNK_SIZE = 10000
+
+# Complete snapshots kept on disk, the current one included
+SNAPSHOTS_KEPT = 2
+
+DAILY_ACTIVE_DAYS = 30
+HOURLY_VOLUME_HOURS = 48
+
+
+# Sharded tables' queries end with the author of the message, to leave
+# out stale copies (see _on_author_shard)
+
+def _message_rows(session):
+    return (session
+            .query(Message.id, Message.user_id, Message.timestamp,
+                   Message.like_count, Message.user_id)
+            .filter(Message.deleted_at.is_(None)))
+
+
+def _like_rows(session):
+    return (session
+            .query(Like.user_liking_id, Like.liked_message_id,
+                   Message.user_id)
+            .join(Message, Message.id == Like.liked_message_id))
+
+
+# table: ({column: dtype}, query of those columns given a session,
+# whether to read it from every shard or just main)
+TABLES = {
+    "users": ({"id": "<i8"},
+              lambda session: (session
+                               .query(User.id)
+                               .filter(User.deleted_at.is_(None))),
+              False),
+    "messages": ({"id": "<i8", "user_id": "<i8",
+                  "timestamp": "<M8[s]", "like_count": "<i4"},
+                 _message_rows,
+                 True),
+    "follows": ({"follower_id": "<i8", "followed_id": "<i8"},
+                lambda session: session.query(Follows.user_following_id,
+                                              Follows.user_being_followed_id),
+                False),
+    "likes": ({"user_id": "<i8", "message_id": "<i8"},
+              _like_rows,
+              True),
+}
+
+
+def _chunks(rows, size):
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+
+    if chunk:
+        yield chunk
+
+
+def _on_author_shard(shard, chunk):
+    """Those of `chunk`'s rows (author id last) read from their author's
+    shard, not from a copy an interrupted move left (see shards.py),
+    without the author id."""
+
+    from shards import shards
+
+    authors = shards.shards_of({row[-1] for row in chunk})
+
+    return [row[:-1] for row in chunk if authors[row[-1]] == shard]
+
+
+def _write_table(path, name, columns, queries, chunk_size):
+    """Append `queries`' rows to the table's column files.
+
+    `queries` are (shard, query); with a shard, the query is of a sharded
+    table. Returns the number of rows written.
+    """
+
+    files = {column: open(os.path.join(path, f"{name}.{column}"), "wb")
+             for column in columns}
+    rows = 0
+
+    try:
+        for shard, query in queries:
+            for chunk in _chunks(query.yield_per(chunk_size), chunk_size):
+                if shard is not None:
+                    chunk = _on_author_shard(shard, chunk)
+                    if not chunk:
+                        continue
+                for (column, dtype), values in zip(columns.items(),
+                                                   zip(*chunk)):
+                    np.array(values, dtype=dtype).tofile(files[column])
+                rows += len(chunk)
+    finally:
+        for f in files.values():
+            f.close()
+
+    return rows
+
+
+@job_handler("snapshot_analytics")
+def snapshot_analytics(analytics_dir=None, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """Write a new snapshot, make it current and queue the next one.
+
+    Returns the snapshot's path.
+    """
+
+    from shards import MAIN, shards
+
+    analytics_dir = analytics_dir or current_app.config['ANALYTICS_DIR']
+    taken_at = datetime.utcnow().replace(microsecond=0)
+    name = f"{taken_at:%Y%m%dT%H%M%S}"
+    path = os.path.join(analytics_dir, name)
+    os.makedirs(path, exist_ok=True)
+
+    manifest = {"taken_at": taken_at.isoformat(), "tables": {}}
+
+    for table, (columns, query, sharded) in TABLES.items():
+        names = shards.names if sharded else [MAIN]
+        rows = _write_table(path, table, columns,
+                            ((shard if sharded else None,
+                              query(shards.session(shard)))
+                             for shard in names),
+                            chunk_size)
+        manifest["tables"][table] = {"rows": rows, "columns": columns}
+
+    # Don't hold transactions open between snapshots
+    for shard in shards.names:
+        shards.session(shard).rollback()
+
+    with open(os.path.join(path, "manifest.json"), "w") as f:
+        json.dump(manifest, f)
+
+    current_path = os.path.join(analytics_dir, "CURRENT")
+    with open(f"{current_path}.tmp", "w") as f:
+        f.write(name)
+    os.replace(f"{current_path}.tmp", current_path)
+
+    snapshots = sorted(entry for entry in os.listdir(analytics_dir)
+                       if os.path.isfile(os.path.join(analytics_dir, entry,
+                                                      "manifest.json")))
+    for old in snapshots[:-SNAPSHOTS_KEPT]:
+        shutil.rmtree(os.path.join(analytics_dir, old), ignore_errors=True)
+
+    schedule_snapshot(taken_at, analytics_dir)
+    db.session.commit()
+
+    logger.info("analytics snapshot %s: %s", name,
+                {table: info["rows"]
+                 for table, info in manifest["tables"].items()})
+    return path
+
+
+def schedule_snapshot(when, analytics_dir):
+    """Queue the snapshot for the start of the next period after `when`."""
+
+    epoch_seconds = int((when - datetime(1970, 1, 1)).total_seconds())
+    period = epoch_seconds // ANALYTICS_SNAPSHOT_SECONDS + 1
+
+    enqueue("snapshot_analytics",
+            {"analytics_dir": analytics_dir},
+            priority=-5,
+            idempotency_key=f"snapshot_analytics:{period}",
+            delay=period * ANALYTICS_SNAPSHOT_SECONDS - epoch_seconds)
+
+
+class Snapshot:
+    """A complete snapshot's columns, memory-mapped on first use."""
+
+    def __init__(self, path):
+        self.path = path
+
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+
+        self.taken_at = datetime.fromisoformat(self.manifest["taken_at"])
+        self._columns = {}
+
+    def rows(self, table):
+        return self.manifest["tables"][table]["rows"]
+
+    def column(self, table, name):
+        """One column of `table` as a read-only array."""
+
+        key = (table, name)
+
+        if key not in self._columns:
+            info = self.manifest["tables"][table]
+            dtype = np.dtype(info["columns"][name])
+
+            if info["rows"]:
+                self._columns[key] = np.memmap(
+                    os.path.join(self.path, f"{table}.{name}"),
+                    dtype=dtype, mode="r", shape=(info["rows"],))
+            else:
+                self._columns[key] = np.zeros(0, dtype=dtype)
+
+        return self._columns[key]
+
+
+def current_snapshot(analytics_dir):
+    """The current Snapshot in `analytics_dir`, or None if there isn't one."""
+
+    try:
+        with open(os.path.join(analytics_dir, "CURRENT")) as f:
+            name = f.read().strip()
+    except FileNotFoundError:
+        return None
+
+    return _open_snapshot(os.path.join(analytics_dir, name))
+
+
+@lru_cache(maxsize=SNAPSHOTS_KEPT)
+def _open_snapshot(path):
+    return Snapshot(path)
+
+
+def daily_active_posters(snapshot, days=DAILY_ACTIVE_DAYS):
+    """[(date, users who posted that day)] for the last `days` days."""
+
+    first_day = (np.datetime64(snapshot.taken_at, "D")
+                 - np.timedelta64(days - 1, "D"))
+
+    day = (snapshot.column("messages", "timestamp").astype("M8[D]")
+           - first_day).astype(np.int64)
+    user_ids = snapshot.column("messages", "user_id")
+
+    recent = (day >= 0) & (day < days)
+    day, user_ids = day[recent], user_ids[recent]
+
+    # One key per (day, poster), so each poster counts once a day
+    stride = int(user_ids.max()) + 1 if len(user_ids) else 1
+    posters = np.unique(day * stride + user_ids)
+    counts = np.bincount(posters // stride, minlength=days)
+
+    return [(str(first_day + np.timedelta64(i, "D")), int(count))
+            for i, count in enumerate(counts)]
+
+
+def hourly_volume(snapshot, hours=HOURLY_VOLUME_HOURS):
+    """[(hour, messages posted in it)] for the last `hours` hours."""
+
+    first_hour = (np.datetime64(snapshot.taken_at, "h")
+                  - np.timedelta64(hours - 1, "h"))
+
+    hour = (snapshot.column("messages", "timestamp").astype("M8[h]")
+            - first_hour).astype(np.int64)
+    counts = np.bincount(hour[(hour >= 0) & (hour < hours)], minlength=hours)
+
+    return [(str(first_hour + np.timedelta64(i, "h")), int(count))
+            for i, count in enumerate(counts)]
+
+
+def follower_distribution(snapshot):
+    """Followers per active user: counts in power-of-two buckets, and
+    percentiles."""
+
+    user_ids = np.sort(snapshot.column("users", "id"))
+    followed = snapshot.column("follows", "followed_id")
+    follower = snapshot.column("follows", "follower_id")
+
+    keep = np.isin(followed, user_ids) & np.isin(follower, user_ids)
+    degree = np.bincount(np.searchsorted(user_ids, followed[keep]),
+                         minlength=len(user_ids))
+
+    # Bucket 0 is no followers, bucket b > 0 is 2**(b-1) to 2**b - 1
+    bucket = np.zeros(len(degree), dtype=np.int64)
+    nonzero = degree > 0
+    bucket[nonzero] = np.floor(np.log2(degree[nonzero])).astype(np.int64) + 1
+    counts = np.bincount(bucket)
+
+    buckets = [("0" if b == 0 else
+                str(2 ** (b - 1)) if b == 1 else
+                f"{2 ** (b - 1)}-{2 ** b - 1}", int(count))
+               for b, count in enumerate(counts)]
+
+    percentiles = dict(zip(
+        ("p50", "p90", "p99", "max"),
+        (int(value) for value in (np.percentile(degree, [50, 90, 99, 100])
+                                  if len(degree) else [0, 0, 0, 0]))))
+
+    return {"users": len(user_ids),
+            "follows": int(keep.sum()),
+            "buckets": buckets,
+            "percentiles": percentiles}
+
+
+def like_ratios(snapshot):
+    """How liked messages are, and how much users like."""
+
+    like_counts = snapshot.column("messages", "like_count")
+    messages = len(like_counts)
+    likes = snapshot.rows("likes")
+    users = snapshot.rows("users")
+
+    liked = like_counts[like_counts > 0]
+    likers = len(np.unique(snapshot.column("likes", "user_id")))
+
+    return {"likes_per_message": likes / messages if messages else 0.0,
+            "liked_share": len(liked) / messages if messages else 0.0,
+            "median_likes_when_liked":
+                float(np.median(liked)) if len(liked) else 0.0,
+            "likes_per_user": likes / users if users else 0.0,
+            "liker_share": likers / users if users else 0.0}
+
+
+@lru_cache(maxsize=SNAPSHOTS_KEPT)
+def _stats(path):
+    snapshot = _open_snapshot(path)
+
+    return {"taken_at": snapshot.taken_at.isoformat(),
+            "rows": {table: snapshot.rows(table) for table in TABLES},
+            "daily_active_posters": daily_active_posters(snapshot),
+            "hourly_volume": hourly_volume(snapshot),
+            "followers": follower_distribution(snapshot),
+            "likes": like_ratios(snapshot)}
+
+
+def stats(analytics_dir):
+    """Every statistic, from the current snapshot (None without one)."""
+
+    snapshot = current_snapshot(analytics_dir)
+    return _stats(snapshot.path) if snapshot else None
@@ -1,14 +1,61 @@
+import hmac
+import json
+import mimetypes
 import os
+import re
+import time
+from datetime import datetime
+
+import click
 # from re import template
 
-from flask import Flask, render_template, request, flash, redirect, session, g
+from flask import (
+    Flask, Response, render_template, request, flash, redirect, session, g,
+    abort, make_response, send_file, stream_with_context)
 from flask_debugtoolbar import DebugToolbarExtension
 # from sqlalchemy import exc
 from sqlalchemy.exc import IntegrityError
 # from werkzeug.exceptions import Unauthorized
+from werkzeug.middleware.proxy_fix import ProxyFix
 
+from analytics import snapshot_analytics, stats as analytics_stats
+from card_cache import card_cache
+from existence_filter import existence_filter
+from export import (
+    FORMATS as EXPORT_FORMATS, InvalidCursor, export_stream)
 from forms import EditUser, UserAddForm, LoginForm, MessageForm, CSRFForm
-from models import db, connect_db, User, Message
+from models import (
+    db, connect_db, Follows, User, Message, TrendingMessage)
+from assets import (
+    CACHE_SECONDS as ASSET_CACHE_SECONDS, build_assets, built_file,
+    load_manifest, static_path, static_url)
+from images import (
+    CACHE_SECONDS, THUMBNAIL_SIZES, InvalidImage, ensure_thumbnail,
+    original_mimetype, original_path, save_upload, thumbnail_url)
+from ingest import ingest, read_lines
+from invalidation_bus import invalidation_bus
+from jobs import enqueue
+from like_buffer import like_buffer
+from load_shedding import (
+    DEGRADED_STALE_SECONDS, RETRY_AFTER_SECONDS, db_health, low_priority)
+from partitions import (
+    ARCHIVE_PAGE_SIZE, MESSAGE_RETENTION_DAYS, archive_messages, archived_rows,
+    ensure_partitions, has_archived, partition_messages, scanned_partitions)
+from purge import purge_all
+from rate_limit import rate_limited, rate_limiter
+from read_models import (
+    feed_messages, feed_messages_from_rows, feed_rows, load_like_summaries,
+    load_user_counts, older_than, user_cards)
+from recommendations import (
+    compute_all_recommendations, note_follows_changed,
+    refresh_changed_recommendations)
+from server import is_ready
+from shards import ShardMoving, shards
+from single_flight import single_flight
+from streaming import feed_batches, flush, stream_template
+from tags import index_message, index_tags, link_tags, mentions_page, tag_page
+from timeline_bus import timeline_bus
+from trending import refresh_trending
 
 import dotenv
 dotenv.load_dotenv()
@@ -22,29 +69,503 @@ app = Flask(__name__)
 app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URL'].replace("postgres://", "postgresql://")
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 app.config['SQLALCHEMY_ECHO'] = False
+# Set by gunicorn.conf.py to match each worker's thread count
+if 'DB_POOL_SIZE' in os.environ:
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'pool_size': int(os.environ['DB_POOL_SIZE']),
+        'pool_pre_ping': True,
+    }
 app.config['DEBUG_TB_INTERCEPT_REDIRECTS'] = True
 app.config['SECRET_KEY'] = os.environ['SECRET_KEY']
+# Uploaded images and their thumbnails (see images.py)
+app.config['IMAGE_STORE'] = os.environ.get(
+    'IMAGE_STORE', os.path.join(app.root_path, 'uploads'))
+# Buffer likes and commit them in batches (see like_buffer.py); ignored
+# with SHARD_DATABASE_URLS, as the buffer only writes to main
+app.config['LIKES_WRITE_BEHIND'] = bool(os.environ.get('LIKES_WRITE_BEHIND'))
+# Host-wide shared-memory cache of feed authors (see card_cache.py)
+app.config['CARD_CACHE_PATH'] = os.environ.get('CARD_CACHE_PATH')
+# Where workers share single-flight cached pages (see single_flight.py)
+app.config['SINGLE_FLIGHT_DIR'] = os.environ.get('SINGLE_FLIGHT_DIR')
+# Without Postgres, workers send each other invalidations through Unix
+# sockets here (see invalidation_bus.py)
+app.config['INVALIDATION_SOCKET_DIR'] = os.environ.get('INVALIDATION_SOCKET_DIR')
+# Where messages older than MESSAGE_RETENTION_DAYS are archived (see
+# partitions.py)
+app.config['MESSAGE_ARCHIVE_DIR'] = os.environ.get(
+    'MESSAGE_ARCHIVE_DIR', os.path.join(app.root_path, 'archive'))
+app.config['MESSAGE_RETENTION_DAYS'] = int(
+    os.environ.get('MESSAGE_RETENTION_DAYS', MESSAGE_RETENTION_DAYS))
+# More databases for messages, as name=URL,name=URL (see shards.py)
+app.config['SHARD_DATABASE_URLS'] = dict(
+    shard.split("=", 1)
+    for shard in os.environ.get('SHARD_DATABASE_URLS', '').split(",")
+    if shard)
+# Bearer token for POST /api/ingest; unset turns it off (see ingest.py)
+app.config['INGEST_TOKEN'] = os.environ.get('INGEST_TOKEN')
+# Host-wide rate limit buckets; unset keeps them per worker (see
+# rate_limit.py)
+app.config['RATE_LIMIT_PATH'] = os.environ.get('RATE_LIMIT_PATH')
+# Where the analytics snapshots go (see analytics.py)
+app.config['ANALYTICS_DIR'] = os.environ.get(
+    'ANALYTICS_DIR', os.path.join(app.root_path, 'analytics'))
+# Users who can see /admin/stats and /metrics, as id,id
+app.config['ADMIN_USER_IDS'] = {
+    int(user_id)
+    for user_id in os.environ.get('ADMIN_USER_IDS', '').split(",")
+    if user_id}
 toolbar = DebugToolbarExtension(app)
 
+# Behind a load balancer, take the client's IP (for rate limits) from the
+# X-Forwarded-For set by this many proxies
+if os.environ.get('PROXY_COUNT'):
+    app.wsgi_app = ProxyFix(app.wsgi_app,
+                            x_for=int(os.environ['PROXY_COUNT']))
+
 connect_db(app)
+db_health.init_app(app)
+shards.init_app(app)
+
+# In development, always link to the plain (editable) files in static/
+if not app.debug:
+    load_manifest(app.static_folder)
+app.add_template_global(static_url, 'static_url')
+app.add_template_global(flush, 'flush')
+app.add_template_filter(link_tags, 'link_tags')
+
+
+@app.template_filter('thumbnail')
+def thumbnail_filter(image_url, size):
+    """URL of the `size` thumbnail of an image (see images.py)."""
+
+    return static_path(thumbnail_url(image_url, size))
+
+if app.config['LIKES_WRITE_BEHIND']:
+    like_buffer.init_app(app)
+
+if app.config['CARD_CACHE_PATH']:
+    card_cache.init_app(app)
+
+single_flight.init_app(app)
+invalidation_bus.init_app(app)
+rate_limiter.init_app(app)
+existence_filter.init_app(app)
+
+
+@invalidation_bus.on("user")
+def invalidate_user(user_id):
+    card_cache.invalidate(int(user_id))
+    single_flight.invalidate(f"profile:{user_id}", f"counts:{user_id}")
+
+
+@invalidation_bus.on("timeline")
+def invalidate_timeline(user_id):
+    single_flight.invalidate(f"timeline:{user_id}")
+
+
+@invalidation_bus.on("posts")
+def wake_timelines(user_id):
+    timeline_bus.publish(int(user_id))
+
+
+@invalidation_bus.on("username")
+def username_taken(username):
+    existence_filter.add("username", username)
+
+
+@invalidation_bus.on("email")
+def email_taken(email):
+    existence_filter.add("email", email)
+
+
+@invalidation_bus.on("existence_filter")
+def rebuild_existence_filter(_):
+    existence_filter.mark_stale()
+
+
+@invalidation_bus.on_recover
+def invalidate_everything():
+    card_cache.invalidate_all()
+    single_flight.invalidate_all()
+    timeline_bus.publish_all()
+    # It may have missed a signup, and would call that name free
+    existence_filter.mark_stale()
+
+
+@app.cli.command('build-assets')
+def build_assets_command():
+    """Fingerprint and precompress static files (see assets.py)."""
+
+    built = build_assets(app.static_folder)
+    print(f"Built {len(built)} assets")
+
+
+@app.cli.command('purge-deleted')
+def purge_deleted_command():
+    """Purge all tombstoned users and messages."""
+
+    purge_all()
+
+
+@app.cli.command('recommend')
+@click.option('--changed', is_flag=True,
+              help="Only users whose follows changed since the last run.")
+def recommend_command(changed):
+    """Compute "who to follow" recommendations."""
+
+    if changed:
+        refresh_changed_recommendations()
+    else:
+        compute_all_recommendations()
+
+
+@app.cli.command('index-tags')
+def index_tags_command():
+    """Index the hashtags and mentions of existing messages."""
+
+    indexed = index_tags()
+    print(f"Indexed {indexed} messages")
+
+
+@app.cli.command('recount-likes')
+def recount_likes_command():
+    """Recount every message's likes (fills in like_count)."""
+
+    recounted = sum(Message.recount_likes(shards.session(name))
+                    for name in shards.names)
+    print(f"Recounted likes of {recounted} messages")
+
+
+@app.cli.command('create-shards')
+def create_shards_command():
+    """Create the messages and likes tables on every shard."""
+
+    shards.create_all()
+
+
+@app.cli.command('move-user')
+@click.argument('user_id', type=int)
+@click.argument('shard')
+def move_user_command(user_id, shard):
+    """Move a user's messages to another shard."""
+
+    moved = shards.move_user(user_id, shard)
+    print(f"Moved {moved} messages")
+
+
+@app.cli.command('rebalance-shards')
+def rebalance_shards_command():
+    """Move every user whose shard isn't the one the hash ring picks."""
+
+    moved = shards.rebalance()
+    print(f"Moved {moved} users")
+
+
+@app.cli.command('partition-messages')
+def partition_messages_command():
+    """Convert the messages table to monthly partitions (Postgres)."""
+
+    if partition_messages():
+        print("Partitioned messages")
+    else:
+        print("Messages are already partitioned")
+
+
+@app.cli.command('maintain-messages')
+def maintain_messages_command():
+    """Create upcoming partitions and archive old messages (run daily)."""
+
+    months = ensure_partitions()
+    archived = archive_messages(app.config['MESSAGE_ARCHIVE_DIR'],
+                                app.config['MESSAGE_RETENTION_DAYS'])
+    print(f"{len(months)} partitions ready, archived {archived} messages")
+
+
+@app.cli.command('check-partition-pruning')
+@click.argument('user_id', type=int)
+def check_partition_pruning_command(user_id):
+    """Show which partitions a user's hot queries read."""
+
+    for name, query in (("timeline", timeline_query(user_id)),
+                        ("profile", profile_query(user_id))):
+        print(f"{name}: {', '.join(sorted(scanned_partitions(query)))}")
+
+
+@app.cli.command('export-user')
+@click.argument('user_id', type=int)
+@click.option('--format', type=click.Choice(list(EXPORT_FORMATS)),
+              default='ndjson')
+@click.option('--gzip', is_flag=True, help="Compress the output.")
+@click.option('--after', help="Resume after this row's cursor.")
+@click.option('--output', '-o', type=click.File('wb'), default='-')
+def export_user_command(user_id, format, gzip, after, output):
+    """Write all of a user's data to a file (default: stdout)."""
+
+    user = db.session.get(User, user_id)
+    if user is None or user.deleted_at is not None:
+        raise click.ClickException(f"No user {user_id}")
+
+    try:
+        body = export_stream(user, app.config['MESSAGE_ARCHIVE_DIR'],
+                             format=format, after=after, gzip=gzip)
+    except InvalidCursor as error:
+        raise click.BadParameter(str(error), param_hint='--after')
+
+    for chunk in body:
+        output.write(chunk)
+
+
+@app.cli.command('snapshot-analytics')
+def snapshot_analytics_command():
+    """Snapshot the tables for analytics (then hourly, in the worker)."""
+
+    print(f"Wrote {snapshot_analytics(app.config['ANALYTICS_DIR'])}")
+
+
+@app.cli.command('analytics-stats')
+def analytics_stats_command():
+    """Print the stats from the current analytics snapshot, as JSON."""
+
+    stats = analytics_stats(app.config['ANALYTICS_DIR'])
+    if stats is None:
+        raise click.ClickException("No snapshot yet: run snapshot-analytics")
+
+    print(json.dumps(stats, indent=2))
+
+
+@app.cli.command('rebuild-existence-filter')
+def rebuild_existence_filter_command():
+    """Have every worker rebuild its username and email filter."""
+
+    invalidation_bus.publish("existence_filter:rebuild")
+    db.session.commit()
+
+    # This process's, to report how big it is now
+    existence_filter.build()
+    print(json.dumps(existence_filter.snapshot(), indent=2))
+
+
+@app.cli.command('refresh-trending')
+def refresh_trending_command():
+    """Recompute the trending messages list."""
+
+    refresh_trending()
 
 
 ##############################################################################
 # User signup/login/logout/edit
 
 
+@app.before_request
+def admit_request():
+    """Shed low-priority requests while the database is struggling.
+
+    See load_shedding.py. Runs before add_user_to_g, so a shed request
+    never touches the database.
+    """
+
+    g.degraded = db_health.degraded
+
+    view = app.view_functions.get(request.endpoint)
+    if getattr(view, 'low_priority', False) and not db_health.admit_low_priority():
+        response = make_response(
+            "Warbler is very busy right now. Please try again shortly.", 503)
+        response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+        return response
+
+
+@app.before_request
+def limit_rate():
+    """Check views marked @rate_limited against their token buckets.
+
+    See rate_limit.py. Takes the user from the session cookie rather than
+    the database, so a limited request costs nothing but the check.
+    """
+
+    view = app.view_functions.get(request.endpoint)
+    policy = getattr(view, 'rate_limit', None)
+    if policy is None or request.method not in view.rate_limit_methods:
+        return
+
+    allowed, g.rate_limit = rate_limiter.check(policy, request.remote_addr,
+                                               session.get(CURR_USER_KEY))
+    if not allowed:
+        response = make_response(
+            "Too many requests. Please slow down and try again shortly.", 429)
+        response.headers['Retry-After'] = str(g.rate_limit.retry_after)
+        return response
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    """RateLimit-* headers for the bucket a limited request was closest to
+    emptying."""
+
+    result = g.get('rate_limit')
+    if result is not None:
+        response.headers['RateLimit-Limit'] = str(result.limit)
+        response.headers['RateLimit-Remaining'] = str(result.remaining)
+        response.headers['RateLimit-Reset'] = str(result.reset)
+    return response
+
+
+@app.teardown_request
+def release_admission(error=None):
+    db_health.release_low_priority()
+
+
+@app.errorhandler(ShardMoving)
+def shard_moving(error):
+    """Writes by a user being moved to another shard (see shards.py)."""
+
+    response = make_response(
+        "Your messages are being moved. Please try again shortly.", 503)
+    response.headers['Retry-After'] = str(RETRY_AFTER_SECONDS)
+    return response
+
+
+@app.before_request
+def listen_for_invalidations():
+    """Start this worker's invalidation listener (see invalidation_bus.py)."""
+
+    invalidation_bus.ensure_listening()
+
+
 @app.before_request
 def add_user_to_g():
     """If we're logged in, add curr user to Flask global."""
 
     g.csrf_form = CSRFForm()
     if CURR_USER_KEY in session:
+        db_health.check_out_connection()
         g.user = User.query.get(session[CURR_USER_KEY])
 
+        if g.user and g.user.deleted_at:
+            g.user = None
+
     else:
         g.user = None
 
 
+def liked_ids_for(messages):
+    """Ids of the `messages` the current user has liked (in one query)."""
+
+    if not g.user:
+        return set()
+
+    return g.user.liked_ids_among(msg.id for msg in messages)
+
+
+# Feeds built through single_flight (see single_flight.py). The builders
+# take ids, not model instances, as they may run in a background thread.
+
+TRENDING_FRESH_SECONDS = 30
+
+# How many messages the home timeline shows
+TIMELINE_LENGTH = 100
+
+
+def cached_feed(key, build, **kwargs):
+    """single_flight.get, but serving much older snapshots while degraded."""
+
+    if g.degraded:
+        kwargs['stale_for'] = DEGRADED_STALE_SECONDS
+
+    return single_flight.get(key, build, **kwargs)
+
+
+@app.template_global('user_counts')
+def user_counts(user):
+    """A user's stats (messages, following, followers, likes), built once
+    however many requests show them.
+
+    Follows and messages invalidate them through `user:`; the likes count
+    is refreshed when the entry goes stale.
+    """
+
+    user_id = user.id
+    return cached_feed(f"counts:{user_id}", lambda: load_user_counts(user_id))
+
+
+def profile_query(user_id, before=None):
+    """Message query for a page of a user's profile: the newest, or those
+    older than `before` (a (timestamp, id))."""
+
+    query = Message.visible().filter(Message.user_id == user_id)
+
+    if before is not None:
+        query = query.filter(*older_than(before))
+
+    return (query
+            .order_by(Message.timestamp.desc(), Message.id.desc())
+            .limit(TIMELINE_LENGTH))
+
+
+def profile_rows(user_id, before=None):
+    """Feed rows for a page of a user's profile."""
+
+    if shards.enabled:
+        return shards.feed_rows([user_id], before=before,
+                                limit=TIMELINE_LENGTH)
+
+    return feed_rows(profile_query(user_id, before))
+
+
+def timeline_author_ids(user_id):
+    """Ids of the users whose messages are on a user's home timeline."""
+
+    return [
+        followed_id for followed_id, in (
+            db.session
+            .query(Follows.user_being_followed_id)
+            .filter(Follows.user_following_id == user_id))] + [user_id]
+
+
+def timeline_query(user_id):
+    """Message query for a user's home timeline: them and who they follow."""
+
+    return (Message
+            .visible()
+            .filter(Message.user_id.in_(timeline_author_ids(user_id)))
+            .order_by(Message.timestamp.desc())
+            .limit(TIMELINE_LENGTH))
+
+
+def timeline_rows(user_id):
+    """Feed rows for a user's home timeline."""
+
+    if shards.enabled:
+        return shards.feed_rows(timeline_author_ids(user_id),
+                                limit=TIMELINE_LENGTH)
+
+    return feed_rows(timeline_query(user_id))
+
+
+def timeline_rows_since(author_ids, since_id):
+    """Feed rows for timeline messages newer than message `since_id`."""
+
+    if shards.enabled:
+        return shards.feed_rows(author_ids, order_by=Message.id,
+                                since_id=since_id, limit=TIMELINE_LENGTH)
+
+    return feed_rows(Message
+                     .visible()
+                     .filter(Message.user_id.in_(author_ids),
+                             Message.id > since_id)
+                     .order_by(Message.id.desc())
+                     .limit(TIMELINE_LENGTH))
+
+
+def trending_rows():
+    """Feed rows for the trending page, best first."""
+
+    return feed_rows(Message
+                     .visible()
+                     .join(TrendingMessage,
+                           TrendingMessage.message_id == Message.id)
+                     .order_by(TrendingMessage.score.desc()))
+
+
 def do_login(user):
     """Log in user."""
 
@@ -59,6 +580,7 @@ def do_logout():
 
 
 @app.route('/signup', methods=["GET", "POST"])
+@rate_limited("signup")
 def signup():
     """Handle user signup.
 
@@ -73,19 +595,40 @@ def signup():
     form = UserAddForm()
 
     if form.validate_on_submit():
+        # Before the password hashing, and mostly without a query
+        taken = existence_filter.taken(username=form.username.data,
+                                       email=form.email.data)
+        if taken["username"] or taken["email"]:
+            flash("Username already taken" if taken["username"]
+                  else "Email already taken", 'danger')
+            return render_template('users/signup.html', form=form)
+
         try:
+            image_url = form.image_url.data or User.image_url.default.arg
+            if form.image_file.data:
+                image_url = save_upload(app.config['IMAGE_STORE'],
+                                        form.image_file.data)
+
             user = User.signup(
                 username=form.username.data,
                 password=form.password.data,
                 email=form.email.data,
-                image_url=form.image_url.data or User.image_url.default.arg,
+                image_url=image_url,
             )
+            db.session.flush()
+            shards.assign(user.id)
+            invalidation_bus.publish(f"username:{user.username}",
+                                     f"email:{user.email}")
             db.session.commit()
 
         except IntegrityError:
             flash("Username already taken", 'danger')
             return render_template('users/signup.html', form=form)
 
+        except InvalidImage as error:
+            flash(str(error), 'danger')
+            return render_template('users/signup.html', form=form)
+
         do_login(user)
 
         return redirect("/")
@@ -95,6 +638,7 @@ def signup():
 
 
 @app.route('/login', methods=["GET", "POST"])
+@rate_limited("login")
 def login():
     """Handle user login."""
 
@@ -127,11 +671,29 @@ def logout():
     return redirect('/login')
 
 
+@app.get('/users/available')
+@rate_limited("availability", methods={"GET"})
+def username_available():
+    """Whether the username= and email= given are free, as JSON.
+
+    For checking the signup form as it's typed: usually answered by the
+    existence filter alone (see existence_filter.py).
+    """
+
+    values = {field: request.args[field]
+              for field in ("username", "email")
+              if request.args.get(field)}
+
+    return {field: not taken
+            for field, taken in existence_filter.taken(**values).items()}
+
+
 ##############################################################################
 # General user routes:
 
 
 @app.get('/users')
+@low_priority
 def list_users():
     """Page with listing of users.
 
@@ -140,48 +702,196 @@ def list_users():
 
     search = request.args.get('q')
 
-    if not search:
-        users = User.query.all()
-    else:
-        users = User.query.filter(User.username.like(f"%{search}%")).all()
+    users = User.query.filter(User.deleted_at.is_(None))
 
-    return render_template('users/index.html', users=users)
+    if search:
+        users = users.filter(User.username.like(f"%{search}%"))
+
+    users = user_cards(users)
+    followed_ids = (g.user.following_ids_among(user.id for user in users)
+                    if g.user else set())
+
+    return render_template('users/index.html',
+                           users=users,
+                           followed_ids=followed_ids)
 
 
 @app.get('/users/<int:user_id>')
 def users_show(user_id):
-    """Show user profile."""
+    """Show user profile, a page of messages at a time.
+
+    Takes 'before' and 'before_id' params in querystring, like
+    users_archive. Only the first page is cached.
+    """
+
+    user = User.get_active_or_404(user_id)
+    before = keyset_before()
+
+    if before is None:
+        rows = cached_feed(f"profile:{user.id}",
+                           lambda: profile_rows(user_id))
+    else:
+        rows = profile_rows(user_id, before)
+
+    messages = feed_messages_from_rows(rows)
+    liked_ids = set()
+    like_summaries = {}
+
+    # After the last page of live messages come the archived ones
+    if len(rows) == TIMELINE_LENGTH:
+        last_id, _, last_timestamp, _ = rows[-1]
+        older_url = (f"/users/{user.id}?before={last_timestamp.isoformat()}"
+                     f"&before_id={last_id}")
+    elif has_archived(app.config['MESSAGE_ARCHIVE_DIR'], user.id):
+        older_url = f"/users/{user.id}/archive"
+    else:
+        older_url = None
+
+    return stream_template('users/show.html',
+                           user=user,
+                           messages=feed_batches(messages, liked_ids,
+                                                 like_summaries, g.user),
+                           liked_ids=liked_ids,
+                           like_summaries=like_summaries,
+                           older_url=older_url)
+
+
+def keyset_before():
+    """(timestamp, id) from the 'before' and 'before_id' params, or None."""
+
+    if not (request.args.get('before') and request.args.get('before_id')):
+        return None
+
+    try:
+        return (datetime.fromisoformat(request.args['before']),
+                int(request.args['before_id']))
+    except ValueError:
+        abort(400)
+
+
+@app.get('/users/<int:user_id>/archive')
+@low_priority
+def users_archive(user_id):
+    """Show a page of a user's archived messages (see partitions.py).
 
-    user = User.query.get_or_404(user_id)
+    Takes 'before' and 'before_id' params in querystring: the timestamp and
+    id of the last message of the previous page.
+    """
+
+    user = User.get_active_or_404(user_id)
+    before = keyset_before()
+
+    rows = archived_rows(app.config['MESSAGE_ARCHIVE_DIR'], user.id,
+                         before=before,
+                         limit=ARCHIVE_PAGE_SIZE,
+                         deleted_before=user.messages_deleted_before)
+
+    older_url = None
+    if len(rows) == ARCHIVE_PAGE_SIZE:
+        last_id, _, last_timestamp, _ = rows[-1]
+        older_url = (f"/users/{user.id}/archive?"
+                     f"before={last_timestamp.isoformat()}&before_id={last_id}")
+
+    return render_template('users/show.html',
+                           user=user,
+                           messages=feed_messages_from_rows(rows),
+                           liked_ids=set(),
+                           like_summaries={},
+                           archived=True,
+                           older_url=older_url)
 
-    return render_template('users/show.html', user=user)
+
+@app.get('/users/<int:user_id>/export')
+@low_priority
+def users_export(user_id):
+    """Download all of a user's data (see export.py). Only for that user.
+
+    Takes 'format' (ndjson or csv), 'gzip' and 'after' (the cursor of the
+    last row received, to resume) params in querystring.
+    """
+
+    if not g.user or g.user.id != user_id:
+        return {"error": "Access unauthorized."}, 401
+
+    format = request.args.get('format', 'ndjson')
+    if format not in EXPORT_FORMATS:
+        abort(400)
+    gzip = bool(request.args.get('gzip'))
+
+    try:
+        body = export_stream(g.user, app.config['MESSAGE_ARCHIVE_DIR'],
+                             format=format,
+                             after=request.args.get('after'),
+                             gzip=gzip)
+    except InvalidCursor:
+        abort(400)
+
+    # By id: usernames are free text, not safe in a header
+    filename = f"warbler-{g.user.id}.{format}"
+    if gzip:
+        filename += ".gz"
+
+    response = Response(stream_with_context(body),
+                        mimetype='application/gzip' if gzip
+                        else EXPORT_FORMATS[format])
+    response.headers['Content-Disposition'] = (
+        f'attachment; filename="{filename}"')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
 
 
 @app.get('/users/<int:user_id>/following')
+@low_priority
 def show_following(user_id):
-    """Show list of people this user is following."""
+    """Show list of people this user is following.
+
+    Paginated: takes an 'after' param in querystring with the last user id
+    of the previous page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/following.html', user=user)
+    user = User.get_active_or_404(user_id)
+    after_id = request.args.get('after', type=int)
+    cards, next_after_id = user.following_page(after_id)
+
+    return render_template('users/following.html',
+                           user=user,
+                           cards=cards,
+                           followed_ids=g.user.following_ids_among(
+                               card.id for card in cards),
+                           next_after_id=next_after_id)
 
 
 @app.get('/users/<int:user_id>/followers')
+@low_priority
 def users_followers(user_id):
-    """Show list of followers of this user."""
+    """Show list of followers of this user.
+
+    Paginated: takes an 'after' param in querystring with the last user id
+    of the previous page.
+    """
 
     if not g.user:
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    user = User.query.get_or_404(user_id)
-    return render_template('users/followers.html', user=user)
+    user = User.get_active_or_404(user_id)
+    after_id = request.args.get('after', type=int)
+    cards, next_after_id = user.followers_page(after_id)
+
+    return render_template('users/followers.html',
+                           user=user,
+                           cards=cards,
+                           followed_ids=g.user.following_ids_among(
+                               card.id for card in cards),
+                           next_after_id=next_after_id)
 
 
 @app.post('/users/follow/<int:follow_id>')
+@rate_limited("follow")
 def add_follow(follow_id):
     """Add a follow for the currently-logged-in user."""
 
@@ -189,8 +899,11 @@ def add_follow(follow_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    followed_user = User.query.get_or_404(follow_id)
+    followed_user = User.get_active_or_404(follow_id)
     g.user.following.append(followed_user)
+    note_follows_changed([g.user.id])
+    invalidation_bus.publish(f"user:{g.user.id}", f"user:{follow_id}",
+                             f"timeline:{g.user.id}")
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -206,6 +919,9 @@ def stop_following(follow_id):
 
     followed_user = User.query.get(follow_id)
     g.user.following.remove(followed_user)
+    note_follows_changed([g.user.id])
+    invalidation_bus.publish(f"user:{g.user.id}", f"user:{follow_id}",
+                             f"timeline:{g.user.id}")
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}/following")
@@ -224,6 +940,14 @@ def update_profile():
     form = EditUser(obj=user)
 
     if form.validate_on_submit():
+        changed = {field: form[field].data
+                   for field in ("username", "email")
+                   if form[field].data != getattr(user, field)}
+        if any(existence_filter.taken(exclude_user_id=user.id,
+                                      **changed).values()):
+            flash("Username or email already taken", 'danger')
+            return render_template('/users/edit.html', form=form)
+
         try:
             username = form.username.data
             email = form.email.data
@@ -231,12 +955,22 @@ def update_profile():
             header_image_url = form.header_image_url.data
             bio = form.bio.data
 
+            if form.image_file.data:
+                image_url = save_upload(app.config['IMAGE_STORE'],
+                                        form.image_file.data)
+            if form.header_image_file.data:
+                header_image_url = save_upload(app.config['IMAGE_STORE'],
+                                               form.header_image_file.data)
+
             user.username = username
             user.email = email
             user.image_url = image_url or "/static/images/default-pic.png"
             user.header_image_url = header_image_url or "/static/images/warbler-hero.jpg"
             user.bio = bio
 
+            invalidation_bus.publish(f"user:{user.id}",
+                                     f"username:{user.username}",
+                                     f"email:{user.email}")
             db.session.commit()
 
         except IntegrityError:
@@ -244,7 +978,11 @@ def update_profile():
             db.session.rollback()
 
             flash("Username or email already taken", 'danger')
-            return render_template('users/signup.html', form=form)
+            return render_template('/users/edit.html', form=form)
+
+        except InvalidImage as error:
+            flash(str(error), 'danger')
+            return render_template('/users/edit.html', form=form)
 
         flash('Profile successfuly updated!')
         return redirect(f'/users/{g.user.id}')
@@ -262,7 +1000,22 @@ def delete_user():
 
     do_logout()
 
-    db.session.delete(g.user)
+    g.user.deleted_at = datetime.utcnow()
+    enqueue("purge_user",
+            {"user_id": g.user.id},
+            idempotency_key=f"purge_user:{g.user.id}")
+
+    # Their follows no longer count towards anyone's followers/following
+    follows = (Follows.query
+               .filter(db.or_(Follows.user_following_id == g.user.id,
+                              Follows.user_being_followed_id == g.user.id))
+               .all())
+    invalidation_bus.publish(
+        *{f"user:{user_id}"
+          for follow in follows
+          for user_id in (follow.user_following_id,
+                          follow.user_being_followed_id)},
+        f"user:{g.user.id}")
     db.session.commit()
 
     return redirect("/signup")
@@ -272,6 +1025,7 @@ def delete_user():
 # Messages routes:
 
 @app.route('/messages/new', methods=["GET", "POST"])
+@rate_limited("post")
 def messages_add():
     """Add a message:
 
@@ -285,8 +1039,17 @@ def messages_add():
     form = MessageForm()
 
     if form.validate_on_submit():
-        msg = Message(text=form.text.data)
-        g.user.messages.append(msg)
+        if shards.enabled:
+            message_id = shards.add_message(g.user.id, form.text.data)
+        else:
+            message = Message(text=form.text.data)
+            g.user.messages.append(message)
+            db.session.flush()
+            message_id = message.id
+        index_message(message_id, form.text.data, g.user.id)
+        invalidation_bus.publish(f"user:{g.user.id}",
+                                 f"timeline:{g.user.id}",
+                                 f"posts:{g.user.id}")
         db.session.commit()
 
         return redirect(f"/users/{g.user.id}")
@@ -295,8 +1058,9 @@ def messages_add():
 
 
 @app.route('/messages/<int:message_id>', methods=["GET", "POST"])
+@rate_limited("like")
 def messages_show(message_id):
-    """Show a message."""
+    """Show a message, or (POST) like or unlike it."""
 
     form = CSRFForm()
 
@@ -304,11 +1068,22 @@ def messages_show(message_id):
         g.user.like_or_unlike_message(message_id)
         return redirect(f'/messages/{message_id}')
 
-    msg = Message.query.get(message_id)
-    return render_template('messages/show.html', message=msg)
+    if shards.enabled:
+        row = shards.find_message(message_id)
+        if row is None:
+            abort(404)
+        [msg] = feed_messages_from_rows([row])
+    else:
+        msg = Message.visible().filter(Message.id == message_id).first_or_404()
+
+    return render_template('messages/show.html',
+                           message=msg,
+                           liked_ids=liked_ids_for([msg]),
+                           like_summaries=load_like_summaries([msg.id]))
 
 ############
 @app.route('/messages/<int:message_id>/like', methods=["GET", "POST"])
+@rate_limited("like")
 def toggle_like(message_id):
     """Toggle a liked message for the currently-logged-in user."""
 
@@ -353,17 +1128,97 @@ def messages_destroy(message_id):
         flash("Access unauthorized.", "danger")
         return redirect("/")
 
-    msg = Message.query.get(message_id)
-    db.session.delete(msg)
+    if shards.enabled:
+        deleted = shards.delete_message(g.user.id, message_id)
+    else:
+        msg = Message.visible().filter(Message.id == message_id).first_or_404()
+        deleted = msg.user_id == g.user.id
+        if deleted:
+            msg.deleted_at = datetime.utcnow()
+
+    if deleted:
+        enqueue("purge_messages", {"user_id": g.user.id}, priority=-1)
+        invalidation_bus.publish(f"user:{g.user.id}", f"timeline:{g.user.id}")
+        db.session.commit()
+
+    return redirect(f"/users/{g.user.id}")
+
+
+@app.post('/users/messages/delete')
+def messages_destroy_all():
+    """Delete all of the current user's messages."""
+
+    if not g.user:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    g.user.messages_deleted_before = datetime.utcnow()
+    enqueue("purge_messages", {"user_id": g.user.id}, priority=-1)
+    invalidation_bus.publish(f"user:{g.user.id}", f"timeline:{g.user.id}")
     db.session.commit()
 
     return redirect(f"/users/{g.user.id}")
 
+@app.get('/trending')
+def show_trending():
+    """Show the most liked messages lately (precomputed by trending.py)."""
+
+    rows = cached_feed("trending", trending_rows,
+                       fresh_for=TRENDING_FRESH_SECONDS)
+
+    return render_template('messages/trending.html',
+                           messages=list(feed_messages_from_rows(rows)))
+
+
+def render_feed_page(template, rows, next_before_id, **context):
+    """Render a page of feed rows with their like state."""
+
+    messages = list(feed_messages_from_rows(rows))
+
+    return render_template(template,
+                           messages=messages,
+                           liked_ids=liked_ids_for(messages),
+                           like_summaries=load_like_summaries(
+                               msg.id for msg in messages),
+                           next_before_id=next_before_id,
+                           **context)
+
+
+@app.get('/tags/<tag>')
+def show_tag(tag):
+    """Show messages with a hashtag, newest first (see tags.py).
+
+    Paginated: takes a 'before' param in querystring with the last message
+    id of the previous page.
+    """
+
+    rows, next_before_id = tag_page(tag, request.args.get('before', type=int))
+
+    return render_feed_page('messages/tagged.html', rows, next_before_id,
+                            heading=f"#{tag.lower()}")
+
+
+@app.get('/users/<int:user_id>/mentions')
+def show_mentions(user_id):
+    """Show messages mentioning a user, newest first (see tags.py).
+
+    Paginated like show_tag.
+    """
+
+    user = User.get_active_or_404(user_id)
+
+    rows, next_before_id = mentions_page(user.id,
+                                         request.args.get('before', type=int))
+
+    return render_feed_page('messages/tagged.html', rows, next_before_id,
+                            heading=f"Mentioning @{user.username}")
+
+
 @app.get('/users/<int:user_id>/likes')
 def show_liked_messages(user_id):
     """ Show liked messages on a given users detail page """
 
-    liked_messages = g.user.liked_messages
+    liked_messages = list(feed_messages(g.user.visible_liked_messages()))
 
     return render_template('users/likes.html',
                            messages=liked_messages,
@@ -371,6 +1226,7 @@ def show_liked_messages(user_id):
                            )
 
 @app.post('/users/<int:user_id>/<int:message_id>')
+@rate_limited("like")
 def like_message_from_user_page(user_id, message_id):
     """Show a message."""
 
@@ -380,6 +1236,70 @@ def like_message_from_user_page(user_id, message_id):
 
     return redirect(f'/users/{user_id}')
 
+##############################################################################
+# Uploaded images
+
+
+@app.get('/images/<digest>')
+@app.get('/images/<digest>/<size>')
+def show_image(digest, size=None):
+    """Serve an uploaded image, or one of its thumbnails.
+
+    URLs are content-addressed, so they can be cached forever.
+    """
+
+    store = app.config['IMAGE_STORE']
+
+    if not re.fullmatch(r"[0-9a-f]{64}", digest):
+        abort(404)
+
+    if size is None:
+        path = original_path(store, digest)
+        if not os.path.exists(path):
+            abort(404)
+        mimetype = original_mimetype(path)
+    else:
+        if size not in THUMBNAIL_SIZES:
+            abort(404)
+        path = ensure_thumbnail(store, digest, size)
+        if path is None:
+            abort(404)
+        mimetype = "image/jpeg"
+
+    response = send_file(path, mimetype=mimetype, max_age=CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+##############################################################################
+# Fingerprinted static assets
+
+
+@app.get('/assets/<path:name>')
+def show_asset(name):
+    """Serve a fingerprinted static file, precompressed if accepted.
+
+    Names change with content, so they can be cached forever.
+    """
+
+    path, encoding = built_file(app.static_folder,
+                                name,
+                                request.accept_encodings)
+    if path is None:
+        abort(404)
+
+    response = send_file(path,
+                         mimetype=mimetypes.guess_type(name)[0],
+                         max_age=ASSET_CACHE_SECONDS)
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    response.vary.add('Accept-Encoding')
+    if encoding:
+        response.content_encoding = encoding
+    return response
+
+
 ##############################################################################
 # Homepage and error pages
 
@@ -393,24 +1313,195 @@ def homepage():
     """
 
     if g.user:
-        following_ids = [
-            following_user.id for
-            following_user in
-            g.user.following] + [g.user.id]
-
-        messages = (Message
-                    .query
-                    .filter(Message.user_id.in_(following_ids))
-                    .order_by(Message.timestamp.desc())
-                    .limit(100)
-                    .all())
-
-        return render_template('home.html', messages=messages)
+        user_id = g.user.id
+        rows = cached_feed(f"timeline:{user_id}",
+                           lambda: timeline_rows(user_id))
+        messages = feed_messages_from_rows(rows)
+        liked_ids = set()
+        like_summaries = {}
+
+        return stream_template('home.html',
+                               messages=feed_batches(messages, liked_ids,
+                                                     like_summaries, g.user),
+                               liked_ids=liked_ids,
+                               like_summaries=like_summaries,
+                               head_id=max((row[0] for row in rows), default=0),
+                               recommendations=(
+                                   [] if g.degraded
+                                   else g.user.recommended_users()))
 
     else:
         return render_template('home-anon.html')
 
 
+##############################################################################
+# Live timeline updates (see static/scripts/timeline.js)
+
+# How long one stream lasts before the browser reconnects, so stream
+# threads get recycled and follow changes are picked up
+STREAM_SECONDS = 120
+STREAM_RETRY_MS = 3000
+
+# How long a browser turned away by a full or busy worker polls instead
+BUSY_RETRY_MS = 60000
+
+
+def timeline_delta(author_ids, since_id):
+    """Timeline messages newer than `since_id`: {head, count, html}."""
+
+    rows = timeline_rows_since(author_ids, since_id)
+    messages = list(feed_messages_from_rows(rows))
+
+    html = render_template('messages/timeline_items.html',
+                           messages=messages,
+                           liked_ids=liked_ids_for(messages),
+                           like_summaries=load_like_summaries(
+                               msg.id for msg in messages))
+
+    return {"head": rows[0][0] if rows else since_id,
+            "count": len(rows),
+            "html": html}
+
+
+def sse_event(event, data, id=None):
+    """One Server-Sent Event."""
+
+    lines = [f"id: {id}"] if id is not None else []
+    lines += [f"event: {event}", f"data: {data}"]
+    return "\n".join(lines) + "\n\n"
+
+
+@app.get('/timeline')
+def timeline_since():
+    """Messages on the current user's timeline newer than ?since_id=."""
+
+    if not g.user:
+        return {"error": "Access unauthorized."}, 401
+
+    since_id = request.args.get('since_id', 0, type=int)
+
+    return timeline_delta(timeline_author_ids(g.user.id), since_id)
+
+
+@app.get('/timeline/stream')
+def timeline_stream():
+    """Server-Sent Events: new messages on the current user's timeline.
+
+    Starts from ?since_id= (or Last-Event-ID, when the browser reconnects).
+    Sends a `messages` event (data as from /timeline) whenever there are
+    new ones. Between them the stream holds no DB connection: it sleeps on
+    timeline_bus until someone it follows posts, or for a heartbeat.
+    """
+
+    if not g.user:
+        return {"error": "Access unauthorized."}, 401
+
+    since_id = (request.headers.get('Last-Event-ID', type=int)
+                or request.args.get('since_id', 0, type=int))
+    author_ids = timeline_author_ids(g.user.id)
+
+    subscription = None if g.degraded else timeline_bus.subscribe(author_ids)
+    if subscription is None:
+        return Response(sse_event("busy", BUSY_RETRY_MS),
+                        mimetype='text/event-stream')
+
+    def events():
+        head = since_id
+        deadline = time.monotonic() + STREAM_SECONDS
+
+        with subscription:
+            yield f"retry: {STREAM_RETRY_MS}\n\n"
+
+            while True:
+                delta = timeline_delta(author_ids, head)
+
+                # Give the connection back to the pool while we wait
+                db.session.rollback()
+
+                if delta["count"]:
+                    head = delta["head"]
+                    yield sse_event("messages", json.dumps(delta), id=head)
+
+                if time.monotonic() >= deadline:
+                    return
+
+                if not subscription.wait():
+                    # Nothing from this process; the next query still
+                    # catches posts made through other workers
+                    yield ": heartbeat\n\n"
+
+    response = Response(stream_with_context(events()),
+                        mimetype='text/event-stream')
+    response.headers['X-Accel-Buffering'] = 'no'
+    # If the client goes before the stream starts, events() never runs
+    response.call_on_close(subscription.close)
+    return response
+
+
+@app.post('/api/ingest')
+@low_priority
+def api_ingest():
+    """Bulk ingest messages, follows and likes from an NDJSON body.
+
+    Streams back one NDJSON result line per batch (see ingest.py).
+    """
+
+    token = app.config['INGEST_TOKEN']
+    if not token:
+        abort(404)
+
+    sent = request.headers.get('Authorization', '')
+    if not hmac.compare_digest(sent.encode(), f"Bearer {token}".encode()):
+        return {"error": "Access unauthorized."}, 401
+
+    def results():
+        retention_days = app.config['MESSAGE_RETENTION_DAYS']
+        for result in ingest(read_lines(request.stream),
+                             retention_days=retention_days):
+            yield json.dumps(result) + "\n"
+
+    response = Response(stream_with_context(results()),
+                        mimetype='application/x-ndjson')
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.get('/admin/stats')
+def admin_stats():
+    """Show operational stats, from the analytics snapshot (see analytics.py)."""
+
+    if not g.user or g.user.id not in app.config['ADMIN_USER_IDS']:
+        flash("Access unauthorized.", "danger")
+        return redirect("/")
+
+    return render_template('admin/stats.html',
+                           stats=analytics_stats(app.config['ANALYTICS_DIR']))
+
+
+@app.get('/readyz')
+def readyz():
+    """Readiness check: 200 once warmed up (see server.py), else 503."""
+
+    ready, checks = is_ready()
+
+    return checks, 200 if ready else 503
+
+
+@app.get('/metrics')
+def metrics():
+    """This worker's cache, invalidation, rate limit, existence filter and
+    database health counters. Admins only, like /admin/stats."""
+
+    if not g.user or g.user.id not in app.config['ADMIN_USER_IDS']:
+        return {"error": "Access unauthorized."}, 401
+
+    return {"single_flight": dict(single_flight.stats),
+            "invalidation_bus": dict(invalidation_bus.stats),
+            "rate_limits": dict(rate_limiter.stats),
+            "existence_filter": existence_filter.snapshot(),
+            "database": db_health.snapshot()}
+
+
 ##############################################################################
 # Turn off all caching in Flask
 #   (useful for dev; in production, this kind of stuff is typically
@@ -423,5 +1514,7 @@ def add_header(response):
     """Add non-caching headers on every request."""
 
     # https://developer.mozilla.org/en-US/docs/Web/HTTP/Headers/Cache-Control
-    response.cache_control.no_store = True
+    # (responses that set their own max-age, like images, are left alone)
+    if response.cache_control.max_age is None:
+        response.cache_control.no_store = True
     return response
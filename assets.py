@@ -0,0 +1,165 @@
+"""Fingerprinted, precompressed static assets.
+
+`flask build-assets` copies every file in static/ to static/build/ with a
+content hash in its name (stylesheets/style.css ->
+stylesheets/style.1a2b3c4d5e6f.css), writes .gz and .br variants of the
+compressible ones, and records the mapping in static/build/manifest.json.
+url() references inside stylesheets are rewritten to the fingerprinted
+names first, so a stylesheet's hash changes when an image it uses does.
+
+Templates link to assets with static_url('stylesheets/style.css'). With a
+manifest that's /assets/stylesheets/style.1a2b3c4d5e6f.css, served (see
+app.py) with the best precompressed variant the browser accepts and cached
+for a year. Without one (in development), it's the plain /static/ URL.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+
+try:
+    import brotli
+except ImportError:  # .br variants are skipped without it
+    brotli = None
+
+BUILD_DIR_NAME = "build"
+MANIFEST_NAME = "manifest.json"
+
+COMPRESSIBLE_EXTENSIONS = {".css", ".js", ".svg", ".ico", ".json", ".txt"}
+
+# Content-Encoding -> file suffix, most preferred first
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+_CSS_URL = re.compile(r"""url\(\s*(['"]?)/static/([^'")]+)\1\s*\)""")
+
+manifest = {}
+
+
+def fingerprinted_name(filename, data):
+    """`filename` with a hash of `data` before its extension."""
+
+    root, ext = os.path.splitext(filename)
+    return f"{root}.{hashlib.sha256(data).hexdigest()[:12]}{ext}"
+
+
+def _source_files(static_folder):
+    """Paths (relative to static/, with /) of the files to fingerprint."""
+
+    for dirpath, dirnames, filenames in os.walk(static_folder):
+        if dirpath == static_folder and BUILD_DIR_NAME in dirnames:
+            dirnames.remove(BUILD_DIR_NAME)
+
+        for filename in filenames:
+            path = os.path.join(dirpath, filename)
+            yield os.path.relpath(path, static_folder).replace(os.sep, "/")
+
+
+def _write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(data)
+
+
+def build_assets(static_folder):
+    """Fingerprint and precompress everything in `static_folder`.
+
+    Replaces static/build/ and returns the new manifest.
+    """
+
+    build_folder = os.path.join(static_folder, BUILD_DIR_NAME)
+    shutil.rmtree(build_folder, ignore_errors=True)
+
+    sources = sorted(_source_files(static_folder))
+
+    # Stylesheets last, so the files they refer to are already renamed
+    sources.sort(key=lambda name: name.endswith(".css"))
+
+    new_manifest = {}
+
+    for name in sources:
+        with open(os.path.join(static_folder, name), "rb") as f:
+            data = f.read()
+
+        if name.endswith(".css"):
+            data = _CSS_URL.sub(
+                lambda match: 'url("{}")'.format(
+                    asset_path(match.group(2), new_manifest)),
+                data.decode("utf-8"),
+            ).encode("utf-8")
+
+        built_name = fingerprinted_name(name, data)
+        new_manifest[name] = built_name
+
+        built_path = os.path.join(build_folder, built_name)
+        _write(built_path, data)
+
+        if os.path.splitext(name)[1] in COMPRESSIBLE_EXTENSIONS:
+            _write(built_path + ".gz", gzip.compress(data, 9, mtime=0))
+            if brotli is not None:
+                _write(built_path + ".br", brotli.compress(data))
+
+    _write(os.path.join(build_folder, MANIFEST_NAME),
+           json.dumps(new_manifest, indent=2, sort_keys=True).encode("utf-8"))
+
+    return new_manifest
+
+
+def load_manifest(static_folder):
+    """Load static/build/manifest.json into `manifest`, if it's there."""
+
+    manifest.clear()
+
+    path = os.path.join(static_folder, BUILD_DIR_NAME, MANIFEST_NAME)
+    if os.path.exists(path):
+        with open(path) as f:
+            manifest.update(json.load(f))
+
+    return manifest
+
+
+def asset_path(filename, names=None):
+    """URL for static file `filename`: fingerprinted if it's been built."""
+
+    names = manifest if names is None else names
+
+    if filename in names:
+        return f"/assets/{names[filename]}"
+
+    return f"/static/{filename}"
+
+
+def static_url(filename):
+    """URL for static file `filename` (Jinja global)."""
+
+    return asset_path(filename)
+
+
+def static_path(url):
+    """Rewrite a /static/... URL to its fingerprinted one, if built."""
+
+    if url and url.startswith("/static/"):
+        return asset_path(url[len("/static/"):])
+
+    return url
+
+
+def built_file(static_folder, name, accept_encodings):
+    """(path, content encoding) of the best variant of built file `name`.
+
+    Returns (None, None) if there is no such file.
+    """
+
+    path = os.path.join(static_folder, BUILD_DIR_NAME, name)
+    if not os.path.isfile(path) or name == MANIFEST_NAME:
+        return None, None
+
+    for encoding, suffix in ENCODINGS:
+        if accept_encodings[encoding] and os.path.exists(path + suffix):
+            return path + suffix, encoding
+
+    return path, None
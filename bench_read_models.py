@@ -0,0 +1,114 @@
+"""Benchmark: full ORM instances vs read models for a 1,000-message render.
+
+Loads the likes page of a user who liked 1,000 messages both ways (User and
+Message instances joined with contains_eager, as the pages used to, and
+read_models.feed_messages) and renders users/likes.html with each. Reports
+the best wall time and the peak memory (tracemalloc) per message.
+
+Uses its own database, which it drops and recreates:
+
+    FLASK_ENV=production python bench_read_models.py
+"""
+
+import os
+import time
+import tracemalloc
+
+os.environ['DATABASE_URL'] = os.environ.get(
+    'BENCH_DATABASE_URL', "postgresql:///warbler_bench")
+os.environ.setdefault('SECRET_KEY', "bench")
+
+from flask import g, render_template
+from sqlalchemy.orm import contains_eager
+
+from app import app
+from forms import CSRFForm
+from models import db, Like, Message, User
+from read_models import feed_messages
+
+MESSAGES = 1000
+AUTHORS = 50
+ROUNDS = 5
+
+
+def seed():
+    db.drop_all()
+    db.create_all()
+
+    db.session.bulk_insert_mappings(User, [
+        {"id": i,
+         "email": f"user{i}@test.com",
+         "username": f"user{i}",
+         "password": "x" * 60,
+         "bio": "A bio nobody reads on a timeline. " * 4}
+        for i in range(1, AUTHORS + 1)])
+    db.session.bulk_insert_mappings(Message, [
+        {"id": i, "text": f"Message number {i}. " * 5, "user_id": i % AUTHORS + 1}
+        for i in range(1, MESSAGES + 1)])
+    db.session.bulk_insert_mappings(Like, [
+        {"user_liking_id": 1, "liked_message_id": i}
+        for i in range(1, MESSAGES + 1)])
+    db.session.commit()
+
+
+def load_orm(user):
+    return (user.visible_liked_messages()
+            .options(contains_eager(Message.user))
+            .all())
+
+
+def load_read_models(user):
+    return list(feed_messages(user.visible_liked_messages()))
+
+
+def render(load):
+    """Load and render the likes page once, in a fresh session."""
+
+    db.session.remove()
+    user = User.query.get(1)
+    g.user = user
+    g.csrf_form = CSRFForm()
+
+    messages = load(user)
+    return render_template('users/likes.html', messages=messages, user=user)
+
+
+def measure(load):
+    """(best seconds, peak bytes) for one render."""
+
+    render(load)  # warm up template and statement caches
+
+    best = float("inf")
+    for _ in range(ROUNDS):
+        start = time.perf_counter()
+        render(load)
+        best = min(best, time.perf_counter() - start)
+
+    tracemalloc.start()
+    render(load)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return best, peak
+
+
+def main():
+    with app.test_request_context():
+        seed()
+
+        results = {name: measure(load) for name, load in
+                   [("orm", load_orm), ("read models", load_read_models)]}
+
+        print(f"{MESSAGES} messages, best of {ROUNDS}")
+        for name, (seconds, peak) in results.items():
+            print(f"{name:>12}: {seconds * 1000:7.1f} ms "
+                  f"({seconds / MESSAGES * 1e6:5.1f} us/item), "
+                  f"peak {peak / 1024:7.0f} KiB "
+                  f"({peak / MESSAGES:5.0f} B/item)")
+
+        db.session.remove()
+        db.drop_all()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,348 @@
+"""Host-wide shared-memory cache of user cards.
+
+Every worker process on a host maps the same file (CARD_CACHE_PATH, best
+put on tmpfs such as /dev/shm) and reads author cards (id, username,
+and image_url) straight out of it: no pickling, no round trip to
+another process, no per-worker copy of the same popular authors.
+
+The file is a fixed array of fixed-size slots, grouped into sets of
+WAYS slots; a user can only live in the set its id hashes to. When a set
+is full, a clock hand over its slots picks the first one that hasn't
+been read since the hand last passed it (or since it was written).
+
+Reads take no lock. Each slot has a sequence number that a writer makes
+odd before changing the slot and even again after, so a reader that sees
+an odd or changed sequence knows it read a half-written slot and retries.
+Writes (rare: only on misses) hold the file's flock.
+
+Invalidation is by version, not by deleting entries: the file also holds
+a table of version counters, indexed by user id. invalidate(user_id) bumps
+the user's counter, so any cached card for them no longer matches and is
+a miss. A card is only stored if its counter hasn't moved since before it
+was read from the database, so a slow request can't put back a card that
+an edit committed in the meantime has already invalidated.
+
+Other hosts hear about edits through the invalidation bus (see
+invalidation_bus.py); entries also expire after CARD_CACHE_TTL_SECONDS, in
+case an invalidation never arrives.
+"""
+
+import fcntl
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+CARD_CACHE_SLOTS = 16384
+CARD_CACHE_TTL_SECONDS = 60
+
+WAYS = 8
+VERSION_COUNTERS = 65536
+
+MAX_USERNAME_BYTES = 64
+MAX_IMAGE_URL_BYTES = 256
+
+READ_ATTEMPTS = 3
+
+CachedCard = namedtuple("CachedCard", "id username image_url")
+
+_MAGIC = b"WBCARDS1"
+
+# magic, slots, ways, version counters, slot size
+_HEADER = struct.Struct("<8sIIII")
+_HEADER_SIZE = 64
+
+_U32 = struct.Struct("<I")
+
+# sequence, user id (0 = empty), version, filled at, referenced,
+# username length, image URL length, username, image URL
+_SLOT = struct.Struct(f"<IqIdBBH{MAX_USERNAME_BYTES}s{MAX_IMAGE_URL_BYTES}s")
+_REFERENCED_OFFSET = 24
+
+
+class SharedCardCache:
+    """Fixed-size user card cache in a file mapped by every worker."""
+
+    def __init__(self):
+        self.path = None
+        self.slots = CARD_CACHE_SLOTS
+        self.ttl = CARD_CACHE_TTL_SECONDS
+
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.path is not None
+
+    def init_app(self, app):
+        """Use the cache file named by app.config['CARD_CACHE_PATH']."""
+
+        self.path = app.config['CARD_CACHE_PATH']
+        self.slots = app.config.get('CARD_CACHE_SLOTS', CARD_CACHE_SLOTS)
+        self.ttl = app.config.get('CARD_CACHE_TTL_SECONDS',
+                                  CARD_CACHE_TTL_SECONDS)
+
+        # Round down to whole sets
+        self.slots -= self.slots % WAYS
+        self._open()
+
+    # Layout
+
+    @property
+    def _sets(self):
+        return self.slots // WAYS
+
+    @property
+    def _versions_offset(self):
+        return _HEADER_SIZE
+
+    @property
+    def _hands_offset(self):
+        return self._versions_offset + VERSION_COUNTERS * _U32.size
+
+    @property
+    def _slots_offset(self):
+        return self._hands_offset + self._sets * _U32.size
+
+    @property
+    def size(self):
+        """Size of the cache file in bytes."""
+
+        return self._slots_offset + self.slots * _SLOT.size
+
+    def _slot_offset(self, slot):
+        return self._slots_offset + slot * _SLOT.size
+
+    def _set_slots(self, user_id):
+        first = (user_id * 2654435761 % 2**32) % self._sets * WAYS
+        return range(first, first + WAYS)
+
+    def _version_offset(self, user_id):
+        return self._versions_offset + user_id % VERSION_COUNTERS * _U32.size
+
+    # Opening
+
+    def _open(self):
+        """Map the cache file, creating or resetting it if needed.
+
+        Called again lazily in a process forked after init_app (a preloaded
+        gunicorn worker): it needs its own file descriptor, as flock locks
+        belong to the open file, which a fork shares.
+        """
+
+        if self._fd is not None:
+            os.close(self._fd)
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        self._pid = os.getpid()
+
+        header = _HEADER.pack(_MAGIC, self.slots, WAYS, VERSION_COUNTERS,
+                              _SLOT.size)
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if (os.fstat(self._fd).st_size != self.size
+                    or os.pread(self._fd, _HEADER.size, 0) != header):
+                # New file, or one laid out by a different version of this
+                # module: start from empty
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, header, 0)
+
+            self._map = mmap.mmap(self._fd, self.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _mapped(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            os.close(self._fd)
+        self._map = self._fd = self._pid = None
+
+    # Reading
+
+    def version(self, user_id):
+        """Current version counter for `user_id`."""
+
+        return _U32.unpack_from(self._mapped(),
+                                self._version_offset(user_id))[0]
+
+    def versions(self, user_ids):
+        """{user id: current version}; snapshot these before a DB read."""
+
+        return {user_id: self.version(user_id) for user_id in user_ids}
+
+    def _read_slot(self, buf, offset):
+        """Unpacked slot at `offset`, or None if it's being written."""
+
+        for _ in range(READ_ATTEMPTS):
+            fields = _SLOT.unpack_from(buf, offset)
+            sequence = fields[0]
+            if sequence % 2 == 0 and _U32.unpack_from(buf, offset)[0] == sequence:
+                return fields
+
+        return None
+
+    def get(self, user_id):
+        """The cached card for `user_id`, or None."""
+
+        buf = self._mapped()
+        version = self.version(user_id)
+        now = time.time()
+
+        for slot in self._set_slots(user_id):
+            offset = self._slot_offset(slot)
+            fields = self._read_slot(buf, offset)
+            if fields is None or fields[1] != user_id:
+                continue
+
+            (_, _, slot_version, filled_at, _, username_len, image_url_len,
+             username, image_url) = fields
+
+            if slot_version != version or now - filled_at > self.ttl:
+                return None
+
+            buf[offset + _REFERENCED_OFFSET] = 1
+
+            return CachedCard(
+                user_id,
+                username[:username_len].decode("utf-8"),
+                image_url[:image_url_len].decode("utf-8") or None)
+
+        return None
+
+    def get_many(self, user_ids):
+        """{user id: card} for the `user_ids` that are cached."""
+
+        cards = {}
+        for user_id in user_ids:
+            card = self.get(user_id)
+            if card is not None:
+                cards[user_id] = card
+
+        return cards
+
+    # Writing
+
+    def put(self, card, version):
+        """Cache `card`, read from the database at `version`.
+
+        Does nothing if the user has been invalidated since, or if the
+        card's strings don't fit in a slot. Returns whether it was stored.
+        """
+
+        username = card.username.encode("utf-8")
+        image_url = (card.image_url or "").encode("utf-8")
+        if (len(username) > MAX_USERNAME_BYTES
+                or len(image_url) > MAX_IMAGE_URL_BYTES):
+            return False
+
+        buf = self._mapped()
+
+        with self._locked():
+            if self.version(card.id) != version:
+                return False
+
+            slot = self._slot_for(buf, card.id)
+            offset = self._slot_offset(slot)
+            sequence = _U32.unpack_from(buf, offset)[0]
+
+            _U32.pack_into(buf, offset, sequence + 1)
+            _SLOT.pack_into(
+                buf, offset,
+                sequence + 1, card.id, version, time.time(), 0,
+                len(username), len(image_url), username, image_url)
+            _U32.pack_into(buf, offset, sequence + 2)
+
+        return True
+
+    def _slot_for(self, buf, user_id):
+        """Slot to write `user_id` to: its own, a free one, or a victim."""
+
+        slots = self._set_slots(user_id)
+        free = None
+
+        for slot in slots:
+            slot_user_id = struct.unpack_from(
+                "<q", buf, self._slot_offset(slot) + _U32.size)[0]
+            if slot_user_id == user_id:
+                return slot
+            if slot_user_id == 0 and free is None:
+                free = slot
+
+        if free is not None:
+            return free
+
+        # Clock: clear referenced bits until we come to a slot without one
+        hand_offset = self._hands_offset + slots.start // WAYS * _U32.size
+        hand = _U32.unpack_from(buf, hand_offset)[0]
+
+        while True:
+            slot = slots.start + hand % WAYS
+            referenced_offset = self._slot_offset(slot) + _REFERENCED_OFFSET
+            hand = (hand + 1) % WAYS
+
+            if buf[referenced_offset]:
+                buf[referenced_offset] = 0
+            else:
+                _U32.pack_into(buf, hand_offset, hand)
+                return slot
+
+    def invalidate(self, *user_ids):
+        """Make any cached cards for `user_ids` stale, on every worker."""
+
+        if not self.enabled:
+            return
+
+        buf = self._mapped()
+
+        with self._locked():
+            for user_id in user_ids:
+                offset = self._version_offset(user_id)
+                version = _U32.unpack_from(buf, offset)[0]
+                _U32.pack_into(buf, offset, (version + 1) % 2**32)
+
+    def invalidate_all(self):
+        """Make every cached card stale, on every worker."""
+
+        if not self.enabled:
+            return
+
+        buf = self._mapped()
+
+        with self._locked():
+            counters = memoryview(buf)[
+                self._versions_offset:self._hands_offset].cast("I")
+            try:
+                for i in range(len(counters)):
+                    counters[i] = (counters[i] + 1) % 2**32
+            finally:
+                counters.release()
+
+    @contextmanager
+    def _locked(self):
+        """Hold this process's lock and the cache file's flock."""
+
+        with self._lock:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+
+card_cache = SharedCardCache()
@@ -0,0 +1,325 @@
+"""Which usernames and emails are taken, mostly without the database.
+
+Signup and profile edits used to find a taken username or email only by
+hashing the password and failing to commit, and the live availability
+check on the signup form (GET /users/available) would be a query per
+keystroke. Instead each worker keeps a Bloom filter of every username
+and email in the users table. A name it has never seen is certainly free;
+only a possible hit is checked against the database, and most of those
+are real. The IntegrityError on commit is still the final word.
+
+The filter is built by server.warm_up() (so forked workers share the
+copy), or on first use, from one pass over the users table. It's kept
+current with the invalidation bus: signup and profile edits publish
+
+    username:<username>
+    email:<email>
+
+and every worker adds them to its filter. Anything else that writes
+usernames or emails (seed.py, ingest scripts) should publish them too,
+or run `flask rebuild-existence-filter`.
+
+A Bloom filter can't forget, so a renamed or purged user's old name
+stays a possible hit (a deleted user's row keeps its name until the
+purge, so it really is taken until then). Those cost one query each and
+are counted as false positives in the stats. The filter is rebuilt from
+scratch, sized for the table as it is then, when:
+
+- it's REBUILD_SECONDS old;
+- more keys were added than it was sized for;
+- the invalidation bus may have missed events (a missed signup would
+  make the filter say a taken name is free);
+- `flask rebuild-existence-filter` asks every worker to.
+
+A rebuild runs in a background thread, started by whichever request next
+needs the filter, so no request waits for the scan. Until it's done,
+requests keep using the old filter if it can still be trusted (it's only
+old or full), and otherwise ask the database.
+"""
+
+import hashlib
+import logging
+import math
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+
+from models import db, User
+
+logger = logging.getLogger(__name__)
+
+# Wrong "possibly taken" answers the filter is sized for
+FALSE_POSITIVE_RATE = 0.01
+
+# Room for this many times the keys at build time, and at least
+# MIN_CAPACITY, before it needs rebuilding
+GROWTH_FACTOR = 2
+MIN_CAPACITY = 10000
+
+REBUILD_SECONDS = 6 * 60 * 60
+
+# Users read per round trip while building
+BUILD_CHUNK_SIZE = 10000
+
+FIELDS = ("username", "email")
+
+_MASK = 2 ** 64 - 1
+
+
+def _hashes(key):
+    """Two independent 64-bit hashes of `key`, for double hashing."""
+
+    digest = hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+    return (int.from_bytes(digest[:8], "little"),
+            int.from_bytes(digest[8:], "little") | 1)
+
+
+def _key(field, value):
+    return f"{field}:{value}"
+
+
+class _Bits:
+    """A Bloom filter's bit array, and how it was sized."""
+
+    def __init__(self, capacity, false_positive_rate):
+        self.capacity = capacity
+        self.size = max(64, math.ceil(
+            -capacity * math.log(false_positive_rate) / math.log(2) ** 2))
+        self.hash_count = max(1, round(self.size / capacity * math.log(2)))
+        self.array = bytearray((self.size + 7) // 8)
+        self.keys = 0
+
+    def _positions(self, h1, h2):
+        return [((h1 + i * h2) & _MASK) % self.size
+                for i in range(self.hash_count)]
+
+    def add(self, key):
+        for position in self._positions(*_hashes(key)):
+            self.array[position >> 3] |= 1 << (position & 7)
+        self.keys += 1
+
+    def add_many(self, keys):
+        """Add `keys` at once, with the bit arithmetic in NumPy."""
+
+        hashes = np.array([_hashes(key) for key in keys],
+                          dtype=np.uint64).reshape(-1, 2)
+        steps = np.arange(self.hash_count, dtype=np.uint64)
+
+        # (uint64 arithmetic wraps like _MASK does)
+        positions = ((hashes[:, :1] + steps * hashes[:, 1:])
+                     % np.uint64(self.size)).ravel()
+
+        array = np.frombuffer(self.array, dtype=np.uint8)
+        np.bitwise_or.at(array,
+                         (positions >> np.uint64(3)).astype(np.int64),
+                         (np.uint8(1) << (positions & np.uint64(7))
+                          .astype(np.uint8)))
+        self.keys += len(hashes)
+
+    def __contains__(self, key):
+        return all(self.array[position >> 3] & 1 << (position & 7)
+                   for position in self._positions(*_hashes(key)))
+
+    def fill(self):
+        """Share of bits set."""
+
+        return (int(np.unpackbits(np.frombuffer(self.array, dtype=np.uint8))
+                    .sum()) / self.size)
+
+
+class ExistenceFilter:
+    """This worker's Bloom filter of taken usernames and emails."""
+
+    def __init__(self, false_positive_rate=FALSE_POSITIVE_RATE,
+                 rebuild_seconds=REBUILD_SECONDS):
+        self.false_positive_rate = false_positive_rate
+        self.rebuild_seconds = rebuild_seconds
+        self.stats = Counter()
+        self.app = None
+
+        self._bits = None
+        self._built_at = None
+        self._stale = True
+        # Whether mark_stale() was called since the running build started
+        self._marked = False
+        # Keys added while a rebuild reads the table, for the new filter
+        self._pending = None
+        self._lock = threading.Lock()
+        self._building = threading.Lock()
+
+    def init_app(self, app):
+        """Rebuild in `app`'s context (in the background)."""
+
+        self.app = app
+
+    @property
+    def needs_rebuild(self):
+        bits = self._bits
+        return (self._stale
+                or bits is None
+                or bits.keys > bits.capacity
+                or time.monotonic() - self._built_at > self.rebuild_seconds)
+
+    def mark_stale(self):
+        """Rebuild before the filter is trusted again."""
+
+        with self._lock:
+            self._stale = True
+            self._marked = True
+
+    def add(self, field, value):
+        """Note that `field` (username or email) `value` is taken."""
+
+        key = _key(field, value)
+
+        with self._lock:
+            if self._bits is not None:
+                self._bits.add(key)
+            if self._pending is not None:
+                self._pending.append(key)
+
+    def build(self, chunk_size=BUILD_CHUNK_SIZE):
+        """Build a new filter from the users table and start using it.
+
+        Waits for a background rebuild that's already running.
+        """
+
+        with self._building:
+            self._build(chunk_size)
+
+    def _build(self, chunk_size):
+        start = time.monotonic()
+
+        with self._lock:
+            self._pending = []
+            self._marked = False
+
+        try:
+            users = db.session.query(db.func.count(User.id)).scalar()
+            bits = _Bits(max(MIN_CAPACITY,
+                             GROWTH_FACTOR * len(FIELDS) * users),
+                         self.false_positive_rate)
+
+            chunk = []
+            for username, email in (db.session
+                                    .query(User.username, User.email)
+                                    .yield_per(chunk_size)):
+                chunk += [_key("username", username), _key("email", email)]
+
+                if len(chunk) >= chunk_size:
+                    bits.add_many(chunk)
+                    chunk = []
+            bits.add_many(chunk)
+
+        except Exception:
+            with self._lock:
+                self._pending = None
+            raise
+
+        with self._lock:
+            for key in self._pending:
+                bits.add(key)
+            self._pending = None
+            self._bits = bits
+            self._built_at = time.monotonic()
+            # Events missed during the scan may not be in it
+            self._stale = self._marked
+
+        self.stats["builds"] += 1
+        logger.info("existence filter: %d keys in %d bits, built in %.2fs",
+                    bits.keys, bits.size, time.monotonic() - start)
+
+    def _ready_bits(self):
+        """The filter to use, or None (ask the database) while it can't be
+        trusted. Starts a background rebuild if one is due."""
+
+        if self.needs_rebuild and self._building.acquire(blocking=False):
+            threading.Thread(target=self._rebuild, name="existence-filter",
+                             daemon=True).start()
+
+        return None if self._stale else self._bits
+
+    def _rebuild(self):
+        """Background rebuild; the caller holds self._building for us."""
+
+        try:
+            if self.app is None:
+                self._build(BUILD_CHUNK_SIZE)
+            else:
+                with self.app.app_context():
+                    self._build(BUILD_CHUNK_SIZE)
+        except Exception:
+            logger.exception("rebuilding the existence filter failed")
+        finally:
+            self._building.release()
+
+    def might_be_taken(self, field, value):
+        """False if `value` is certainly not a taken `field`."""
+
+        bits = self._ready_bits()
+        if bits is None:
+            self.stats["unbuilt"] += 1
+            return True
+
+        self.stats["checks"] += 1
+
+        if _key(field, value) in bits:
+            self.stats["possible"] += 1
+            return True
+
+        return False
+
+    def taken(self, exclude_user_id=None, **values):
+        """{field: whether it's taken} for each of username=, email=.
+
+        Only asks the database about possible hits. `exclude_user_id`'s
+        own username and email don't count as taken.
+        """
+
+        taken = {}
+
+        for field, value in values.items():
+            if not value or not self.might_be_taken(field, value):
+                taken[field] = False
+                continue
+
+            query = User.query.filter(getattr(User, field) == value)
+            if exclude_user_id is not None:
+                query = query.filter(User.id != exclude_user_id)
+
+            taken[field] = db.session.query(query.exists()).scalar()
+            if not taken[field]:
+                self.stats["false_positives"] += 1
+
+        return taken
+
+    def snapshot(self):
+        """Stats, and the filter's size and measured false positive rate."""
+
+        bits = self._bits
+        snapshot = dict(self.stats)
+
+        # Of the checks for free names, how many the filter got wrong
+        free = (snapshot.get("checks", 0) - snapshot.get("possible", 0)
+                + snapshot.get("false_positives", 0))
+        snapshot["observed_false_positive_rate"] = (
+            snapshot.get("false_positives", 0) / free if free else 0.0)
+
+        if bits is not None:
+            fill = bits.fill()
+            snapshot.update({
+                "keys": bits.keys,
+                "capacity": bits.capacity,
+                "bits": bits.size,
+                "hashes": bits.hash_count,
+                "fill": fill,
+                "estimated_false_positive_rate": fill ** bits.hash_count,
+                "stale": self.needs_rebuild,
+            })
+
+        return snapshot
+
+
+existence_filter = ExistenceFilter()
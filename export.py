@@ -0,0 +1,229 @@
+"""Streaming export of a user's data.
+
+/users/<id>/export (and `flask export-user`) sends everything a user has
+put into Warbler, one row per line, as NDJSON or CSV:
+
+- their archived messages (see partitions.py), oldest month first;
+- their messages;
+- the messages they've liked;
+- the users they follow, and the users following them.
+
+Nothing is loaded up front. Each section is read in id order from a
+server-side cursor, EXPORT_CHUNK_SIZE rows at a time (archived months a
+line at a time), and written out as it's read, optionally gzipped on the
+fly. Memory stays flat however heavy the account.
+
+Every row has a `cursor`. An interrupted export picks up where it
+stopped with ?after=<the last cursor received>, as long as it's asked
+for in the same format: each section is keyset-paginated, so resuming
+reads nothing that was already sent.
+"""
+
+import csv
+import io
+import json
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+
+from models import db, Follows, Like, Message, User
+from partitions import archived_messages
+from shards import shards
+from streaming import _buffered, _gzipped
+
+# Rows read per round trip from each server-side cursor
+EXPORT_CHUNK_SIZE = 1000
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+
+CSV_COLUMNS = ("cursor", "type", "id", "timestamp", "text", "username")
+
+
+class InvalidCursor(ValueError):
+    """An ?after= cursor that isn't one an export handed out."""
+
+
+def parse_cursor(cursor):
+    """(section, key) for a cursor, or (None, None) for no cursor."""
+
+    if not cursor:
+        return None, None
+
+    section, _, key = cursor.partition(":")
+
+    try:
+        if section == "archived_message":
+            month, _, message_id = key.partition("/")
+            return section, (month, int(message_id))
+        if section in SECTIONS:
+            return section, int(key)
+    except ValueError:
+        pass
+
+    raise InvalidCursor(f"invalid cursor {cursor!r}")
+
+
+def export_rows(user, archive_dir, after=None, chunk_size=EXPORT_CHUNK_SIZE):
+    """A dict for each row of `user`'s export, after cursor `after`."""
+
+    resume_section, resume_key = parse_cursor(after)
+    started = resume_section is None
+
+    for section, rows in SECTIONS.items():
+        if not started and section != resume_section:
+            continue
+
+        key = None if started else resume_key
+        started = True
+
+        if section == "archived_message":
+            yield from rows(user, archive_dir, key)
+        else:
+            yield from rows(user, key, chunk_size)
+
+
+def _archived_messages(user, archive_dir, after):
+    deleted_before = user.messages_deleted_before
+
+    for month, row in archived_messages(archive_dir, user.id):
+        if after is not None and (month, row["id"]) <= after:
+            continue
+        if (deleted_before is not None
+                and datetime.fromisoformat(row["timestamp"]) <= deleted_before):
+            continue
+
+        yield {"cursor": f"archived_message:{month}/{row['id']}",
+               "type": "archived_message",
+               "id": row["id"],
+               "timestamp": row["timestamp"],
+               "text": row["text"]}
+
+
+def _messages(user, after_id, chunk_size):
+    query = (shards.session(shards.shard_of(user.id))
+             .query(Message.id, Message.timestamp, Message.text)
+             .filter(Message.user_id == user.id,
+                     Message.deleted_at.is_(None)))
+    if user.messages_deleted_before is not None:
+        query = query.filter(Message.timestamp > user.messages_deleted_before)
+    if after_id is not None:
+        query = query.filter(Message.id > after_id)
+
+    for message_id, timestamp, text in (query
+                                        .order_by(Message.id)
+                                        .yield_per(chunk_size)):
+        yield {"cursor": f"message:{message_id}",
+               "type": "message",
+               "id": message_id,
+               "timestamp": timestamp.isoformat(),
+               "text": text}
+
+
+def _likes(user, after_id, chunk_size):
+    # A user's likes are stored with the liked messages, so on any shard
+    # (and, after an interrupted move, on a stale one too)
+    def liked(shard):
+        query = (shards.session(shard)
+                 .query(Like.liked_message_id, Message.user_id)
+                 .join(Message, Message.id == Like.liked_message_id)
+                 .filter(Like.user_liking_id == user.id))
+        if after_id is not None:
+            query = query.filter(Like.liked_message_id > after_id)
+
+        return ((shard, message_id, author_id)
+                for message_id, author_id in (
+                    query.order_by(Like.liked_message_id)
+                    .yield_per(chunk_size)))
+
+    rows = merge(*(liked(shard) for shard in shards.names),
+                 key=itemgetter(1))
+
+    while True:
+        chunk = list(islice(rows, chunk_size))
+        if not chunk:
+            return
+
+        for _, message_id, _ in shards.on_author_shards(chunk):
+            yield {"cursor": f"like:{message_id}",
+                   "type": "like",
+                   "id": message_id}
+
+
+def _follows(section, user_column, other_column):
+    def rows(user, after_id, chunk_size):
+        query = (db.session
+                 .query(User.id, User.username)
+                 .join(Follows, other_column == User.id)
+                 .filter(user_column == user.id, User.deleted_at.is_(None)))
+        if after_id is not None:
+            query = query.filter(User.id > after_id)
+
+        for user_id, username in (query
+                                  .order_by(User.id)
+                                  .yield_per(chunk_size)):
+            yield {"cursor": f"{section}:{user_id}",
+                   "type": section,
+                   "id": user_id,
+                   "username": username}
+
+    return rows
+
+
+# In export order
+SECTIONS = {
+    "archived_message": _archived_messages,
+    "message": _messages,
+    "like": _likes,
+    "following": _follows("following", Follows.user_following_id,
+                          Follows.user_being_followed_id),
+    "follower": _follows("follower", Follows.user_being_followed_id,
+                         Follows.user_following_id),
+}
+
+
+def _ndjson_lines(rows):
+    for row in rows:
+        yield json.dumps(row) + "\n"
+
+
+def _csv_lines(rows, header=True):
+    out = io.StringIO()
+    writer = csv.writer(out)
+
+    def line(values):
+        writer.writerow(values)
+        value = out.getvalue()
+        out.seek(0)
+        out.truncate()
+        return value
+
+    if header:
+        yield line(CSV_COLUMNS)
+
+    for row in rows:
+        yield line([row.get(column, "") for column in CSV_COLUMNS])
+
+
+def export_stream(user, archive_dir, format="ndjson", after=None,
+                  gzip=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """`user`'s export as a stream of byte strings.
+
+    A resumed CSV export (with `after`) has no header row, so it can be
+    appended to what was already received. Raises InvalidCursor for a bad
+    `after` straight away, before anything is sent.
+    """
+
+    parse_cursor(after)
+    rows = export_rows(user, archive_dir, after, chunk_size)
+
+    if format == "csv":
+        lines = _csv_lines(rows, header=after is None)
+    else:
+        lines = _ndjson_lines(rows)
+
+    body = _buffered(lines)
+    return _gzipped(body) if gzip else body
@@ -1,7 +1,10 @@
 from flask_wtf import FlaskForm
+from flask_wtf.file import FileField, FileAllowed
 from wtforms import StringField, PasswordField, TextAreaField
 from wtforms.validators import DataRequired, Email, Length
 
+from images import UPLOAD_EXTENSIONS
+
 
 class MessageForm(FlaskForm):
     """Form for adding/editing messages."""
@@ -16,6 +19,8 @@ class UserAddForm(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     password = PasswordField('Password', validators=[Length(min=6)])
     image_url = StringField('(Optional) Image URL')
+    image_file = FileField('(Optional) Upload Image',
+                           validators=[FileAllowed(UPLOAD_EXTENSIONS, 'Images only!')])
 
 
 class LoginForm(FlaskForm):
@@ -36,5 +41,9 @@ class EditUser(FlaskForm):
     email = StringField('E-mail', validators=[DataRequired(), Email()])
     image_url = StringField('(Optional) Image URL', default="/static/images/default-pic.png")
     header_image_url = StringField('(Optional) Header Image URL', default="/static/images/warbler-hero.jpg")
+    image_file = FileField('(Optional) Upload Image',
+                           validators=[FileAllowed(UPLOAD_EXTENSIONS, 'Images only!')])
+    header_image_file = FileField('(Optional) Upload Header Image',
+                                  validators=[FileAllowed(UPLOAD_EXTENSIONS, 'Images only!')])
     bio = TextAreaField('Bio')
     password = PasswordField('Password')
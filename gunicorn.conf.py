@@ -0,0 +1,47 @@
+"""gunicorn settings for production (see server.py).
+
+    gunicorn -c gunicorn.conf.py app:app
+"""
+
+import os
+
+from server import worker_counts
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '8000')}"
+
+workers, threads, pool_size = worker_counts()
+workers = int(os.environ.get('WEB_CONCURRENCY', workers))
+
+# Read by app.py on import
+os.environ.setdefault('DB_POOL_SIZE', str(pool_size))
+
+# Load the app once, in the master, and fork workers from it
+preload_app = True
+
+# Streamed pages keep a thread busy until the browser has them
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then so slow leaks can't build up
+max_requests = 5000
+max_requests_jitter = 500
+
+
+def on_starting(server):
+    """Warm the preloaded app before binding the port or forking."""
+
+    from app import app
+    from server import warm_up
+
+    warm_up(app)
+
+
+def post_fork(server, worker):
+    """Don't share the master's DB connections with a worker."""
+
+    from app import app
+    from models import db
+
+    with app.app_context():
+        db.engine.dispose()
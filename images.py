@@ -0,0 +1,174 @@
+"""Uploaded avatar and header images, and their thumbnails.
+
+Uploads are stored once under IMAGE_STORE, named by the SHA-256 of their
+contents, and the user's image_url becomes /images/<digest>. Templates ask
+for the size they render at with the `thumbnail` filter, e.g.
+{{ user.image_url | thumbnail('timeline') }} -> /images/<digest>/timeline.
+Remote URLs and the default static images pass through unchanged.
+
+Thumbnails are generated in a background pool right after the upload (or on
+first request, if that hasn't finished). Since the URL changes whenever the
+image does, they're served with a year-long immutable Cache-Control.
+"""
+
+import hashlib
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+
+from PIL import Image, ImageOps
+
+# Thumbnail sizes in pixels: 2x the CSS size they're shown at
+THUMBNAIL_SIZES = {
+    "timeline": (96, 96),
+    "card": (140, 140),
+    "avatar": (400, 400),
+    "card_header": (700, 240),
+    "header": (1600, 360),
+}
+
+UPLOAD_EXTENSIONS = ["jpg", "jpeg", "png", "gif", "webp"]
+MAX_UPLOAD_BYTES = 8 * 1024 * 1024
+
+CACHE_SECONDS = 365 * 24 * 60 * 60
+
+_IMAGE_URL = re.compile(r"^/images/(?P<digest>[0-9a-f]{64})$")
+
+thumbnail_pool = ThreadPoolExecutor(max_workers=2,
+                                    thread_name_prefix="thumbnails")
+
+_in_flight = {}
+_in_flight_lock = threading.Lock()
+
+
+class InvalidImage(ValueError):
+    """The upload isn't an image we can read, or is too big."""
+
+
+def original_path(store, digest):
+    return os.path.join(store, "originals", digest[:2], digest)
+
+
+def thumbnail_path(store, digest, size):
+    return os.path.join(store, "thumbnails", digest[:2], f"{digest}-{size}.jpg")
+
+
+def save_upload(store, file_storage):
+    """Store an uploaded image, start making its thumbnails, return its URL.
+
+    Raises InvalidImage if it isn't a readable image.
+    """
+
+    data = file_storage.read(MAX_UPLOAD_BYTES + 1)
+    if len(data) > MAX_UPLOAD_BYTES:
+        raise InvalidImage("Image is too large")
+
+    try:
+        with Image.open(BytesIO(data)) as image:
+            image.verify()
+    except Exception:
+        raise InvalidImage("Not a valid image")
+
+    digest = hashlib.sha256(data).hexdigest()
+    path = original_path(store, digest)
+
+    if not os.path.exists(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        _write_atomically(path, data)
+
+    for size in THUMBNAIL_SIZES:
+        _submit(store, digest, size)
+
+    return f"/images/{digest}"
+
+
+def thumbnail_url(image_url, size):
+    """URL of the `size` thumbnail for `image_url` (Jinja filter)."""
+
+    match = _IMAGE_URL.match(image_url or "")
+    if not match or size not in THUMBNAIL_SIZES:
+        return image_url
+
+    return f"{image_url}/{size}"
+
+
+def original_mimetype(path):
+    """Content type of a stored original, from its contents."""
+
+    with Image.open(path) as image:
+        return image.get_format_mimetype()
+
+
+def ensure_thumbnail(store, digest, size):
+    """Path to the `size` thumbnail for `digest`, making it if needed.
+
+    Returns None if there is no such original.
+    """
+
+    path = thumbnail_path(store, digest, size)
+    if os.path.exists(path):
+        return path
+
+    if not os.path.exists(original_path(store, digest)):
+        return None
+
+    return _submit(store, digest, size).result()
+
+
+def _submit(store, digest, size):
+    """Make a thumbnail in the pool; concurrent asks share one future."""
+
+    key = (digest, size)
+
+    with _in_flight_lock:
+        future = _in_flight.get(key)
+        if future is not None:
+            return future
+
+        future = thumbnail_pool.submit(_make_thumbnail, store, digest, size)
+        _in_flight[key] = future
+
+    # Outside the lock: if the thumbnail is already done, this runs _forget
+    # right here
+    future.add_done_callback(lambda _: _forget(key))
+
+    return future
+
+
+def _forget(key):
+    with _in_flight_lock:
+        _in_flight.pop(key, None)
+
+
+def _make_thumbnail(store, digest, size):
+    path = thumbnail_path(store, digest, size)
+    if os.path.exists(path):
+        return path
+
+    with Image.open(original_path(store, digest)) as image:
+        image = ImageOps.exif_transpose(image)
+
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, "white")
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+
+        thumbnail = ImageOps.fit(image, THUMBNAIL_SIZES[size], Image.LANCZOS)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        thumbnail.save(tmp_path, "JPEG", quality=85,
+                       optimize=True, progressive=True)
+        os.replace(tmp_path, path)
+
+    return path
+
+
+def _write_atomically(path, data):
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        f.write(data)
+    os.replace(tmp_path, path)
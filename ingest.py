@@ -0,0 +1,348 @@
+"""Bulk ingest of messages, follows and likes from NDJSON.
+
+POST /api/ingest takes newline-delimited JSON, one row per line:
+
+    {"type": "message", "user_id": 1, "text": "hi", "timestamp": "2021-06-01T12:00:00"}
+    {"type": "follow", "user_id": 1, "follows_id": 2}
+    {"type": "like", "user_id": 1, "message_id": 3}
+
+(a message's timestamp is optional, and can't be in the future or older
+than the messages table keeps: see retention_horizon() in
+partitions.py). The body is read a line at a time
+as it arrives, and each line is checked on its own as it's read. Every
+INGEST_BATCH_SIZE lines, the valid rows are checked against the database
+(users and messages exist, in a few queries for the whole batch) and
+written in one transaction, with one multi-row INSERT per table. Follows
+and likes that already exist are skipped, so replaying an upload doesn't
+duplicate them (messages have no natural key, and are always added).
+
+The response is NDJSON too, streamed back one line per batch as it's
+committed:
+
+    {"batch": 1, "lines": [1, 500], "inserted": {"messages": 120, ...},
+     "skipped": 3, "errors": [{"line": 17, "error": "..."}]}
+
+and a final {"done": true, ...} line with the totals. A batch that fails
+to commit is reported with an "error" and the upload carries on. Only
+one batch is held at a time, so memory stays flat however big the upload.
+
+Requests need `Authorization: Bearer <INGEST_TOKEN>`; without
+INGEST_TOKEN set the endpoint is off. Like the like buffer, ingest writes
+to the main database only: with sharding on, messages by users on other
+shards, and likes of their messages, are rejected.
+
+Ingested likes count towards like counts, but not towards trending: they
+aren't new.
+"""
+
+import json
+import logging
+from collections import Counter
+from datetime import datetime, timedelta, timezone
+
+from sqlalchemy import tuple_
+from sqlalchemy.exc import SQLAlchemyError
+
+from invalidation_bus import invalidation_bus
+from models import (
+    db, Follows, insert_ignoring_duplicates, Like, Message, User)
+from partitions import (
+    MESSAGE_RETENTION_DAYS, ensure_partitions, month_start, retention_horizon)
+from recommendations import note_follows_changed
+from shards import MAIN, shards
+from tags import index_messages
+
+logger = logging.getLogger(__name__)
+
+INGEST_BATCH_SIZE = 500
+
+# Longer lines are rejected (and skipped without being held in memory)
+MAX_LINE_BYTES = 4096
+
+MAX_MESSAGE_LENGTH = Message.text.type.length
+
+# How far ahead of our clock a message's timestamp may be
+MAX_CLOCK_SKEW = timedelta(minutes=5)
+
+# Fields each row type needs, and their types
+ROW_FIELDS = {
+    "message": {"user_id": int, "text": str},
+    "follow": {"user_id": int, "follows_id": int},
+    "like": {"user_id": int, "message_id": int},
+}
+
+
+class RowError(ValueError):
+    """A row that can't be ingested."""
+
+
+def read_lines(stream, max_bytes=MAX_LINE_BYTES):
+    """(line number, line) for each line of a binary stream, read as it
+    arrives. Lines longer than `max_bytes` come back as None."""
+
+    number = 0
+
+    while True:
+        line = stream.readline(max_bytes + 1)
+        if not line:
+            return
+        number += 1
+
+        if len(line) > max_bytes and not line.endswith(b"\n"):
+            while line and not line.endswith(b"\n"):
+                line = stream.readline(max_bytes + 1)
+            line = None
+
+        yield number, line
+
+
+def parse_row(line, horizon=None):
+    """(type, fields) for one line. Raises RowError if it isn't valid.
+
+    Only checks the line itself: users and messages are checked a batch
+    at a time by write_batch(). Messages from before `horizon` (default:
+    retention_horizon()) are rejected.
+    """
+
+    if line is None:
+        raise RowError(f"line longer than {MAX_LINE_BYTES} bytes")
+
+    try:
+        row = json.loads(line)
+    except ValueError:
+        raise RowError("not valid JSON")
+
+    if not isinstance(row, dict):
+        raise RowError("not a JSON object")
+
+    kind = row.get("type")
+    if kind not in ROW_FIELDS:
+        raise RowError(f"unknown type {kind!r}")
+
+    fields = {}
+    for name, kind_of in ROW_FIELDS[kind].items():
+        value = row.get(name)
+        if not isinstance(value, kind_of) or isinstance(value, bool):
+            raise RowError(f"{name} must be "
+                           f"{'an integer' if kind_of is int else 'a string'}")
+        fields[name] = value
+
+    if kind == "message":
+        if not 0 < len(fields["text"].strip()) <= MAX_MESSAGE_LENGTH:
+            raise RowError(
+                f"text must be 1 to {MAX_MESSAGE_LENGTH} characters")
+
+        now = fields["timestamp"] = datetime.utcnow()
+        if row.get("timestamp") is not None:
+            try:
+                timestamp = datetime.fromisoformat(row["timestamp"])
+            except (TypeError, ValueError):
+                raise RowError("timestamp must be an ISO 8601 date and time")
+
+            if timestamp.tzinfo is not None:
+                timestamp = timestamp.astimezone(timezone.utc).replace(
+                    tzinfo=None)
+
+            # It would stay at the top of every timeline
+            if timestamp > now + MAX_CLOCK_SKEW:
+                raise RowError("timestamp is in the future")
+
+            # Its month has been (or is about to be) archived
+            horizon = horizon or retention_horizon(now=now)
+            if timestamp < horizon:
+                raise RowError(f"timestamp is before {horizon:%Y-%m-%d}, "
+                               f"older than messages are kept")
+
+            fields["timestamp"] = timestamp
+
+    if kind == "follow" and fields["user_id"] == fields["follows_id"]:
+        raise RowError("users can't follow themselves")
+
+    return kind, fields
+
+
+def ingest(lines, batch_size=INGEST_BATCH_SIZE,
+           retention_days=MESSAGE_RETENTION_DAYS):
+    """Ingest (line number, line) pairs; yields one result per batch,
+    then the totals."""
+
+    horizon = retention_horizon(retention_days)
+    totals = Counter()
+    batch_number = 0
+    rows = []
+    errors = []
+    first_line = None
+
+    def flush():
+        nonlocal batch_number, rows, errors, first_line
+
+        batch_number += 1
+        result = {"batch": batch_number, "lines": [first_line, number]}
+
+        try:
+            inserted, skipped, rejected = write_batch(rows)
+        except SQLAlchemyError as error:
+            db.session.rollback()
+            logger.exception("ingest batch %s failed", batch_number)
+            result.update(error=type(error).__name__, errors=errors)
+            totals["failed_batches"] += 1
+        else:
+            result.update(inserted=inserted, skipped=skipped,
+                          errors=sorted(errors + rejected,
+                                        key=lambda error: error["line"]))
+            totals.update(inserted)
+            totals["skipped"] += skipped
+            totals["errors"] += len(result["errors"])
+
+        rows, errors, first_line = [], [], None
+        return result
+
+    number = 0
+    for number, line in lines:
+        if first_line is None:
+            first_line = number
+
+        try:
+            rows.append((number, *parse_row(line, horizon)))
+        except RowError as error:
+            errors.append({"line": number, "error": str(error)})
+
+        if number - first_line + 1 == batch_size:
+            yield flush()
+
+    if first_line is not None:
+        yield flush()
+
+    yield {"done": True, "batches": batch_number, **totals}
+
+
+def write_batch(rows):
+    """Check a batch of parsed (line, type, fields) rows against the
+    database and insert the good ones, in one transaction.
+
+    Returns ({table: rows inserted}, rows skipped as already there,
+    [errors]).
+    """
+
+    errors = []
+
+    def reject(number, error):
+        errors.append({"line": number, "error": error})
+
+    user_ids = {fields[name] for _, _, fields in rows
+                for name in ("user_id", "follows_id") if name in fields}
+    active_ids = {user_id for user_id, in (
+        db.session
+        .query(User.id)
+        .filter(User.id.in_(user_ids), User.deleted_at.is_(None)))}
+    user_shards = shards.shards_of(active_ids) if shards.enabled else {}
+
+    liked_ids = {fields["message_id"] for _, kind, fields in rows
+                 if kind == "like"}
+    authors = dict(Message.visible()
+                   .with_entities(Message.id, Message.user_id)
+                   .filter(Message.id.in_(liked_ids))) if liked_ids else {}
+
+    messages, follows, likes = [], {}, {}
+
+    for number, kind, fields in rows:
+        missing = [user_id for user_id in (fields["user_id"],
+                                           fields.get("follows_id"))
+                   if user_id is not None and user_id not in active_ids]
+        if missing:
+            reject(number, f"no such user {missing[0]}")
+
+        elif kind == "message":
+            if user_shards.get(fields["user_id"], MAIN) != MAIN:
+                reject(number, "author is on another shard")
+            else:
+                messages.append(fields)
+
+        elif kind == "follow":
+            follows[(fields["follows_id"], fields["user_id"])] = number
+
+        elif fields["message_id"] not in authors:
+            reject(number, f"no such message {fields['message_id']}")
+        elif authors[fields["message_id"]] == fields["user_id"]:
+            reject(number, "users can't like their own messages")
+        else:
+            likes[(fields["user_id"], fields["message_id"])] = number
+
+    inserted = {"messages": _insert_messages(messages),
+                "follows": _insert_follows(follows),
+                "likes": _insert_likes(likes)}
+    db.session.commit()
+
+    skipped = (len(messages) + len(follows) + len(likes)
+               - sum(inserted.values()))
+    return inserted, skipped, errors
+
+
+def _insert_messages(messages):
+    if not messages:
+        return 0
+
+    # Earlier months' partitions may not exist yet (the ones from this
+    # month on are kept ahead by `flask maintain-messages`)
+    oldest = min(fields["timestamp"] for fields in messages)
+    if oldest < month_start(datetime.utcnow()):
+        ensure_partitions(since=oldest)
+
+    for fields, message_id in zip(messages,
+                                  shards.allocate_message_ids(len(messages))):
+        fields["id"] = message_id
+
+    db.session.execute(Message.__table__.insert().values(messages))
+    index_messages((fields["id"], fields["text"], fields["user_id"])
+                   for fields in messages)
+
+    author_ids = {fields["user_id"] for fields in messages}
+    invalidation_bus.publish(*(f"{kind}:{user_id}" for user_id in author_ids
+                               for kind in ("user", "timeline", "posts")))
+    return len(messages)
+
+
+def _existing(key_columns, keys):
+    """Those of `keys` (tuples of key_columns' values) already in the table."""
+
+    return {tuple(row) for row in (db.session
+                                   .query(*key_columns)
+                                   .filter(tuple_(*key_columns).in_(keys)))}
+
+
+def _insert_follows(follows):
+    """`follows` is {(followed id, follower id): line number}."""
+
+    new = follows.keys() - _existing(
+        (Follows.user_being_followed_id, Follows.user_following_id),
+        list(follows))
+    if not new:
+        return 0
+
+    insert_ignoring_duplicates(Follows, [
+        {"user_being_followed_id": followed_id,
+         "user_following_id": follower_id}
+        for followed_id, follower_id in new])
+
+    follower_ids = {follower_id for _, follower_id in new}
+    note_follows_changed(follower_ids)
+    invalidation_bus.publish(
+        *{f"user:{user_id}" for key in new for user_id in key},
+        *(f"timeline:{follower_id}" for follower_id in follower_ids))
+    return len(new)
+
+
+def _insert_likes(likes):
+    """`likes` is {(user id, message id): line number}."""
+
+    new = likes.keys() - _existing(
+        (Like.user_liking_id, Like.liked_message_id), list(likes))
+    if not new:
+        return 0
+
+    insert_ignoring_duplicates(Like, [
+        {"user_liking_id": user_id, "liked_message_id": message_id}
+        for user_id, message_id in new])
+
+    Message.count_likes(Counter(message_id for _, message_id in new))
+    return len(new)
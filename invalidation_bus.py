@@ -0,0 +1,485 @@
+"""Cache invalidation events, broadcast to every worker.
+
+Write paths say what they changed as keys, with invalidation_bus.publish()
+any time before their transaction commits:
+
+    user:<id>       a user's card or profile (username, image, counts)
+    timeline:<id>   what's on a user's home timeline
+    posts:<id>      a user posted a message
+
+When the transaction commits, the keys are applied in this process right
+away, so the writer's next page sees its own change. They are also sent
+to every other worker:
+
+- on Postgres, with NOTIFY issued inside the transaction (after its
+  flush), so the event is delivered if and only if the commit is;
+- on other databases, as datagrams to the Unix socket of each worker in
+  INVALIDATION_SOCKET_DIR (a stand-in that only reaches one host).
+
+If the transaction rolls back, the keys are dropped.
+
+Each worker runs a listener thread that applies what the others send.
+Applying a key calls the handlers registered for its kind with on().
+app.py registers the card cache, the single-flight pages and live
+timelines.
+
+Events can go missing: NOTIFYs sent while a listener is reconnecting, or
+datagrams dropped because a worker's socket buffer was full. Each
+publisher numbers its events, so a listener notices a gap in a
+publisher's sequence that isn't filled within GAP_GRACE_SECONDS (events
+from concurrent transactions can arrive out of order). It also assumes it
+missed something whenever it reconnects. Either way it recovers: it runs
+the on_recover() handlers, which drop everything cached locally.
+"""
+
+import json
+import logging
+import os
+import select
+import socket
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+
+from sqlalchemy import event, text
+from sqlalchemy.engine import make_url
+
+from models import db
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = "warbler_invalidation"
+
+# Postgres NOTIFY payloads must be under 8000 bytes, and datagrams small.
+# More keys than fit are split into several events (a single key too big
+# to send is sent as "invalidate everything")
+MAX_PAYLOAD_BYTES = 7900
+
+# Room in a payload for everything but the keys
+_EVENT_OVERHEAD_BYTES = 100
+
+# How long an out-of-order event may take to fill a gap in a sequence
+GAP_GRACE_SECONDS = 1
+
+# How often the listener wakes to check for gaps, with nothing to receive
+POLL_SECONDS = 1
+
+RECONNECT_SECONDS = 1
+
+# Forget publishers (workers) not heard from for this long
+PUBLISHER_TTL_SECONDS = 60 * 60
+
+
+class _Sequence:
+    """Event numbers seen from one publisher."""
+
+    def __init__(self, seq):
+        self.expected = seq + 1
+        self.early = set()
+        self.gap_since = None
+        self.seen_at = time.monotonic()
+
+    def see(self, seq):
+        self.seen_at = time.monotonic()
+
+        if seq == self.expected:
+            self.expected += 1
+            while self.expected in self.early:
+                self.early.remove(self.expected)
+                self.expected += 1
+            if not self.early:
+                self.gap_since = None
+
+        elif seq > self.expected:
+            self.early.add(seq)
+            self.gap_since = self.gap_since or self.seen_at
+
+    def skip_gap(self):
+        """Give up on the missing events."""
+
+        self.expected = max(self.early) + 1
+        self.early.clear()
+        self.gap_since = None
+
+
+class InvalidationBus:
+    """Publishes invalidated keys on commit and applies everyone else's."""
+
+    def __init__(self, transport=None, socket_dir=None):
+        self.app = None
+        self.transport = transport
+        self.socket_dir = socket_dir
+        self.gap_grace = GAP_GRACE_SECONDS
+        self.stats = Counter()
+
+        self._closed = False
+        self._handlers = defaultdict(list)
+        self._recover_handlers = []
+        self._lock = threading.Lock()
+        self._reset_process()
+
+    def init_app(self, app):
+        """Publish on commits of `app`'s sessions.
+
+        Uses NOTIFY if the database is Postgres, else the sockets in
+        app.config['INVALIDATION_SOCKET_DIR'] (if set), else nothing: keys
+        are only applied in the process that committed them.
+        """
+
+        self.app = app
+        self.socket_dir = app.config.get('INVALIDATION_SOCKET_DIR')
+
+        database_url = make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+        if database_url.get_backend_name() == "postgresql":
+            self.transport = "postgres"
+        elif self.socket_dir:
+            self.transport = "socket"
+            os.makedirs(self.socket_dir, exist_ok=True)
+
+        event.listen(db.session, "before_commit", self._before_commit)
+        event.listen(db.session, "after_commit", self._after_commit)
+        event.listen(db.session, "after_rollback", self._after_rollback)
+
+    def _reset_process(self):
+        """Per-process state, fresh in a forked worker."""
+
+        self._pid = os.getpid()
+        self.publisher = uuid.uuid4().hex[:12]
+        self._seq = 0
+        self._sequences = {}
+        self._thread = None
+        self._send_socket = None
+
+    def _check_process(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset_process()
+
+    # Handlers
+
+    def on(self, kind):
+        """Decorator: call handler(id) whenever a `kind`:id key is applied."""
+
+        def register(handler):
+            self._handlers[kind].append(handler)
+            return handler
+
+        return register
+
+    def on_recover(self, handler):
+        """Call handler() when events may have been missed."""
+
+        self._recover_handlers.append(handler)
+        return handler
+
+    def apply(self, keys):
+        """Run the handlers of `keys`."""
+
+        for key in keys:
+            kind, _, arg = key.partition(":")
+
+            for handler in self._handlers.get(kind, ()):
+                try:
+                    handler(arg)
+                except Exception:
+                    logger.exception("invalidating %s failed", key)
+
+    def recover(self):
+        """Treat everything cached here as stale: we missed events."""
+
+        self.stats["recoveries"] += 1
+
+        for handler in self._recover_handlers:
+            try:
+                handler()
+            except Exception:
+                logger.exception("recovering from missed events failed")
+
+    # Publishing
+
+    def publish(self, *keys):
+        """Invalidate `keys` everywhere once the session commits."""
+
+        session = db.session()
+
+        # So a rollback, even with nothing else done yet, drops them
+        if not session.in_transaction():
+            session.begin()
+
+        session.info.setdefault("invalidations", set()).update(keys)
+
+    def _next_seq(self):
+        self._check_process()
+
+        with self._lock:
+            self._seq += 1
+            return self._seq
+
+    def _payload(self, seq, keys):
+        payload = json.dumps({"p": self.publisher, "s": seq,
+                              "k": sorted(keys)}, separators=(",", ":"))
+
+        if len(payload.encode("utf-8")) > MAX_PAYLOAD_BYTES:
+            payload = json.dumps({"p": self.publisher, "s": seq, "k": None},
+                                 separators=(",", ":"))
+
+        return payload
+
+    def _event(self, keys):
+        """The next numbered event from this process, as a payload."""
+
+        self.stats["published"] += 1
+        return self._payload(self._next_seq(), keys)
+
+    @staticmethod
+    def _split(keys):
+        """`keys` in lists small enough for one event each."""
+
+        chunks = [[]]
+        size = 0
+
+        for key in sorted(keys):
+            key_size = len(json.dumps(key).encode("utf-8")) + 1
+            if (chunks[-1] and size + key_size
+                    > MAX_PAYLOAD_BYTES - _EVENT_OVERHEAD_BYTES):
+                chunks.append([])
+                size = 0
+            chunks[-1].append(key)
+            size += key_size
+
+        return chunks
+
+    def _events(self, keys):
+        """Numbered payloads for `keys`, as many as they need."""
+
+        return [self._event(chunk) for chunk in self._split(keys)]
+
+    def _notify(self, connection, payload):
+        connection.execute(text("SELECT pg_notify(:channel, :payload)"),
+                           {"channel": CHANNEL, "payload": payload})
+
+    def _before_commit(self, session):
+        keys = session.info.get("invalidations")
+
+        if keys and self.transport == "postgres":
+            # Flush first: a flush that fails (an IntegrityError, say)
+            # must do so before an event number is used up, or every
+            # other worker would see a gap and recover
+            session.flush()
+
+            notified = session.info["notified"] = []
+            for chunk in self._split(keys):
+                notified.append(self._next_seq())
+                self._notify(session, self._payload(notified[-1], chunk))
+                self.stats["published"] += 1
+
+    def _after_commit(self, session):
+        session.info.pop("notified", None)
+        keys = session.info.pop("invalidations", None)
+
+        if not keys:
+            return
+
+        self.apply(keys)
+
+        if self.transport == "socket":
+            self.broadcast(keys)
+
+    def _after_rollback(self, session):
+        session.info.pop("invalidations", None)
+        notified = session.info.pop("notified", None)
+
+        # The commit failed after its NOTIFYs were queued, which went
+        # with it: send empty events with those numbers, so there's no gap
+        if notified:
+            try:
+                with db.engine.connect() as connection:
+                    connection = connection.execution_options(
+                        isolation_level="AUTOCOMMIT")
+                    for seq in notified:
+                        self._notify(connection, self._payload(seq, ()))
+            except Exception:
+                logger.exception("filling invalidation events %s failed",
+                                 notified)
+
+    def broadcast(self, keys):
+        """Send `keys` to the other workers' sockets, now."""
+
+        payloads = [payload.encode("utf-8") for payload in self._events(keys)]
+
+        if self._send_socket is None:
+            self._send_socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self._send_socket.setblocking(False)
+
+        own = self._socket_path(self.publisher)
+
+        for name in os.listdir(self.socket_dir):
+            path = os.path.join(self.socket_dir, name)
+            if not name.endswith(".sock") or path == own:
+                continue
+
+            try:
+                for payload in payloads:
+                    self._send_socket.sendto(payload, path)
+            except BlockingIOError:
+                # Their buffer is full: they'll see the gap and recover
+                self.stats["dropped"] += 1
+            except (ConnectionRefusedError, FileNotFoundError):
+                # A worker that has exited
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+
+    # Listening
+
+    def ensure_listening(self):
+        """Start this process's listener thread if it isn't running.
+
+        Started lazily so each forked worker gets its own.
+        """
+
+        if self.transport is None:
+            return
+
+        self._check_process()
+
+        if self._thread is not None and self._thread.is_alive():
+            return
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+
+            listen = {"postgres": self._listen_postgres,
+                      "socket": self._listen_socket_dir}[self.transport]
+            self._thread = threading.Thread(target=listen,
+                                            name="invalidation-bus",
+                                            daemon=True)
+            self._thread.start()
+
+    def receive(self, payload):
+        """Apply an event from another process."""
+
+        try:
+            message = json.loads(payload)
+            publisher, seq, keys = message["p"], message["s"], message["k"]
+        except (ValueError, KeyError, TypeError):
+            self.stats["bad_events"] += 1
+            logger.warning("ignoring invalidation event %r", payload)
+            return
+
+        if publisher == self.publisher:
+            return
+
+        self.stats["received"] += 1
+
+        with self._lock:
+            sequence = self._sequences.get(publisher)
+            if sequence is None:
+                self._sequences[publisher] = _Sequence(seq)
+            else:
+                sequence.see(seq)
+
+        if keys is None:
+            self.recover()
+        else:
+            self.apply(keys)
+
+        self.check_gaps()
+
+    def check_gaps(self):
+        """Recover if any publisher's events have gone missing."""
+
+        now = time.monotonic()
+        missed = False
+
+        with self._lock:
+            for publisher, sequence in list(self._sequences.items()):
+                if (sequence.gap_since is not None
+                        and now - sequence.gap_since >= self.gap_grace):
+                    sequence.skip_gap()
+                    missed = True
+                elif now - sequence.seen_at > PUBLISHER_TTL_SECONDS:
+                    del self._sequences[publisher]
+
+        if missed:
+            self.stats["gaps"] += 1
+            self.recover()
+
+    def _listen_postgres(self):
+        reconnecting = False
+
+        while True:
+            connection = None
+            try:
+                with self.app.app_context():
+                    connection = db.engine.raw_connection()
+                # Ours alone, not the pool's
+                connection.detach()
+
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                with dbapi_connection.cursor() as cursor:
+                    cursor.execute(f"LISTEN {CHANNEL}")
+
+                # Whatever was sent while we weren't listening is lost
+                if reconnecting:
+                    self.recover()
+                reconnecting = True
+
+                while not self._closed:
+                    if select.select([dbapi_connection], [], [],
+                                     POLL_SECONDS)[0]:
+                        dbapi_connection.poll()
+                        while dbapi_connection.notifies:
+                            self.receive(dbapi_connection.notifies.pop(0).payload)
+                    self.check_gaps()
+
+                connection.close()
+                return
+
+            except Exception:
+                logger.exception("invalidation listener lost its connection")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(RECONNECT_SECONDS)
+
+    def _socket_path(self, publisher):
+        return os.path.join(self.socket_dir, f"{publisher}.sock")
+
+    def _listen_socket_dir(self):
+        path = self._socket_path(self.publisher)
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        sock.bind(path)
+        sock.settimeout(POLL_SECONDS)
+
+        try:
+            while not self._closed:
+                try:
+                    payload = sock.recv(MAX_PAYLOAD_BYTES + 100)
+                except socket.timeout:
+                    pass
+                else:
+                    self.receive(payload.decode("utf-8"))
+                self.check_gaps()
+        finally:
+            sock.close()
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        """Stop listening (the thread exits at its next wake-up)."""
+
+        self._closed = True
+
+
+invalidation_bus = InvalidationBus()
@@ -0,0 +1,248 @@
+"""Background jobs, stored in the `jobs` table and run by worker.py.
+
+Request handlers call enqueue() to record work that doesn't need to happen
+before the response is sent. The job row is added to the current session, so
+it's committed (or rolled back) together with whatever the request changed.
+
+Handlers are plain functions registered with @job_handler("name"); they're
+called with the job's args as keyword arguments, inside an app context.
+
+Done and failed jobs are kept for JOB_RETENTION_SECONDS (for their
+progress and errors), then deleted by the worker.
+"""
+
+import logging
+import os
+import socket
+import time
+import traceback
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+
+from sqlalchemy.exc import IntegrityError
+
+from models import db, Job
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_SECONDS = 1.0
+
+# Jobs left "running" this long are assumed to belong to a dead worker
+STALE_LOCK_SECONDS = 15 * 60
+
+# Retry n waits RETRY_BACKOFF_SECONDS * 2**(n-1) before running again
+RETRY_BACKOFF_SECONDS = 5
+
+# Done and failed jobs last run longer ago than this are deleted, every
+# PRUNE_INTERVAL_SECONDS, PRUNE_BATCH_SIZE per transaction
+JOB_RETENTION_SECONDS = 7 * 24 * 60 * 60
+PRUNE_INTERVAL_SECONDS = 60 * 60
+PRUNE_BATCH_SIZE = 1000
+
+PENDING = ("queued", "running")
+FINISHED = ("done", "failed")
+
+handlers = {}
+
+_current_job = ContextVar("current_job", default=None)
+
+
+def job_handler(name):
+    """Register the decorated function as the handler for jobs called `name`."""
+
+    def register(func):
+        handlers[name] = func
+        return func
+
+    return register
+
+
+def enqueue(name, args=None, priority=0, idempotency_key=None,
+            delay=0, max_attempts=5):
+    """Add a job to the session; it's queued when the caller commits.
+
+    If `idempotency_key` is given and a queued or running job has that
+    key, nothing new is added and that job is returned.
+    """
+
+    if idempotency_key is not None:
+        existing = _pending_with_key(idempotency_key).first()
+        if existing:
+            return existing
+
+    job = Job(
+        name=name,
+        args=args or {},
+        priority=priority,
+        idempotency_key=idempotency_key,
+        max_attempts=max_attempts,
+        run_at=datetime.utcnow() + timedelta(seconds=delay),
+    )
+
+    if idempotency_key is None:
+        db.session.add(job)
+        return job
+
+    # Another request may have used the key since we looked: only roll back
+    # our insert, not the rest of the caller's transaction.
+    try:
+        with db.session.begin_nested():
+            db.session.add(job)
+    except IntegrityError:
+        return _pending_with_key(idempotency_key).one()
+
+    return job
+
+
+def _pending_with_key(idempotency_key):
+    # (this is what ix_jobs_pending_idempotency_key covers)
+    return Job.query.filter(Job.idempotency_key == idempotency_key,
+                            Job.status.in_(PENDING))
+
+
+def report_progress(progress):
+    """Record progress (a JSON-able value) on the job currently running.
+
+    Does nothing when not called from inside a job.
+    """
+
+    job = _current_job.get()
+    if job is None:
+        return
+
+    job.progress = progress
+    db.session.commit()
+
+
+def _worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def _claim_next(worker_id):
+    """Mark the next job that's due as running, and return it (or None)."""
+
+    now = datetime.utcnow()
+
+    job = (Job.query
+           .filter(Job.status == "queued", Job.run_at <= now)
+           .order_by(Job.priority.desc(), Job.run_at, Job.id)
+           .with_for_update(skip_locked=True)
+           .first())
+
+    if job is None:
+        db.session.rollback()
+        return None
+
+    job.status = "running"
+    job.attempts += 1
+    job.locked_at = now
+    job.locked_by = worker_id
+    db.session.commit()
+
+    return job
+
+
+def _requeue_stale():
+    """Put jobs whose worker apparently died back in the queue."""
+
+    cutoff = datetime.utcnow() - timedelta(seconds=STALE_LOCK_SECONDS)
+
+    (Job.query
+     .filter(Job.status == "running", Job.locked_at < cutoff)
+     .update({"status": "queued", "locked_at": None, "locked_by": None},
+             synchronize_session=False))
+    db.session.commit()
+
+
+def delete_finished(retention_seconds=JOB_RETENTION_SECONDS,
+                    batch_size=PRUNE_BATCH_SIZE):
+    """Delete done and failed jobs last run over `retention_seconds` ago.
+
+    Returns the number deleted.
+    """
+
+    cutoff = datetime.utcnow() - timedelta(seconds=retention_seconds)
+    total = 0
+
+    while True:
+        ids = [job_id for job_id, in (db.session
+                                      .query(Job.id)
+                                      .filter(Job.status.in_(FINISHED),
+                                              Job.run_at < cutoff)
+                                      .limit(batch_size))]
+        if not ids:
+            return total
+
+        total += (Job.query
+                  .filter(Job.id.in_(ids))
+                  .delete(synchronize_session=False))
+        db.session.commit()
+
+
+def run_job(job):
+    """Run one claimed job, then mark it done, queued for retry, or failed."""
+
+    handler = handlers.get(job.name)
+    token = _current_job.set(job)
+
+    try:
+        if handler is None:
+            raise LookupError(f"no handler for job {job.name!r}")
+        handler(**job.args)
+
+    except Exception:
+        db.session.rollback()
+        logger.exception("job %s failed (attempt %s)", job.id, job.attempts)
+
+        job.last_error = traceback.format_exc()
+        job.locked_at = None
+        job.locked_by = None
+
+        if job.attempts < job.max_attempts:
+            job.status = "queued"
+            job.run_at = datetime.utcnow() + timedelta(
+                seconds=RETRY_BACKOFF_SECONDS * 2 ** (job.attempts - 1))
+        else:
+            job.status = "failed"
+
+    else:
+        job.status = "done"
+        job.locked_at = None
+
+    finally:
+        _current_job.reset(token)
+
+    db.session.commit()
+
+
+def run_worker(poll_interval=POLL_INTERVAL_SECONDS, burst=False):
+    """Run jobs until stopped.
+
+    Sleeps `poll_interval` seconds whenever the queue is empty. With
+    `burst`, returns as soon as there's nothing left to do instead.
+    Must be called inside an app context.
+    """
+
+    worker_id = _worker_id()
+    logger.info("job worker %s started", worker_id)
+
+    _requeue_stale()
+    pruned_at = None
+
+    while True:
+        job = _claim_next(worker_id)
+
+        if job is None:
+            if burst:
+                return
+            if (pruned_at is None
+                    or time.monotonic() - pruned_at >= PRUNE_INTERVAL_SECONDS):
+                deleted = delete_finished()
+                if deleted:
+                    logger.info("deleted %s finished jobs", deleted)
+                pruned_at = time.monotonic()
+            time.sleep(poll_interval)
+            _requeue_stale()
+            continue
+
+        run_job(job)
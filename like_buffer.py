@@ -0,0 +1,187 @@
+"""Write-behind buffer for likes.
+
+Normally every like/unlike is its own commit. With LIKES_WRITE_BEHIND set,
+like_or_unlike_message() only records the intent ("user U wants message M
+liked / not liked") in this process's buffer. A background thread flushes
+the buffer every FLUSH_INTERVAL_SECONDS, or as soon as it holds
+FLUSH_MAX_PENDING intents, as one multi-row INSERT, one multi-row DELETE and
+one commit. Repeated clicks on the same star before a flush coalesce to the
+last one.
+
+Intents are per worker process: reads in this process overlay them (see
+User.liked_ids_among), other workers see the like after the next flush, a
+few milliseconds later. Every worker flushes on its own, so a flush first
+locks the rows of the messages it touches: two workers flushing likes of
+the same message take turns, and each counts only the likes it changed.
+
+The buffer only writes to the main database, so it isn't used while
+messages are sharded (see shards.py).
+"""
+
+import atexit
+import logging
+import threading
+from collections import Counter
+
+from sqlalchemy import tuple_
+
+from models import db, insert_ignoring_duplicates, Like, Message
+
+logger = logging.getLogger(__name__)
+
+FLUSH_INTERVAL_SECONDS = 0.005
+FLUSH_MAX_PENDING = 500
+
+
+class LikeBuffer:
+    """Pending like/unlike intents, keyed by (user id, message id)."""
+
+    def __init__(self, flush_interval=FLUSH_INTERVAL_SECONDS,
+                 max_pending=FLUSH_MAX_PENDING):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.app = None
+
+        self._pending = {}
+        self._flushing = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+
+    def init_app(self, app):
+        """Flush in the background for `app`, and when the process exits."""
+
+        self.app = app
+        atexit.register(self._flush_at_exit)
+
+    def _ensure_flushing(self):
+        """Start the flush thread if this process doesn't have one yet.
+
+        Started lazily so a process forked after init_app (a preloaded
+        gunicorn worker) gets its own thread.
+        """
+
+        if self._thread is None or not self._thread.is_alive():
+            self._thread = threading.Thread(target=self._run,
+                                            name="like-buffer",
+                                            daemon=True)
+            self._thread.start()
+
+    def _flush_at_exit(self):
+        with self.app.app_context():
+            self.flush()
+
+    def record(self, user_id, message_id, liked):
+        """Record that `user_id` wants `message_id` liked (or not)."""
+
+        self._ensure_flushing()
+
+        with self._lock:
+            self._pending[(user_id, message_id)] = liked
+
+            if len(self._pending) >= self.max_pending:
+                self._wakeup.notify()
+
+    def pending_for(self, user_id):
+        """{message id: liked} for this user's intents not yet committed."""
+
+        with self._lock:
+            return {message_id: liked
+                    for (pending_user_id, message_id), liked
+                    in {**self._flushing, **self._pending}.items()
+                    if pending_user_id == user_id}
+
+    def _run(self):
+        while True:
+            with self._lock:
+                self._wakeup.wait(self.flush_interval)
+
+            try:
+                with self.app.app_context():
+                    self.flush()
+            except Exception:
+                logger.exception("flushing likes failed")
+
+    def flush(self):
+        """Write all pending intents in one transaction.
+
+        Must be called inside an app context. Returns the number of intents
+        written.
+        """
+
+        from trending import record_like
+
+        with self._lock:
+            if not self._pending:
+                return 0
+            self._flushing, self._pending = self._pending, {}
+            intents = dict(self._flushing)
+
+        message_ids = sorted({message_id for _, message_id in intents})
+
+        try:
+            # Until commit (in id order, so flushes can't deadlock)
+            (db.session
+             .query(Message.id)
+             .filter(Message.id.in_(message_ids))
+             .order_by(Message.id)
+             .with_for_update()
+             .all())
+
+            existing = {
+                (like.user_liking_id, like.liked_message_id)
+                for like in (db.session
+                             .query(Like.user_liking_id, Like.liked_message_id)
+                             .filter(tuple_(Like.user_liking_id,
+                                            Like.liked_message_id)
+                                     .in_(list(intents)))
+                             .all())}
+
+            # Skip likes of messages deleted since the click
+            live_ids = {
+                row.id for row in (Message.visible()
+                                   .with_entities(Message.id)
+                                   .filter(Message.id.in_(message_ids))
+                                   .all())}
+
+            to_like = [key for key, liked in intents.items()
+                       if liked and key not in existing and key[1] in live_ids]
+            to_unlike = [key for key, liked in intents.items()
+                         if not liked and key in existing]
+
+            if to_like:
+                insert_ignoring_duplicates(Like, [
+                    {"user_liking_id": user_id, "liked_message_id": message_id}
+                    for user_id, message_id in to_like])
+
+            if to_unlike:
+                (Like.query
+                 .filter(tuple_(Like.user_liking_id, Like.liked_message_id)
+                         .in_(to_unlike))
+                 .delete(synchronize_session=False))
+
+            deltas = Counter(message_id for _, message_id in to_like)
+            deltas.subtract(message_id for _, message_id in to_unlike)
+            Message.count_likes(deltas)
+            for message_id, delta in deltas.items():
+                if delta:
+                    record_like(message_id, delta)
+
+            db.session.commit()
+
+        except Exception:
+            db.session.rollback()
+
+            # Put the intents back, unless newer ones arrived meanwhile
+            with self._lock:
+                self._pending = {**self._flushing, **self._pending}
+            raise
+
+        finally:
+            with self._lock:
+                self._flushing = {}
+
+        return len(intents)
+
+
+like_buffer = LikeBuffer()
@@ -0,0 +1,139 @@
+"""Admission control for when the database is struggling.
+
+db_health keeps a moving average of how long queries take and how long
+requests wait for a pooled connection, in this worker. When either goes
+over its limit the worker is *degraded* until both are back under half of
+it. While degraded:
+
+- views marked @low_priority (user search, followers/following lists)
+  are let through LOW_PRIORITY_CONCURRENCY at a time per worker; others
+  wait up to QUEUE_SECONDS for a turn, then get a 503 with Retry-After;
+- feed and profile pages serve their single-flight snapshots for up to
+  DEGRADED_STALE_SECONDS (see app.py), with a banner saying they may be
+  behind, instead of waiting on fresh feed queries.
+"""
+
+import threading
+import time
+from collections import Counter
+
+from flask import g
+from sqlalchemy import event
+
+from models import db
+
+DEGRADED_QUERY_MS = 250
+DEGRADED_POOL_WAIT_MS = 100
+
+# Weight of each new sample in the moving averages
+SMOOTHING = 0.2
+
+LOW_PRIORITY_CONCURRENCY = 1
+QUEUE_SECONDS = 0.25
+RETRY_AFTER_SECONDS = 10
+
+# How old a snapshot degraded pages will serve
+DEGRADED_STALE_SECONDS = 15 * 60
+
+
+class DatabaseHealth:
+    """Query latency and pool waits for this worker, and what to shed."""
+
+    def __init__(self):
+        self.query_ms = 0.0
+        self.pool_wait_ms = 0.0
+        self.degraded = False
+        self.stats = Counter()
+
+        self._low_priority = threading.BoundedSemaphore(
+            LOW_PRIORITY_CONCURRENCY)
+
+    def init_app(self, app):
+        """Time every query on the app's engine."""
+
+        with app.app_context():
+            engine = db.engine
+
+        event.listen(engine, "before_cursor_execute", _before_execute)
+        event.listen(engine, "after_cursor_execute", self._after_execute)
+
+    def _after_execute(self, conn, cursor, statement, parameters, context,
+                       executemany):
+        started = conn.info.pop("query_started", None)
+        if started is not None:
+            self.record_query((time.monotonic() - started) * 1000)
+
+    def record_query(self, ms):
+        self.query_ms += SMOOTHING * (ms - self.query_ms)
+        self._update()
+
+    def record_pool_wait(self, ms):
+        self.pool_wait_ms += SMOOTHING * (ms - self.pool_wait_ms)
+        self._update()
+
+    def _update(self):
+        if self.degraded:
+            self.degraded = (self.query_ms > DEGRADED_QUERY_MS / 2
+                             or self.pool_wait_ms > DEGRADED_POOL_WAIT_MS / 2)
+        else:
+            self.degraded = (self.query_ms > DEGRADED_QUERY_MS
+                             or self.pool_wait_ms > DEGRADED_POOL_WAIT_MS)
+
+    def check_out_connection(self):
+        """Get this request's pooled connection now, timing the wait."""
+
+        start = time.monotonic()
+        db.session.connection()
+        self.record_pool_wait((time.monotonic() - start) * 1000)
+
+    def admit_low_priority(self):
+        """Whether a low-priority request may go ahead now.
+
+        If it returns True, call release_low_priority() when it's done.
+        """
+
+        if not self.degraded:
+            return True
+
+        if self._low_priority.acquire(timeout=QUEUE_SECONDS):
+            g.low_priority_admitted = True
+            self.stats["queued"] += 1
+            return True
+
+        self.stats["shed"] += 1
+        return False
+
+    def release_low_priority(self):
+        if g.pop("low_priority_admitted", False):
+            self._low_priority.release()
+
+    def reset(self):
+        """Forget all samples and stats."""
+
+        self.query_ms = self.pool_wait_ms = 0.0
+        self.degraded = False
+        self.stats.clear()
+
+    def snapshot(self):
+        """Current numbers, for /metrics."""
+
+        return {
+            "degraded": self.degraded,
+            "query_ms": round(self.query_ms, 1),
+            "pool_wait_ms": round(self.pool_wait_ms, 1),
+            **self.stats,
+        }
+
+
+def _before_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info["query_started"] = time.monotonic()
+
+
+def low_priority(view):
+    """Mark a view as first to be shed when the database is struggling."""
+
+    view.low_priority = True
+    return view
+
+
+db_health = DatabaseHealth()
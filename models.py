@@ -2,13 +2,18 @@
 
 from datetime import datetime
 
+from flask import abort
 from flask_bcrypt import Bcrypt
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.dialects import postgresql, sqlite
 from sqlalchemy.orm import backref
 
 bcrypt = Bcrypt()
 db = SQLAlchemy()
 
+# How many user cards to show per page on the followers/following pages
+FOLLOWS_PAGE_SIZE = 48
+
 
 class Like(db.Model):
     """Connection of a user <-> liked_messages."""
@@ -27,6 +32,109 @@ class Like(db.Model):
         primary_key=True,
     )
 
+    __table_args__ = (
+        # A message's likers, for the "liked by" preview
+        db.Index('ix_likes_liked_message_id',
+                 'liked_message_id', 'user_liking_id'),
+    )
+
+class LikeBucket(db.Model):
+    """Net likes a message got during one time bucket (see trending.py)."""
+
+    __tablename__ = 'like_buckets'
+
+    liked_message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    bucket_start = db.Column(
+        db.DateTime,
+        primary_key=True,
+        index=True,
+    )
+
+    likes = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+
+class TrendingMessage(db.Model):
+    """A message in the current precomputed trending list."""
+
+    __tablename__ = 'trending_messages'
+
+    message_id = db.Column(
+        db.Integer,
+        db.ForeignKey('messages.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
+class MessageTag(db.Model):
+    """A hashtag used in a message (see tags.py).
+
+    No foreign key to messages: the message may be on a shard, or in a
+    partitioned table.
+    """
+
+    __tablename__ = 'message_tags'
+
+    tag = db.Column(
+        db.Text,
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    # The message's author, to find its shard
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+
+class Mention(db.Model):
+    """A user mentioned in a message (see tags.py)."""
+
+    __tablename__ = 'mentions'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    message_id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    author_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        nullable=False,
+    )
+
+
 class Follows(db.Model):
     """Connection of a follower <-> followed_user."""
 
@@ -45,6 +153,35 @@ class Follows(db.Model):
     )
 
 
+class Recommendation(db.Model):
+    """A precomputed "who to follow" suggestion for a user."""
+
+    __tablename__ = 'recommendations'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    recommended_user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    score = db.Column(
+        db.Float,
+        nullable=False,
+    )
+
+    computed_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+
 class User(db.Model):
     """User in the system."""
 
@@ -90,6 +227,24 @@ class User(db.Model):
         nullable=False,
     )
 
+    # Tombstone: set when the account is deleted. The row (and everything
+    # hanging off it) is removed later by a background purge.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Tombstone for "delete all my messages": messages at or before this
+    # time are hidden, and purged later in the background.
+    messages_deleted_before = db.Column(
+        db.DateTime,
+    )
+
+    # Set when this user follows/unfollows someone, cleared once their
+    # recommendations have been recomputed (see recommendations.py).
+    follows_changed_at = db.Column(
+        db.DateTime,
+    )
+
     messages = db.relationship('Message', order_by='Message.timestamp.desc()')
 
     followers = db.relationship(
@@ -118,24 +273,186 @@ class User(db.Model):
     def is_followed_by(self, other_user):
         """Is this user followed by `other_user`?"""
 
-        found_user_list = [user for user in self.followers if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.is_following(self)
 
     def is_following(self, other_user):
         """Is this user following `other_use`?"""
 
-        found_user_list = [user for user in self.following if user == other_user]
-        return len(found_user_list) == 1
+        return other_user.id in self.following_ids_among([other_user.id])
+
+    def following_ids_among(self, user_ids):
+        """Return the set of `user_ids` this user is following.
+
+        Resolves the follow state for a whole page of users in one query,
+        instead of scanning self.following once per user.
+        """
+
+        user_ids = list(user_ids)
+        if not user_ids:
+            return set()
+
+        rows = (db.session
+                .query(Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        Follows.user_being_followed_id.in_(user_ids))
+                .all())
+
+        return {row.user_being_followed_id for row in rows}
+
+    def followers_page(self, after_id=None, limit=FOLLOWS_PAGE_SIZE):
+        """Page of user cards for the users following this user.
+
+        Keyset paginated on user id: pass the last id of the previous page
+        as `after_id`. Returns (cards, next_after_id); next_after_id is None
+        on the last page.
+        """
+
+        query = (User.card_query()
+                 .join(Follows, Follows.user_following_id == User.id)
+                 .filter(Follows.user_being_followed_id == self.id))
+
+        return User._card_page(query, after_id, limit)
+
+    def following_page(self, after_id=None, limit=FOLLOWS_PAGE_SIZE):
+        """Page of user cards for the users this user is following.
+
+        See followers_page for the paging arguments.
+        """
+
+        query = (User.card_query()
+                 .join(Follows, Follows.user_being_followed_id == User.id)
+                 .filter(Follows.user_following_id == self.id))
+
+        return User._card_page(query, after_id, limit)
+
+    def visible_messages(self):
+        """Query for this user's messages that haven't been deleted."""
+
+        return (Message.visible()
+                .filter(Message.user_id == self.id)
+                .order_by(Message.timestamp.desc()))
+
+    def visible_liked_messages(self):
+        """Query for messages liked by this user that haven't been deleted.
+
+        Includes likes and unlikes still waiting in the like buffer.
+        """
+
+        pending = self._pending_likes()
+
+        liked_ids = (db.session
+                     .query(Like.liked_message_id)
+                     .filter(Like.user_liking_id == self.id))
+        newly_liked = [message_id for message_id, liked in pending.items()
+                       if liked]
+        unliked = [message_id for message_id, liked in pending.items()
+                   if not liked]
+
+        return (Message.visible()
+                .filter(db.or_(Message.id.in_(liked_ids),
+                               Message.id.in_(newly_liked)),
+                        Message.id.notin_(unliked))
+                .order_by(Message.timestamp.desc()))
+
+    def recommended_users(self, limit=5):
+        """User cards for the best "who to follow" suggestions for this user.
+
+        Skips anyone already followed since the suggestions were computed.
+        """
+
+        already_followed = (db.session
+                            .query(Follows.user_being_followed_id)
+                            .filter(Follows.user_following_id == self.id))
+
+        return (User.card_query()
+                .join(Recommendation,
+                      Recommendation.recommended_user_id == User.id)
+                .filter(Recommendation.user_id == self.id,
+                        User.deleted_at.is_(None),
+                        User.id.notin_(already_followed))
+                .order_by(Recommendation.score.desc())
+                .limit(limit)
+                .all())
+
+    @property
+    def num_messages(self):
+        """Number of messages written by this user."""
+
+        from shards import shards
+
+        if shards.enabled:
+            return shards.count_messages([self.id])[self.id]
+
+        return Message.visible().filter(Message.user_id == self.id).count()
+
+    @property
+    def num_followers(self):
+        """Number of users following this user."""
+
+        return (Follows.query
+                .join(User, User.id == Follows.user_following_id)
+                .filter(Follows.user_being_followed_id == self.id,
+                        User.deleted_at.is_(None))
+                .count())
+
+    @property
+    def num_following(self):
+        """Number of users this user is following."""
+
+        return (Follows.query
+                .join(User, User.id == Follows.user_being_followed_id)
+                .filter(Follows.user_following_id == self.id,
+                        User.deleted_at.is_(None))
+                .count())
+
+    @property
+    def num_likes(self):
+        """Number of messages this user has liked."""
+
+        committed = (Message.visible()
+                     .join(Like, Like.liked_message_id == Message.id)
+                     .filter(Like.user_liking_id == self.id)
+                     .count())
+
+        pending = self._pending_likes()
+        committed_liked = self._committed_liked_ids(pending)
+
+        return committed + sum(
+            (liked and message_id not in committed_liked)
+            - (not liked and message_id in committed_liked)
+            for message_id, liked in pending.items())
 
     def like_or_unlike_message(self, message_id):
-        """Like or unlike a message """
+        """Like or unlike a message
+
+        With LIKES_WRITE_BEHIND, the change is only recorded in the like
+        buffer here, and committed by its next flush. The buffer only
+        writes to main, so while sharding it's not used: the like is
+        committed on the message's shard straight away.
+        """
+
+        from shards import shards
+        from trending import record_like
+
+        if shards.enabled:
+            if shards.toggle_like(self.id, message_id) is None:
+                abort(404)
+            db.session.commit()
+            return
 
-        message = Message.query.get_or_404(message_id)
+        message = Message.visible().filter(Message.id == message_id).first_or_404()
 
         if message.user.id != self.id:
-            is_liked_by_user = Like.query.filter(
-                Like.liked_message_id == message_id and
-                Like.user_liking_id == self.id).one_or_none()
+            if db.get_app().config.get('LIKES_WRITE_BEHIND'):
+                from like_buffer import like_buffer
+
+                is_liked = message_id in self.liked_ids_among([message_id])
+                like_buffer.record(self.id, message_id, not is_liked)
+                return
+
+            is_liked_by_user = Like.query.get((self.id, message_id))
+
+            delta = -1 if is_liked_by_user else 1
 
             if is_liked_by_user:
                 db.session.delete(is_liked_by_user)
@@ -145,8 +462,99 @@ class User(db.Model):
                     liked_message_id=message_id)
                 db.session.add(like)
 
+            Message.count_likes({message_id: delta})
+            record_like(message_id, delta)
+
             db.session.commit()
 
+    def _pending_likes(self):
+        """{message id: liked} for this user's buffered, uncommitted likes."""
+
+        if not db.get_app().config.get('LIKES_WRITE_BEHIND'):
+            return {}
+
+        from like_buffer import like_buffer
+
+        return like_buffer.pending_for(self.id)
+
+    def _committed_liked_ids(self, message_ids):
+        """The `message_ids` this user has liked, as committed in the db."""
+
+        from shards import shards
+
+        message_ids = list(message_ids)
+        if not message_ids:
+            return set()
+
+        if shards.enabled:
+            return shards.liked_ids_among(self.id, message_ids)
+
+        return {row.liked_message_id for row in (
+            db.session
+            .query(Like.liked_message_id)
+            .filter(Like.user_liking_id == self.id,
+                    Like.liked_message_id.in_(message_ids))
+            .all())}
+
+    def liked_ids_among(self, message_ids):
+        """Return the set of `message_ids` this user has liked.
+
+        One query for a whole page of messages; includes likes and unlikes
+        still waiting in the like buffer.
+        """
+
+        message_ids = list(message_ids)
+        liked_ids = self._committed_liked_ids(message_ids)
+
+        for message_id, liked in self._pending_likes().items():
+            if message_id in message_ids:
+                if liked:
+                    liked_ids.add(message_id)
+                else:
+                    liked_ids.discard(message_id)
+
+        return liked_ids
+
+    @classmethod
+    def card_query(cls):
+        """Query for just the columns a user card renders.
+
+        Rows are plain named tuples, not tracked User instances.
+        """
+
+        return db.session.query(
+            cls.id,
+            cls.username,
+            cls.image_url,
+            cls.header_image_url,
+            cls.bio,
+        )
+
+    @classmethod
+    def _card_page(cls, query, after_id, limit):
+        """Apply keyset pagination on user id to a card query."""
+
+        query = query.filter(cls.deleted_at.is_(None))
+
+        if after_id is not None:
+            query = query.filter(cls.id > after_id)
+
+        cards = query.order_by(cls.id).limit(limit + 1).all()
+
+        if len(cards) > limit:
+            cards = cards[:limit]
+            return cards, cards[-1].id
+
+        return cards, None
+
+    @classmethod
+    def get_active_or_404(cls, user_id):
+        """Get a user who hasn't been deleted, or abort with a 404."""
+
+        return (cls.query
+                .filter(cls.id == user_id, cls.deleted_at.is_(None))
+                .first_or_404())
+
     @classmethod
     def signup(cls, username, email, password, image_url):
         """Sign up user.
@@ -177,7 +585,7 @@ class User(db.Model):
         If can't find matching user (or if password is wrong), returns False.
         """
 
-        user = cls.query.filter_by(username=username).first()
+        user = cls.query.filter_by(username=username, deleted_at=None).first()
 
         if user:
             is_auth = bcrypt.check_password_hash(user.password, password)
@@ -215,8 +623,225 @@ class Message(db.Model):
         nullable=False,
     )
 
+    # Tombstone: set when the message is deleted; purged in the background.
+    deleted_at = db.Column(
+        db.DateTime,
+    )
+
+    # Number of likes, kept up to date with every like and unlike (see
+    # count_likes) so showing it never counts the likes table
+    like_count = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+        server_default='0',
+    )
+
     user = db.relationship('User')
 
+    @classmethod
+    def visible(cls):
+        """Query for messages that haven't been deleted.
+
+        Hides tombstoned messages, messages cleared by a bulk delete, and
+        messages by tombstoned users.
+        """
+
+        return (cls.query
+                .join(cls.user)
+                .filter(cls.deleted_at.is_(None),
+                        User.deleted_at.is_(None),
+                        db.or_(User.messages_deleted_before.is_(None),
+                               cls.timestamp > User.messages_deleted_before)))
+
+    @classmethod
+    def count_likes(cls, deltas, session=None):
+        """Add {message id: likes gained (or lost)} to the like counts.
+
+        Done in `session` (default db.session), so it's committed along
+        with the likes themselves.
+        """
+
+        session = session or db.session
+
+        for message_id, delta in deltas.items():
+            if delta:
+                (session
+                 .query(cls)
+                 .filter(cls.id == message_id)
+                 .update({"like_count": cls.like_count + delta},
+                         synchronize_session=False))
+
+    @classmethod
+    def recount_likes(cls, session=None, batch_size=1000):
+        """Set every like count from the likes table, a batch at a time.
+
+        For filling in like_count on an existing database, or repairing it.
+        Returns the number of messages recounted.
+        """
+
+        session = session or db.session
+        counted = (db.select(db.func.count())
+                   .where(Like.liked_message_id == cls.id)
+                   .scalar_subquery())
+        after_id = 0
+        total = 0
+
+        while True:
+            ids = [message_id for message_id, in (session
+                                                  .query(cls.id)
+                                                  .filter(cls.id > after_id)
+                                                  .order_by(cls.id)
+                                                  .limit(batch_size))]
+            if not ids:
+                return total
+
+            (session
+             .query(cls)
+             .filter(cls.id.in_(ids))
+             .update({"like_count": counted}, synchronize_session=False))
+            session.commit()
+
+            total += len(ids)
+            after_id = ids[-1]
+
+
+class UserShard(db.Model):
+    """Directory entry: which shard holds a user's messages (see shards.py).
+
+    Users with no entry are on the main database.
+    """
+
+    __tablename__ = 'user_shards'
+
+    user_id = db.Column(
+        db.Integer,
+        db.ForeignKey('users.id', ondelete="cascade"),
+        primary_key=True,
+    )
+
+    shard = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    # Set while the user's messages are being copied to another shard;
+    # their writes wait until it's done
+    moving_since = db.Column(
+        db.DateTime,
+    )
+
+    # The shard they were moved from, until the copies left there are
+    # deleted
+    moved_from = db.Column(
+        db.Text,
+    )
+
+
+class MessageId(db.Model):
+    """Message ids handed out for sharded writes, on databases without
+    sequences (see shards.py)."""
+
+    __tablename__ = 'message_ids'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+
+class Job(db.Model):
+    """A unit of deferred work, run by the worker process (see jobs.py)."""
+
+    __tablename__ = 'jobs'
+
+    id = db.Column(
+        db.Integer,
+        primary_key=True,
+    )
+
+    name = db.Column(
+        db.Text,
+        nullable=False,
+    )
+
+    args = db.Column(
+        db.JSON,
+        nullable=False,
+        default=dict,
+    )
+
+    # Higher priority jobs are run first
+    priority = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    # queued -> running -> done, or back to queued for a retry, or failed
+    status = db.Column(
+        db.Text,
+        nullable=False,
+        default="queued",
+    )
+
+    attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=0,
+    )
+
+    max_attempts = db.Column(
+        db.Integer,
+        nullable=False,
+        default=5,
+    )
+
+    # Enqueueing a job with the key of a queued or running job is a no-op
+    idempotency_key = db.Column(
+        db.Text,
+    )
+
+    run_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    locked_at = db.Column(
+        db.DateTime,
+    )
+
+    locked_by = db.Column(
+        db.Text,
+    )
+
+    progress = db.Column(
+        db.JSON,
+    )
+
+    last_error = db.Column(
+        db.Text,
+    )
+
+    created_at = db.Column(
+        db.DateTime,
+        nullable=False,
+        default=datetime.utcnow,
+    )
+
+    __table_args__ = (
+        db.Index('ix_jobs_ready', 'status', 'priority', 'run_at'),
+        # Finished jobs are left out, so it stays the size of the queue
+        db.Index('ix_jobs_pending_idempotency_key', 'idempotency_key',
+                 unique=True,
+                 postgresql_where=db.text("status IN ('queued', 'running')"),
+                 sqlite_where=db.text("status IN ('queued', 'running')")),
+    )
+
+    def __repr__(self):
+        return f"<Job #{self.id}: {self.name} {self.status}>"
+
 
 def connect_db(app):
     """Connect this database to provided Flask app.
@@ -228,4 +853,12 @@ def connect_db(app):
     db.init_app(app)
 
 
+def insert_ignoring_duplicates(model, rows):
+    """Multi-row INSERT of `rows` into `model`'s table, skipping any whose
+    primary key is already there."""
+
+    dialect = db.engine.dialect.name
+    insert = {"postgresql": postgresql.insert, "sqlite": sqlite.insert}[dialect]
 
+    db.session.execute(
+        insert(model.__table__).values(rows).on_conflict_do_nothing())
@@ -0,0 +1,437 @@
+"""Monthly partitions of the messages table, and a cold archive.
+
+Nearly every read is of the last few weeks of messages, but the messages
+table keeps everything. On Postgres, `flask partition-messages` turns it
+into a table partitioned by month on `timestamp` (one-off and run in a
+single transaction). Each month is then its own table with its own
+indexes. A timeline query (newest first, LIMIT 100) reads the partitions
+newest first and stops once it has enough rows, so older months are
+never touched; scanned_partitions() checks this with EXPLAIN ANALYZE
+(`flask check-partition-pruning`).
+
+`flask maintain-messages` (run it daily) does two things:
+
+- it creates the partitions for the next PARTITION_MONTHS_AHEAD months,
+  so inserts always have one to go to;
+- it archives every whole month older than MESSAGE_RETENTION_DAYS to a
+  gzipped JSONL file in MESSAGE_ARCHIVE_DIR, one message per line with
+  its like count, then drops the month's partition (or deletes its rows
+  on an unpartitioned table, such as SQLite in development).
+
+Each archive file has a small sidecar listing the users in it, so
+reading a user's archive only opens the months they posted in. Profiles
+link to /users/<id>/archive, the slow path that pages through those
+files.
+
+A partitioned table's primary key has to include the partition key, so
+the other tables' foreign keys to messages.id are dropped. Likes,
+trending rows and tags of deleted messages are removed by purge.py and
+by archiving instead of by cascade. Sharded messages (see shards.py) are
+neither partitioned nor archived.
+"""
+
+import glob
+import gzip
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from functools import lru_cache
+
+from sqlalchemy import func, select, text
+
+from invalidation_bus import invalidation_bus
+from models import (
+    db, Like, LikeBucket, Mention, Message, MessageTag, TrendingMessage)
+from purge import PURGE_BATCH_SIZE, _delete_in_batches
+
+logger = logging.getLogger(__name__)
+
+PARTITION_MONTHS_AHEAD = 2
+
+MESSAGE_RETENTION_DAYS = 365
+
+# Archived messages per page of /users/<id>/archive
+ARCHIVE_PAGE_SIZE = 50
+
+_PARTITION_NAME = re.compile(r"^messages_y(\d{4})m(\d{2})$")
+
+
+def month_start(when):
+    return datetime(when.year, when.month, 1)
+
+
+def next_month(start):
+    return datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
+
+
+def partition_name(start):
+    return f"messages_y{start:%Y}m{start:%m}"
+
+
+# Partitioning (Postgres only)
+
+
+def is_partitioned():
+    """Is the messages table partitioned?"""
+
+    if db.engine.dialect.name != "postgresql":
+        return False
+
+    return db.session.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table "
+        "WHERE partrelid = to_regclass('messages'))")).scalar()
+
+
+def partitions():
+    """Start of the month of each partition, oldest first."""
+
+    if not is_partitioned():
+        return []
+
+    names = db.session.execute(text(
+        "SELECT c.relname FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'messages'::regclass")).scalars()
+
+    return sorted(datetime(int(match[1]), int(match[2]), 1)
+                  for match in map(_PARTITION_NAME.match, names) if match)
+
+
+def ensure_partitions(now=None, months_ahead=PARTITION_MONTHS_AHEAD,
+                      since=None):
+    """Create any missing partitions from `since` (default: this month)
+    to `months_ahead` months from now. Returns the months covered."""
+
+    if not is_partitioned():
+        return []
+
+    months = _create_partitions(now, months_ahead, since)
+    db.session.commit()
+    return months
+
+
+def _create_partitions(now, months_ahead, since):
+    now = now or datetime.utcnow()
+    start = month_start(since or now)
+    last = month_start(now)
+    for _ in range(months_ahead):
+        last = next_month(last)
+
+    months = []
+    while start <= last:
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {partition_name(start)} "
+            f"PARTITION OF messages FOR VALUES "
+            f"FROM ('{start:%Y-%m-%d}') TO ('{next_month(start):%Y-%m-%d}')"))
+        months.append(start)
+        start = next_month(start)
+
+    return months
+
+
+def partition_messages():
+    """Convert the messages table to monthly partitions, in one transaction.
+
+    Returns False if it already is partitioned.
+    """
+
+    if db.engine.dialect.name != "postgresql":
+        raise RuntimeError("Partitioning messages needs PostgreSQL")
+
+    if is_partitioned():
+        return False
+
+    oldest = db.session.query(func.min(Message.timestamp)).scalar()
+
+    foreign_keys = db.session.execute(text(
+        "SELECT conrelid::regclass::text, conname FROM pg_constraint "
+        "WHERE contype = 'f' AND confrelid = 'messages'::regclass")).all()
+    for table, constraint in foreign_keys:
+        db.session.execute(text(
+            f'ALTER TABLE {table} DROP CONSTRAINT "{constraint}"'))
+
+    sequence = db.session.execute(text(
+        "SELECT pg_get_serial_sequence('messages', 'id')")).scalar()
+
+    for statement in (
+            "ALTER TABLE messages RENAME TO messages_unpartitioned",
+            "ALTER TABLE messages_unpartitioned "
+            "RENAME CONSTRAINT messages_pkey TO messages_unpartitioned_pkey",
+            "CREATE TABLE messages "
+            "(LIKE messages_unpartitioned INCLUDING DEFAULTS) "
+            "PARTITION BY RANGE (timestamp)",
+            f"ALTER SEQUENCE {sequence} OWNED BY messages.id",
+            "ALTER TABLE messages ADD PRIMARY KEY (id, timestamp)",
+            "ALTER TABLE messages ADD FOREIGN KEY (user_id) "
+            "REFERENCES users (id) ON DELETE CASCADE",
+            "CREATE INDEX ix_messages_user_id_timestamp "
+            "ON messages (user_id, timestamp)",
+            "CREATE INDEX ix_messages_timestamp ON messages (timestamp)"):
+        db.session.execute(text(statement))
+
+    _create_partitions(None, PARTITION_MONTHS_AHEAD, oldest)
+
+    db.session.execute(text(
+        "INSERT INTO messages SELECT * FROM messages_unpartitioned"))
+    db.session.execute(text("DROP TABLE messages_unpartitioned"))
+    db.session.commit()
+
+    return True
+
+
+def scanned_partitions(query):
+    """Names of the partitions `query` actually reads, per EXPLAIN ANALYZE.
+
+    Partitions the plan includes but never runs (skipped once a LIMIT is
+    satisfied, or pruned) aren't counted.
+    """
+
+    compiled = query.statement.compile(dialect=db.engine.dialect)
+    [[plan]] = db.session.connection().exec_driver_sql(
+        f"EXPLAIN (ANALYZE, FORMAT JSON) {compiled}", compiled.params).one()
+
+    scanned = set()
+
+    def walk(node):
+        relation = node.get("Relation Name", "")
+        if _PARTITION_NAME.match(relation) and node.get("Actual Loops"):
+            scanned.add(relation)
+        for child in node.get("Plans", ()):
+            walk(child)
+
+    walk(plan["Plan"])
+    return scanned
+
+
+# Archiving
+
+
+def archive_path(archive_dir, start):
+    return os.path.join(archive_dir, f"messages-{start:%Y-%m}.jsonl.gz")
+
+
+def _users_path(path):
+    return path[:-len(".jsonl.gz")] + ".users.json"
+
+
+def retention_horizon(retention_days=MESSAGE_RETENTION_DAYS, now=None):
+    """Start of the oldest month kept in the messages table."""
+
+    return month_start((now or datetime.utcnow())
+                       - timedelta(days=retention_days))
+
+
+def archive_messages(archive_dir, retention_days=MESSAGE_RETENTION_DAYS,
+                     now=None):
+    """Archive every whole month older than `retention_days`.
+
+    Returns the number of messages archived.
+    """
+
+    horizon = retention_horizon(retention_days, now)
+
+    if is_partitioned():
+        months = [start for start in partitions() if start < horizon]
+    else:
+        months = []
+        oldest = (db.session
+                  .query(func.min(Message.timestamp))
+                  .filter(Message.timestamp < horizon)
+                  .scalar())
+        start = oldest and month_start(oldest)
+        while start and start < horizon:
+            months.append(start)
+            start = next_month(start)
+
+    return sum(archive_month(archive_dir, start) for start in months)
+
+
+def archive_month(archive_dir, start):
+    """Move one month of messages to the archive. Returns how many."""
+
+    end = next_month(start)
+    in_month = (Message.timestamp >= start, Message.timestamp < end)
+
+    rows = [{"id": message_id,
+             "text": message_text,
+             "timestamp": timestamp.isoformat(),
+             "user_id": user_id,
+             "likes": likes}
+            for message_id, message_text, timestamp, user_id, likes in (
+                Message.visible()
+                .outerjoin(Like, Like.liked_message_id == Message.id)
+                .with_entities(Message.id, Message.text, Message.timestamp,
+                               Message.user_id, func.count(Like.user_liking_id))
+                .filter(*in_month)
+                .group_by(Message.id, Message.text, Message.timestamp,
+                          Message.user_id))]
+
+    os.makedirs(archive_dir, exist_ok=True)
+    _write_archive(archive_path(archive_dir, start), rows)
+
+    message_ids = select(Message.id).where(*in_month)
+    for column in (Like.liked_message_id, LikeBucket.liked_message_id,
+                   TrendingMessage.message_id, MessageTag.message_id,
+                   Mention.message_id):
+        (column.class_.query
+         .filter(column.in_(message_ids))
+         .delete(synchronize_session=False))
+
+    if is_partitioned():
+        name = partition_name(start)
+        db.session.execute(text(f"ALTER TABLE messages DETACH PARTITION {name}"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+    else:
+        db.session.commit()
+        _delete_in_batches(Message.id, in_month, PURGE_BATCH_SIZE, 0,
+                           lambda removed: None)
+
+    # Cached profiles would still show (and link to) them
+    invalidation_bus.publish(*{f"user:{row['user_id']}" for row in rows})
+    db.session.commit()
+
+    logger.info("archived %s messages from %s", len(rows), f"{start:%Y-%m}")
+    return len(rows)
+
+
+def _read_archive(path):
+    with gzip.open(path, "rt", encoding="utf-8") as f:
+        for line in f:
+            yield json.loads(line)
+
+
+def _write_archive(path, rows, keep=True):
+    """Write `rows` to `path`, keeping any rows already there (unless
+    `keep` is false).
+
+    Archiving a month again after an interruption adds what's left.
+    """
+
+    by_id = {}
+    if keep and os.path.exists(path):
+        by_id = {row["id"]: row for row in _read_archive(path)}
+    by_id.update((row["id"], row) for row in rows)
+
+    tmp_path = f"{path}.tmp"
+    with gzip.open(tmp_path, "wt", encoding="utf-8") as f:
+        for message_id in sorted(by_id):
+            f.write(json.dumps(by_id[message_id], separators=(",", ":")))
+            f.write("\n")
+
+    users_path = _users_path(path)
+    with open(f"{users_path}.tmp", "w") as f:
+        json.dump(sorted({row["user_id"] for row in by_id.values()}), f)
+
+    os.replace(tmp_path, path)
+    os.replace(f"{users_path}.tmp", users_path)
+
+
+@lru_cache(maxsize=256)
+def _archived_users(users_path, mtime):
+    with open(users_path) as f:
+        return frozenset(json.load(f))
+
+
+def _months_with(archive_dir, user_id):
+    """Archive files that have messages by `user_id`, newest first."""
+
+    paths = sorted(glob.glob(os.path.join(archive_dir, "messages-*.jsonl.gz")),
+                   reverse=True)
+
+    for path in paths:
+        users_path = _users_path(path)
+        try:
+            users = _archived_users(users_path, os.path.getmtime(users_path))
+        except FileNotFoundError:
+            users = None
+
+        if users is None or user_id in users:
+            yield path
+
+
+def has_archived(archive_dir, user_id):
+    """Does `user_id` have any archived messages?
+
+    Asked on every short profile page, so the answer is cached until a
+    month is (re)written, which changes the archive directory's mtime.
+    """
+
+    try:
+        mtime = os.stat(archive_dir).st_mtime_ns
+    except FileNotFoundError:
+        return False
+
+    return _has_archived(archive_dir, mtime, user_id)
+
+
+@lru_cache(maxsize=4096)
+def _has_archived(archive_dir, mtime, user_id):
+    return next(_months_with(archive_dir, user_id), None) is not None
+
+
+def drop_archived(archive_dir, user_id, before=None):
+    """Rewrite the months with `user_id`'s archived messages without them
+    (only those up to `before`, if given). Returns how many were dropped.
+    """
+
+    dropped = 0
+
+    for path in list(_months_with(archive_dir, user_id)):
+        rows = list(_read_archive(path))
+        kept = [row for row in rows
+                if row["user_id"] != user_id
+                or (before is not None
+                    and datetime.fromisoformat(row["timestamp"]) > before)]
+
+        if len(kept) < len(rows):
+            _write_archive(path, kept, keep=False)
+            dropped += len(rows) - len(kept)
+
+    return dropped
+
+
+def archived_messages(archive_dir, user_id):
+    """(month, row) for each of a user's archived messages, oldest month
+    first and in id order within a month, read one line at a time."""
+
+    for path in reversed(list(_months_with(archive_dir, user_id))):
+        month = os.path.basename(path)[len("messages-"):][:len("YYYY-MM")]
+
+        for row in _read_archive(path):
+            if row["user_id"] == user_id:
+                yield month, row
+
+
+def archived_rows(archive_dir, user_id, before=None, limit=ARCHIVE_PAGE_SIZE,
+                  deleted_before=None):
+    """Feed rows of a user's archived messages, newest first.
+
+    `before` is the (timestamp, id) of the last message of the previous
+    page. Messages up to `deleted_before` (the user's bulk delete) are
+    skipped.
+    """
+
+    rows = []
+
+    for path in _months_with(archive_dir, user_id):
+        month = []
+        for row in _read_archive(path):
+            if row["user_id"] != user_id:
+                continue
+
+            timestamp = datetime.fromisoformat(row["timestamp"])
+            if before is not None and (timestamp, row["id"]) >= before:
+                continue
+            if deleted_before is not None and timestamp <= deleted_before:
+                continue
+
+            month.append((row["id"], row["text"], timestamp, user_id))
+
+        rows.extend(sorted(month, key=lambda row: (row[2], row[0]),
+                           reverse=True))
+        if len(rows) >= limit:
+            break
+
+    return rows[:limit]
@@ -0,0 +1,270 @@
+"""Batched purge of tombstoned users and messages.
+
+Deleting a heavy account (or a lot of messages) with a single
+db.session.delete() cascades through every message, like and follow in one
+long transaction. Instead, the request only sets `deleted_at` (a tombstone),
+reads hide tombstoned rows straight away, and the functions here remove the
+rows afterwards in small batches, committing and pausing between batches.
+Archived messages (see partitions.py) are dropped by rewriting the months
+they're archived in.
+
+Messages and likes are purged on every shard (see shards.py); the tags
+and mentions of messages, wherever they're stored, are on main.
+"""
+
+import logging
+import time
+
+from flask import current_app, has_app_context
+
+from jobs import job_handler, report_progress
+from models import db, User, Message, Follows, Like, Mention, MessageTag
+
+logger = logging.getLogger(__name__)
+
+PURGE_BATCH_SIZE = 500
+PURGE_PAUSE_SECONDS = 0.05
+
+
+def _log_progress(what, counts):
+    """Default progress reporter: log the running totals.
+
+    When running as a job, the totals are also saved on the job row.
+    """
+
+    logger.info("purge %s: %s", what, counts)
+    report_progress({"purging": what, **counts})
+
+
+def _drop_archived(archive_dir, user_id, before=None):
+    """Drop `user_id`'s archived messages (see partitions.drop_archived).
+
+    `archive_dir` defaults to the app's MESSAGE_ARCHIVE_DIR; outside an
+    app context, with no `archive_dir`, there's no archive to drop from.
+    """
+
+    from partitions import drop_archived
+
+    if archive_dir is None and has_app_context():
+        archive_dir = current_app.config['MESSAGE_ARCHIVE_DIR']
+    if archive_dir is None:
+        return 0
+
+    return drop_archived(archive_dir, user_id, before=before)
+
+
+def _delete_in_batches(key_column, filters, batch_size, pause, on_batch,
+                       before_delete=None, session=None):
+    """Delete rows matching `filters`, at most `batch_size` per transaction.
+
+    `key_column` is used to pick each batch; `on_batch` is called with the
+    number of rows removed after each commit. `before_delete`, if given,
+    is called with each batch's keys inside its transaction. Runs in
+    `session` (default db.session). Returns the total removed.
+    """
+
+    session = session or db.session
+    model = key_column.class_
+    total = 0
+
+    while True:
+        keys = [row[0] for row in (session
+                                   .query(key_column)
+                                   .filter(*filters)
+                                   .limit(batch_size)
+                                   .all())]
+        if not keys:
+            return total
+
+        if before_delete:
+            before_delete(keys)
+        removed = (session
+                   .query(model)
+                   .filter(*filters, key_column.in_(keys))
+                   .delete(synchronize_session=False))
+        session.commit()
+
+        total += removed
+        on_batch(removed)
+
+        if pause:
+            time.sleep(pause)
+
+
+def _purge_message_batches(filters, batch_size, pause, on_batch):
+    """Delete messages matching `filters` and their likes, in batches, on
+    every shard.
+
+    `on_batch` is called with (messages removed, likes removed) after each
+    commit. Returns the total number of messages removed.
+    """
+
+    from shards import shards
+
+    total = 0
+
+    for shard in shards.names:
+        session = shards.session(shard)
+
+        while True:
+            ids = [row.id for row in (session
+                                      .query(Message.id)
+                                      .filter(*filters)
+                                      .limit(batch_size)
+                                      .all())]
+            if not ids:
+                break
+
+            likes_removed = (session
+                             .query(Like)
+                             .filter(Like.liked_message_id.in_(ids))
+                             .delete(synchronize_session=False))
+            removed = (session
+                       .query(Message)
+                       .filter(Message.id.in_(ids))
+                       .delete(synchronize_session=False))
+            # Shards' tags and mentions are indexed on main
+            for column in (MessageTag.message_id, Mention.message_id):
+                (column.class_.query
+                 .filter(column.in_(ids))
+                 .delete(synchronize_session=False))
+            session.commit()
+            db.session.commit()
+
+            total += removed
+            on_batch(removed, likes_removed)
+
+            if pause:
+                time.sleep(pause)
+
+    return total
+
+
+@job_handler("purge_messages")
+def purge_messages(user_id=None,
+                   batch_size=PURGE_BATCH_SIZE,
+                   pause=PURGE_PAUSE_SECONDS,
+                   progress=_log_progress,
+                   archive_dir=None):
+    """Remove tombstoned messages (and their likes) in batches.
+
+    If `user_id` is given, only that user's tombstoned messages are purged,
+    including those cleared by a "delete all my messages" (archived ones
+    too). Returns the number of messages removed.
+    """
+
+    filters = [Message.deleted_at.isnot(None)]
+
+    if user_id is not None:
+        cleared_before = (db.session
+                          .query(User.messages_deleted_before)
+                          .filter(User.id == user_id)
+                          .scalar())
+        if cleared_before is not None:
+            filters = [db.or_(Message.deleted_at.isnot(None),
+                              Message.timestamp <= cleared_before)]
+        filters.append(Message.user_id == user_id)
+
+    counts = {"messages": 0, "likes": 0}
+
+    if user_id is not None and cleared_before is not None:
+        archived = _drop_archived(archive_dir, user_id,
+                                  before=cleared_before)
+        logger.info("purge messages: %s archived messages of user %s",
+                    archived, user_id)
+
+    def on_batch(messages_removed, likes_removed):
+        counts["messages"] += messages_removed
+        counts["likes"] += likes_removed
+        progress("messages", counts)
+
+    return _purge_message_batches(filters, batch_size, pause, on_batch)
+
+
+@job_handler("purge_user")
+def purge_user(user_id,
+               batch_size=PURGE_BATCH_SIZE,
+               pause=PURGE_PAUSE_SECONDS,
+               progress=_log_progress,
+               archive_dir=None):
+    """Remove a tombstoned user and everything that belongs to them.
+
+    Messages, likes and follows are removed in batches before the user row
+    itself, and archived messages from the archive. Returns a dict with
+    the number of rows removed per table.
+    Does nothing if the user is missing or has not been tombstoned.
+    """
+
+    from shards import shards
+
+    user = User.query.get(user_id)
+    if user is None or user.deleted_at is None:
+        return None
+
+    what = f"user {user_id}"
+    counts = {"likes": 0, "follows": 0, "messages": 0}
+
+    def counted(table):
+        def on_batch(removed):
+            counts[table] += removed
+            progress(what, counts)
+        return on_batch
+
+    for shard in shards.names:
+        session = shards.session(shard)
+        _delete_in_batches(Like.liked_message_id,
+                           [Like.user_liking_id == user_id],
+                           batch_size, pause, counted("likes"),
+                           lambda message_ids, session=session: (
+                               Message.count_likes(
+                                   dict.fromkeys(message_ids, -1), session)),
+                           session=session)
+    _delete_in_batches(Follows.user_being_followed_id,
+                       [Follows.user_following_id == user_id],
+                       batch_size, pause, counted("follows"))
+    _delete_in_batches(Follows.user_following_id,
+                       [Follows.user_being_followed_id == user_id],
+                       batch_size, pause, counted("follows"))
+
+    def on_message_batch(messages_removed, likes_removed):
+        counts["messages"] += messages_removed
+        counts["likes"] += likes_removed
+        progress(what, counts)
+
+    _purge_message_batches([Message.user_id == user_id],
+                           batch_size, pause, on_message_batch)
+
+    archived = _drop_archived(archive_dir, user_id)
+    logger.info("purge %s: %s archived messages", what, archived)
+
+    User.query.filter(User.id == user_id).delete(synchronize_session=False)
+    db.session.commit()
+
+    progress(what, counts)
+    return counts
+
+
+@job_handler("purge_all")
+def purge_all(batch_size=PURGE_BATCH_SIZE, pause=PURGE_PAUSE_SECONDS):
+    """Purge every tombstoned user and message.
+
+    Sweeps up anything a background purge didn't finish (e.g. the process
+    was restarted mid-purge).
+    """
+
+    user_ids = [row.id for row in (db.session
+                                   .query(User.id)
+                                   .filter(User.deleted_at.isnot(None))
+                                   .all())]
+    for user_id in user_ids:
+        purge_user(user_id, batch_size=batch_size, pause=pause)
+
+    cleared_ids = [row.id for row in (
+        db.session
+        .query(User.id)
+        .filter(User.messages_deleted_before.isnot(None))
+        .all())]
+    for user_id in cleared_ids:
+        purge_messages(user_id, batch_size=batch_size, pause=pause)
+
+    purge_messages(batch_size=batch_size, pause=pause)
@@ -0,0 +1,302 @@
+"""Token-bucket rate limits, shared by every worker on a host.
+
+Views marked @rate_limited("policy") are checked against the limits in
+RATE_LIMITS[policy] before they run (for writes, unless other methods
+are given): per client IP, per logged-in user (anonymous requests fall
+back to their IP), or both. Each limit is a token bucket holding up to
+`burst` requests and refilled at `rate` per `per` seconds; a request
+takes one token from every bucket it's checked against, or from none of
+them if any is empty, and then gets a 429 with Retry-After. Responses
+to limited views carry RateLimit-Limit, RateLimit-Remaining and
+RateLimit-Reset headers for the tightest bucket.
+
+Buckets live in a file every worker maps (RATE_LIMIT_PATH, best put on
+tmpfs such as /dev/shm), laid out like the card cache (see
+card_cache.py): a fixed array of slots in sets of WAYS, a bucket only
+living in the set its key hashes to. A slot is the key's 64-bit hash,
+its tokens and when they were counted. A full set drops its least
+recently used bucket; an idle bucket refills to full anyway, so that
+only forgets a client that has gone quiet. Without RATE_LIMIT_PATH the
+buckets are kept per process, so each worker enforces its own limits.
+
+A check is a hash, one flock round trip and a couple of struct reads and
+writes on the map: a few microseconds, and no database.
+"""
+
+import fcntl
+import math
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from collections import Counter, namedtuple
+
+RATE_LIMIT_SLOTS = 65536
+
+WAYS = 8
+
+
+class Limit(namedtuple("Limit", "scope rate per burst")):
+    """`rate` requests per `per` seconds, in bursts of up to `burst`."""
+
+    @property
+    def refill(self):
+        """Tokens added per second."""
+
+        return self.rate / self.per
+
+
+# policy: limits, each by "ip" or "user"
+RATE_LIMITS = {
+    "login": [Limit("ip", 10, 60, 10)],
+    "signup": [Limit("ip", 5, 60 * 60, 5)],
+    "post": [Limit("user", 30, 60, 20), Limit("ip", 120, 60, 60)],
+    "follow": [Limit("user", 60, 60, 30), Limit("ip", 240, 60, 120)],
+    "like": [Limit("user", 120, 60, 60), Limit("ip", 480, 60, 240)],
+    # Checked as the signup form is typed in
+    "availability": [Limit("ip", 120, 60, 30)],
+}
+
+# Methods that are limited by default; a GET of the login page costs
+# nothing
+LIMITED_METHODS = {"POST", "PUT", "PATCH", "DELETE"}
+
+RateLimitResult = namedtuple("RateLimitResult",
+                             "allowed limit remaining reset retry_after")
+
+_MAGIC = b"WBRATES1"
+
+# magic, slots, ways, slot size
+_HEADER = struct.Struct("<8sIII")
+_HEADER_SIZE = 64
+
+# key hash (0 = empty), tokens, counted at
+_SLOT = struct.Struct("<Qdd")
+# A whole set of slots, read in one go
+_SET = struct.Struct("<" + "Qdd" * WAYS)
+
+
+def rate_limited(policy, methods=LIMITED_METHODS):
+    """Check the decorated view's `methods` against RATE_LIMITS[policy]."""
+
+    def mark(view):
+        view.rate_limit = policy
+        view.rate_limit_methods = methods
+        return view
+
+    return mark
+
+
+class SharedRateLimiter:
+    """Token buckets in a file mapped by every worker (or in this process)."""
+
+    def __init__(self):
+        self.path = None
+        self.slots = RATE_LIMIT_SLOTS
+        self.limits = RATE_LIMITS
+        self.stats = Counter()
+
+        self._map = None
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Use the file named by app.config['RATE_LIMIT_PATH'], if set."""
+
+        self.path = app.config.get('RATE_LIMIT_PATH')
+        self.slots = app.config.get('RATE_LIMIT_SLOTS', RATE_LIMIT_SLOTS)
+        self.limits = app.config.get('RATE_LIMITS', RATE_LIMITS)
+
+        # Round down to whole sets
+        self.slots -= self.slots % WAYS
+        self._open()
+
+    @property
+    def size(self):
+        return _HEADER_SIZE + self.slots * _SLOT.size
+
+    def _open(self):
+        """Map the buckets, creating or resetting the file if needed.
+
+        Called again lazily in a forked worker, which needs its own file
+        descriptor for flock (or, without a file, its own buckets).
+        """
+
+        if self._map is not None:
+            self.close()
+
+        self._pid = os.getpid()
+
+        if not self.path:
+            self._map = mmap.mmap(-1, self.size)
+            return
+
+        self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        header = _HEADER.pack(_MAGIC, self.slots, WAYS, _SLOT.size)
+
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+        try:
+            if (os.fstat(self._fd).st_size != self.size
+                    or os.pread(self._fd, _HEADER.size, 0) != header):
+                os.ftruncate(self._fd, 0)
+                os.ftruncate(self._fd, self.size)
+                os.pwrite(self._fd, header, 0)
+
+            self._map = mmap.mmap(self._fd, self.size)
+        finally:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+
+    def _mapped(self):
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._open()
+
+        return self._map
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+        if self._fd is not None:
+            os.close(self._fd)
+        self._map = self._fd = self._pid = None
+
+    def reset(self):
+        """Empty every bucket, and forget the stats."""
+
+        buf = self._mapped()
+
+        self._acquire()
+        try:
+            buf[_HEADER_SIZE:] = bytes(self.size - _HEADER_SIZE)
+        finally:
+            self._release()
+
+        self.stats.clear()
+
+    # Hand-rolled rather than a @contextmanager: this is the fast path
+
+    def _acquire(self):
+        """Take this process's lock and, with a file, its flock."""
+
+        self._lock.acquire()
+        if self._fd is not None:
+            try:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+            except BaseException:
+                self._lock.release()
+                raise
+
+    def _release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    # Buckets
+
+    @staticmethod
+    def _hash(key):
+        """Stable 64-bit hash of `key` (never 0, which marks an empty slot).
+
+        Two cheap 32-bit checksums rather than a cryptographic hash: keys
+        aren't secret, and this runs on every limited request.
+        """
+
+        key = key.encode()
+        return (zlib.crc32(key) << 32 | zlib.adler32(key)) | 1
+
+    def _slot_offset(self, buf, key_hash):
+        """Offset of the slot for `key_hash`: its own, a free one, or the
+        least recently used one in its set."""
+
+        first = _HEADER_SIZE + key_hash % (self.slots // WAYS) * _SET.size
+        fields = _SET.unpack_from(buf, first)
+        hashes = fields[0::3]
+
+        if key_hash in hashes:
+            return first + hashes.index(key_hash) * _SLOT.size, True
+
+        if 0 in hashes:
+            return first + hashes.index(0) * _SLOT.size, False
+
+        counted_at = fields[2::3]
+        return first + counted_at.index(min(counted_at)) * _SLOT.size, False
+
+    def take(self, buckets, now=None):
+        """Take a token from each of `buckets`, [(key, Limit)], if every
+        one has a token to spare.
+
+        Returns a RateLimitResult for each bucket, after the take.
+        """
+
+        now = time.time() if now is None else now
+        buf = self._mapped()
+        hashes = [self._hash(key) for key, _ in buckets]
+        counted = []
+        allowed = True
+
+        self._acquire()
+        try:
+            for key_hash, (_, limit) in zip(hashes, buckets):
+                offset, found = self._slot_offset(buf, key_hash)
+                tokens = limit.burst
+
+                if found:
+                    _, tokens, counted_at = _SLOT.unpack_from(buf, offset)
+                    # (a clock that went backwards refills nothing)
+                    if now > counted_at:
+                        tokens = min(limit.burst, tokens
+                                     + (now - counted_at) * limit.refill)
+
+                # Claim the slot now, so another of these buckets can't
+                # pick it as its victim
+                _SLOT.pack_into(buf, offset, key_hash, tokens, now)
+                counted.append((offset, key_hash, tokens))
+                allowed = allowed and tokens >= 1
+
+            if allowed:
+                for i, (offset, key_hash, tokens) in enumerate(counted):
+                    _SLOT.pack_into(buf, offset, key_hash, tokens - 1, now)
+                    counted[i] = (offset, key_hash, tokens - 1)
+        finally:
+            self._release()
+
+        self.stats["allowed" if allowed else "limited"] += 1
+
+        results = []
+        for (_, _, tokens), (_, limit) in zip(counted, buckets):
+            refill = limit.refill
+            results.append(RateLimitResult(
+                allowed,
+                limit.burst,
+                int(tokens),
+                math.ceil((limit.burst - tokens) / refill),
+                0 if tokens >= 1 else math.ceil((1 - tokens) / refill)))
+
+        return results
+
+    def check(self, policy, ip, user_id=None, now=None):
+        """Take a request's tokens for `policy`.
+
+        Returns (allowed, the result for the tightest bucket).
+        """
+
+        buckets = []
+        for limit in self.limits[policy]:
+            if limit.scope == "user" and user_id is not None:
+                client = f"user:{user_id}"
+            else:
+                client = f"ip:{ip}"
+            buckets.append((f"{policy}:{limit.scope}:{client}", limit))
+
+        results = self.take(buckets, now)
+        if results[0].allowed:
+            return True, min(results, key=lambda result: result.remaining)
+
+        return False, max(results, key=lambda result: result.retry_after)
+
+
+rate_limiter = SharedRateLimiter()
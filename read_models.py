@@ -0,0 +1,319 @@
+"""Lightweight read models for the read-heavy pages.
+
+Feeds and user lists don't need full User/Message instances: those carry
+every column (password hashes, bios nobody sees on a timeline), ORM
+instrumentation and a spot in the session's identity map. The queries here
+select only the columns a page renders and wrap each row in a small
+__slots__ object with the attribute names the templates already use
+(msg.id, msg.text, msg.user.username, ...). Nothing is tracked by the
+session, so a long feed costs a few hundred bytes per item.
+
+Feed authors are resolved through the shared card cache (card_cache.py)
+when it's configured, so only authors not already cached are loaded.
+
+Like counts and "liked by" previews for a page of messages take two
+queries whatever the page, however popular its messages: the counts are
+read from Message.like_count, and the first few likers of each message
+from one window query over the likes index. A message with more than
+LIKERS_WINDOW_MAX_LIKES likes gets its likers from its own LIMITed index
+scan instead, so the window never reads a viral message's million likes.
+"""
+
+from sqlalchemy import func, select
+
+from card_cache import CachedCard, card_cache
+from models import db, Like, Message, User
+
+
+class AuthorCard:
+    """The bits of a user shown next to one of their messages."""
+
+    __slots__ = ("id", "username", "image_url")
+
+    def __init__(self, id, username, image_url):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+
+
+class FeedMessage:
+    """A message as shown in a feed."""
+
+    __slots__ = ("id", "text", "timestamp", "user")
+
+    def __init__(self, id, text, timestamp, user):
+        self.id = id
+        self.text = text
+        self.timestamp = timestamp
+        self.user = user
+
+
+class LikeSummary:
+    """A message's like count and the first few users who liked it."""
+
+    __slots__ = ("count", "likers")
+
+    def __init__(self, count, likers):
+        self.count = count
+        self.likers = likers
+
+    @property
+    def others(self):
+        """Likers not named in the preview."""
+
+        return self.count - len(self.likers)
+
+
+class UserCard:
+    """A user as shown on a user card."""
+
+    __slots__ = ("id", "username", "image_url", "header_image_url", "bio")
+
+    def __init__(self, id, username, image_url, header_image_url, bio):
+        self.id = id
+        self.username = username
+        self.image_url = image_url
+        self.header_image_url = header_image_url
+        self.bio = bio
+
+
+class UserCounts:
+    """The numbers in a profile's stats bar."""
+
+    __slots__ = ("num_messages", "num_following", "num_followers",
+                 "num_likes")
+
+    def __init__(self, num_messages, num_following, num_followers,
+                 num_likes):
+        self.num_messages = num_messages
+        self.num_following = num_following
+        self.num_followers = num_followers
+        self.num_likes = num_likes
+
+
+FEED_COLUMNS = (
+    Message.id,
+    Message.text,
+    Message.timestamp,
+    Message.user_id,
+)
+
+AUTHOR_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+)
+
+# Feed authors are resolved this many rows at a time
+AUTHOR_CHUNK_SIZE = 100
+
+# Likers named in a "liked by" preview
+LIKERS_PREVIEW_SIZE = 2
+
+# Messages with more likes than this are left out of the likers window
+# query (see load_like_summaries)
+LIKERS_WINDOW_MAX_LIKES = 1000
+
+CARD_COLUMNS = (
+    User.id,
+    User.username,
+    User.image_url,
+    User.header_image_url,
+    User.bio,
+)
+
+
+def feed_messages(query):
+    """FeedMessages for a Message query."""
+
+    rows = query.with_entities(*FEED_COLUMNS)
+
+    # Authors repeat a lot in a feed: share one AuthorCard per author
+    authors = {}
+    chunk = []
+
+    for row in rows:
+        chunk.append(row)
+
+        if len(chunk) == AUTHOR_CHUNK_SIZE:
+            yield from _with_authors(chunk, authors)
+            chunk = []
+
+    yield from _with_authors(chunk, authors)
+
+
+def older_than(before):
+    """Criteria for messages after `before`, a (timestamp, id), in
+    newest-first (timestamp, id) order: keyset paging."""
+
+    timestamp, message_id = before
+    # (the plain `<=` on timestamp lets Postgres prune older partitions)
+    return (Message.timestamp <= timestamp,
+            db.or_(Message.timestamp < timestamp, Message.id < message_id))
+
+
+def feed_rows(query):
+    """Plain (id, text, timestamp, user_id) tuples for a Message query.
+
+    Unlike FeedMessages these don't include authors, so they can be cached
+    (see single_flight.py) without going stale when an author changes.
+    """
+
+    return [tuple(row) for row in query.with_entities(*FEED_COLUMNS)]
+
+
+def feed_messages_from_rows(rows):
+    """FeedMessages for rows from feed_rows()."""
+
+    authors = {}
+
+    for start in range(0, len(rows), AUTHOR_CHUNK_SIZE):
+        yield from _with_authors(rows[start:start + AUTHOR_CHUNK_SIZE], authors)
+
+
+def _with_authors(rows, authors):
+    missing = {user_id for _, _, _, user_id in rows} - authors.keys()
+    if missing:
+        authors.update(author_cards(missing))
+
+    return [FeedMessage(message_id, text, timestamp, authors[user_id])
+            for message_id, text, timestamp, user_id in rows]
+
+
+def author_cards(user_ids):
+    """{user id: AuthorCard}, from the card cache where possible."""
+
+    if not card_cache.enabled:
+        return {user_id: AuthorCard(user_id, username, image_url)
+                for user_id, username, image_url in (
+                    db.session
+                    .query(*AUTHOR_COLUMNS)
+                    .filter(User.id.in_(user_ids)))}
+
+    cards = card_cache.get_many(user_ids)
+
+    missing = set(user_ids) - cards.keys()
+    if missing:
+        # Versions first: if a user changes while we read them, the card
+        # we read is refused by put()
+        versions = card_cache.versions(missing)
+
+        for card in load_cached_cards(missing):
+            card_cache.put(card, versions[card.id])
+            cards[card.id] = card
+
+    return {user_id: AuthorCard(card.id, card.username, card.image_url)
+            for user_id, card in cards.items()}
+
+
+def load_cached_cards(user_ids):
+    """CachedCards for `user_ids` from the database."""
+
+    return [CachedCard(user_id, username, image_url)
+            for user_id, username, image_url in (
+                db.session
+                .query(*AUTHOR_COLUMNS)
+                .filter(User.id.in_(user_ids)))]
+
+
+def load_user_counts(user_id):
+    """UserCounts for a profile's stats: four COUNTs, so cache them (see
+    app.user_counts)."""
+
+    user = User.query.get(user_id)
+
+    return UserCounts(user.num_messages, user.num_following,
+                      user.num_followers, user.num_likes)
+
+
+def load_like_summaries(message_ids):
+    """{message id: LikeSummary} for those of `message_ids` with likes."""
+
+    from shards import MAIN, shards
+
+    message_ids = list(message_ids)
+    if not message_ids:
+        return {}
+
+    # (not from a stale copy an interrupted shard move left behind)
+    rows = shards.on_author_shards([
+        (shard, message_id, author_id, like_count)
+        for shard in shards.names
+        for message_id, author_id, like_count in (
+            shards.session(shard)
+            .query(Message.id, Message.user_id, Message.like_count)
+            .filter(Message.id.in_(message_ids),
+                    Message.like_count > 0))])
+
+    counts = {}
+    liker_ids = {}
+
+    # Deleted users aren't named until they're purged. Shards have no
+    # users table, so they're given the ids
+    deleted = select(User.id).where(User.deleted_at.isnot(None))
+    deleted_ids = (db.session.execute(deleted).scalars().all()
+                   if shards.enabled else [])
+
+    for shard in shards.names:
+        shard_counts = {message_id: like_count
+                        for row_shard, message_id, _, like_count in rows
+                        if row_shard == shard}
+        counts.update(shard_counts)
+        liker_ids.update(_liker_ids(shards.session(shard), shard_counts,
+                                    deleted if shard == MAIN else deleted_ids))
+
+    cards = author_cards({user_id for user_ids in liker_ids.values()
+                          for user_id in user_ids})
+
+    return {message_id: LikeSummary(count, [cards[user_id]
+                                            for user_id in liker_ids.get(
+                                                message_id, [])
+                                            if user_id in cards])
+            for message_id, count in counts.items()}
+
+
+def _liker_ids(session, counts, deleted):
+    """{message id: first LIKERS_PREVIEW_SIZE liker ids} for `counts`,
+    leaving out the users in `deleted` (ids, or a query for them)."""
+
+    liker_ids = {}
+
+    windowed = [message_id for message_id, count in counts.items()
+                if count <= LIKERS_WINDOW_MAX_LIKES]
+    if windowed:
+        ranked = (session
+                  .query(Like.liked_message_id,
+                         Like.user_liking_id,
+                         func.row_number().over(
+                             partition_by=Like.liked_message_id,
+                             order_by=Like.user_liking_id.desc(),
+                         ).label("rank"))
+                  .filter(Like.liked_message_id.in_(windowed),
+                          Like.user_liking_id.notin_(deleted))
+                  .subquery())
+
+        for message_id, user_id in (session
+                                    .query(ranked.c.liked_message_id,
+                                           ranked.c.user_liking_id)
+                                    .filter(ranked.c.rank
+                                            <= LIKERS_PREVIEW_SIZE)
+                                    .order_by(ranked.c.rank)):
+            liker_ids.setdefault(message_id, []).append(user_id)
+
+    # Viral messages: the first few entries of their slice of the index
+    for message_id in counts.keys() - set(windowed):
+        liker_ids[message_id] = [user_id for user_id, in (
+            session
+            .query(Like.user_liking_id)
+            .filter(Like.liked_message_id == message_id,
+                    Like.user_liking_id.notin_(deleted))
+            .order_by(Like.user_liking_id.desc())
+            .limit(LIKERS_PREVIEW_SIZE))]
+
+    return liker_ids
+
+
+def user_cards(query):
+    """UserCards for a User query."""
+
+    return [UserCard(*row) for row in query.with_entities(*CARD_COLUMNS)]
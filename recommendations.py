@@ -0,0 +1,287 @@
+"""Precomputed "who to follow" recommendations.
+
+Candidates are friends-of-friends: users followed by the users you follow.
+Each two-hop path u -> v -> c adds 1 / log(2 + following(v)) to c's score
+(Adamic-Adar), so a path through someone who follows few people counts for
+more than one through someone who follows everybody. The best
+RECOMMENDATIONS_PER_USER candidates per user go in the `recommendations`
+table, which is all the homepage widget reads.
+
+The follow graph is loaded into CSR arrays (indptr/indices over dense user
+indexes) and candidates for a chunk of users are scored at once with NumPy,
+so a full run over a million users is a few minutes of array work.
+"""
+
+import logging
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy.orm import aliased
+
+from jobs import enqueue, job_handler
+from models import db, User, Follows, Recommendation
+
+logger = logging.getLogger(__name__)
+
+RECOMMENDATIONS_PER_USER = 10
+
+# Upper bound on two-hop paths expanded at once; users are grouped into
+# chunks that stay under it.
+MAX_PATHS_PER_CHUNK = 5_000_000
+
+# Only the first this-many follows of each intermediate user are expanded,
+# so one user following everybody can't blow up a chunk.
+MAX_FANOUT = 1_000
+
+LOAD_BATCH_SIZE = 100_000
+
+
+class FollowGraph:
+    """Following edges as CSR arrays over dense user indexes.
+
+    user_ids[i] is the user id for index i; the users followed by index i
+    are indices[indptr[i]:indptr[i + 1]].
+    """
+
+    def __init__(self, user_ids, sources, targets):
+        self.user_ids = user_ids
+        self.size = len(user_ids)
+
+        order = np.argsort(sources, kind="stable")
+        self.indices = targets[order]
+        self.degree = np.bincount(sources, minlength=self.size)
+        self.indptr = np.zeros(self.size + 1, dtype=np.int64)
+        np.cumsum(self.degree, out=self.indptr[1:])
+
+    def index_of(self, user_ids):
+        """Dense indexes for `user_ids` (which must be in the graph)."""
+
+        return np.searchsorted(self.user_ids, user_ids)
+
+
+def _load_edges(query):
+    """Read (follower, followed) id pairs from `query` into two arrays."""
+
+    sources = []
+    targets = []
+
+    for row in query.yield_per(LOAD_BATCH_SIZE):
+        sources.append(row.user_following_id)
+        targets.append(row.user_being_followed_id)
+
+    return (np.array(sources, dtype=np.int64),
+            np.array(targets, dtype=np.int64))
+
+
+def load_follow_graph(source_ids=None):
+    """Load the follow graph between active users.
+
+    With `source_ids`, only the edges out of those users are loaded, which
+    is all that's needed to score the users they follow.
+    """
+
+    follower = aliased(User)
+    followed = aliased(User)
+
+    query = (db.session
+             .query(Follows.user_following_id, Follows.user_being_followed_id)
+             .join(follower, follower.id == Follows.user_following_id)
+             .join(followed, followed.id == Follows.user_being_followed_id)
+             .filter(follower.deleted_at.is_(None),
+                     followed.deleted_at.is_(None)))
+
+    if source_ids is not None:
+        query = query.filter(Follows.user_following_id.in_(
+            [int(user_id) for user_id in source_ids]))
+
+    sources, targets = _load_edges(query)
+
+    user_ids = np.union1d(sources, targets)
+    return FollowGraph(user_ids,
+                       np.searchsorted(user_ids, sources),
+                       np.searchsorted(user_ids, targets))
+
+
+def _expand(starts, counts):
+    """Concatenate arange(start, start + count) for each (start, count)."""
+
+    total = int(counts.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.int64)
+
+    offsets = np.repeat(np.cumsum(counts) - counts, counts)
+    return np.repeat(starts, counts) + (np.arange(total) - offsets)
+
+
+def score_chunk(graph, rows, limit=RECOMMENDATIONS_PER_USER):
+    """Top `limit` two-hop candidates for each dense index in `rows`.
+
+    Returns parallel arrays (row, candidate, score), grouped by row with
+    the best candidates first.
+    """
+
+    # First hop: everyone each row follows
+    counts1 = graph.degree[rows]
+    owners1 = np.repeat(rows, counts1)
+    hop1 = graph.indices[_expand(graph.indptr[rows], counts1)]
+
+    # Second hop: everyone they follow
+    counts2 = np.minimum(graph.degree[hop1], MAX_FANOUT)
+    owners2 = np.repeat(owners1, counts2)
+    candidates = graph.indices[_expand(graph.indptr[hop1], counts2)]
+    weights = np.repeat(1.0 / np.log(2.0 + graph.degree[hop1]), counts2)
+
+    # Sum the path weights per (row, candidate)
+    keys = owners2 * graph.size + candidates
+    keys, inverse = np.unique(keys, return_inverse=True)
+    scores = np.bincount(inverse.ravel(), weights=weights)
+    owners = keys // graph.size
+    candidates = keys % graph.size
+
+    # Drop yourself and people you already follow
+    followed = owners1 * graph.size + hop1
+    keep = (candidates != owners) & ~np.isin(keys, followed)
+    owners, candidates, scores = owners[keep], candidates[keep], scores[keep]
+
+    # Best `limit` per row
+    order = np.lexsort((-scores, owners))
+    owners, candidates, scores = owners[order], candidates[order], scores[order]
+    group_starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    rank = np.arange(len(owners)) - np.repeat(
+        group_starts, np.diff(np.r_[group_starts, len(owners)]))
+    top = rank < limit
+
+    return owners[top], candidates[top], scores[top]
+
+
+def _chunks(graph, rows):
+    """Split `rows` into chunks of at most MAX_PATHS_PER_CHUNK paths."""
+
+    if len(rows) == 0:
+        return []
+
+    hop1_fanout = np.minimum(graph.degree[graph.indices], MAX_FANOUT)
+    paths_per_row = np.add.reduceat(
+        np.r_[hop1_fanout, 0], graph.indptr[:-1])
+    paths_per_row[graph.degree == 0] = 0
+
+    paths = np.cumsum(paths_per_row[rows])
+    chunk_ids = paths // MAX_PATHS_PER_CHUNK
+
+    boundaries = np.flatnonzero(np.r_[True, chunk_ids[1:] != chunk_ids[:-1]])
+    return np.split(rows, boundaries[1:])
+
+
+def _store(graph, rows, owners, candidates, scores):
+    """Replace the stored recommendations for `rows`."""
+
+    user_ids = [int(user_id) for user_id in graph.user_ids[rows]]
+    computed_at = datetime.utcnow()
+
+    (Recommendation.query
+     .filter(Recommendation.user_id.in_(user_ids))
+     .delete(synchronize_session=False))
+
+    db.session.bulk_insert_mappings(Recommendation, [
+        {
+            "user_id": int(user_id),
+            "recommended_user_id": int(recommended_id),
+            "score": float(score),
+            "computed_at": computed_at,
+        }
+        for user_id, recommended_id, score in zip(
+            graph.user_ids[owners], graph.user_ids[candidates], scores)
+    ])
+    db.session.commit()
+
+
+def compute_recommendations(graph, rows):
+    """Score and store recommendations for dense indexes `rows` of `graph`."""
+
+    for chunk in _chunks(graph, rows):
+        owners, candidates, scores = score_chunk(graph, chunk)
+        _store(graph, chunk, owners, candidates, scores)
+
+    return len(rows)
+
+
+@job_handler("compute_recommendations")
+def compute_all_recommendations():
+    """Recompute recommendations for every user who follows anyone."""
+
+    started = datetime.utcnow()
+    graph = load_follow_graph()
+    rows = np.flatnonzero(graph.degree)
+
+    computed = compute_recommendations(graph, rows)
+
+    # Users who no longer follow anyone have nothing to recommend from
+    (Recommendation.query
+     .filter(Recommendation.computed_at < started)
+     .delete(synchronize_session=False))
+    _clear_changed(None, started)
+
+    logger.info("computed recommendations for %s users", computed)
+    return computed
+
+
+def note_follows_changed(user_ids):
+    """Queue a refresh of these users' recommendations after (un)follows.
+
+    Changes within the same minute share one refresh job.
+    """
+
+    now = datetime.utcnow()
+    (User.query
+     .filter(User.id.in_(user_ids))
+     .update({"follows_changed_at": now}, synchronize_session=False))
+    enqueue("refresh_recommendations",
+            priority=-5,
+            idempotency_key=f"refresh_recommendations:{now:%Y%m%d%H%M}",
+            delay=60)
+
+
+@job_handler("refresh_recommendations")
+def refresh_changed_recommendations():
+    """Recompute recommendations for users whose follows changed."""
+
+    started = datetime.utcnow()
+    user_ids = [row.id for row in (db.session
+                                   .query(User.id)
+                                   .filter(User.follows_changed_at.isnot(None),
+                                           User.deleted_at.is_(None))
+                                   .all())]
+    if not user_ids:
+        return 0
+
+    # Scoring a user needs their follows and their follows' follows
+    followed_ids = {row.user_being_followed_id for row in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .filter(Follows.user_following_id.in_(user_ids))
+        .all())}
+    graph = load_follow_graph(set(user_ids) | followed_ids)
+
+    in_graph = np.intersect1d(np.array(user_ids, dtype=np.int64),
+                              graph.user_ids)
+    rows = graph.index_of(in_graph)
+
+    (Recommendation.query
+     .filter(Recommendation.user_id.in_(user_ids))
+     .delete(synchronize_session=False))
+    computed = compute_recommendations(graph, rows)
+    _clear_changed(user_ids, started)
+
+    logger.info("refreshed recommendations for %s users", computed)
+    return computed
+
+
+def _clear_changed(user_ids, started):
+    """Clear follows_changed_at for users that haven't changed since `started`."""
+
+    query = User.query.filter(User.follows_changed_at <= started)
+    if user_ids is not None:
+        query = query.filter(User.id.in_(user_ids))
+
+    query.update({"follows_changed_at": None}, synchronize_session=False)
+    db.session.commit()
@@ -0,0 +1,126 @@
+"""Production web server support: sizing, warm-up and readiness.
+
+gunicorn.conf.py uses this to size the server and to warm the app in the
+gunicorn master before it forks any workers, so every worker starts with
+compiled templates, a filled card cache, a built existence filter and no
+inherited DB connections.
+The /readyz route reports is_ready().
+"""
+
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy import func, text
+
+from card_cache import card_cache
+from existence_filter import existence_filter
+from models import db, Follows, Message
+from read_models import author_cards, feed_messages
+from timeline_bus import timeline_bus
+
+logger = logging.getLogger(__name__)
+
+DB_POOL_SIZE = 5
+
+# Connections the database allows, less some for the job worker and psql
+DB_MAX_CONNECTIONS = 90
+
+# How much warm_up() loads
+WARM_CARDS = 1000
+WARM_TIMELINE_MESSAGES = 500
+
+warmed = threading.Event()
+
+
+def worker_counts(cpus=None, pool_size=None, max_connections=None):
+    """(workers, threads per worker, DB pool size) for this host.
+
+    One thread per pooled DB connection, so a page request never waits for
+    a connection, plus one per live timeline stream (which don't hold
+    connections while they wait). The usual 2 x CPUs + 1 workers, but no
+    more than the database has connections for.
+    """
+
+    cpus = cpus or os.cpu_count() or 1
+    pool_size = pool_size or int(os.environ.get('DB_POOL_SIZE', DB_POOL_SIZE))
+    max_connections = max_connections or int(
+        os.environ.get('DB_MAX_CONNECTIONS', DB_MAX_CONNECTIONS))
+
+    workers = max(1, min(2 * cpus + 1, max_connections // pool_size))
+
+    return workers, pool_size + timeline_bus.max_subscribers, pool_size
+
+
+def precompile_templates(app):
+    """Compile every template now, not on its first request."""
+
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+
+
+def warm_card_cache(limit=WARM_CARDS):
+    """Cache the cards of the most followed users."""
+
+    if not card_cache.enabled:
+        return
+
+    popular_ids = [user_id for user_id, in (
+        db.session
+        .query(Follows.user_being_followed_id)
+        .group_by(Follows.user_being_followed_id)
+        .order_by(func.count().desc())
+        .limit(limit))]
+
+    author_cards(popular_ids)
+
+
+def warm_recent_timeline(limit=WARM_TIMELINE_MESSAGES):
+    """Load the latest messages the way the feeds do.
+
+    Caches their authors' cards and SQLAlchemy's compiled feed queries.
+    """
+
+    for _ in feed_messages(Message
+                           .visible()
+                           .order_by(Message.timestamp.desc())
+                           .limit(limit)):
+        pass
+
+
+def warm_up(app):
+    """Warm everything up, then mark this process (and its forks) ready.
+
+    Leaves no database connections open, so none are shared with forked
+    workers.
+    """
+
+    start = time.monotonic()
+
+    with app.app_context():
+        precompile_templates(app)
+        warm_card_cache()
+        warm_recent_timeline()
+        existence_filter.build()
+
+        db.session.remove()
+        db.engine.dispose()
+
+    warmed.set()
+    logger.info("warmed up in %.2fs", time.monotonic() - start)
+
+
+def is_ready():
+    """(ready, checks): warmed up and able to reach the database."""
+
+    checks = {"warm": warmed.is_set()}
+
+    try:
+        db.session.execute(text("SELECT 1"))
+        checks["database"] = True
+    except Exception:
+        db.session.rollback()
+        checks["database"] = False
+
+    return all(checks.values()), checks
@@ -0,0 +1,641 @@
+"""Horizontal sharding of messages and likes by user id.
+
+Users, follows and everything else live in the main database. Messages
+can be spread over more databases: each user's messages, and the likes of
+those messages, live together on one shard. A profile is then one query
+on one database, and message and like writes are spread over all of them.
+
+The shards are the main database (named "main") plus the databases in
+SHARD_DATABASE_URLS. The user_shards directory table says which shard
+each user is on; users with no entry (everyone from before sharding) are
+on main. New users are placed by a consistent-hash ring over the shards,
+so adding a shard only means moving about 1/n of the users.
+`flask rebalance-shards` moves everyone the ring now places elsewhere
+(see move_users()).
+
+While sharding is on, message ids are drawn from the main database's
+sequence, whichever shard stores the message, so they stay unique.
+
+Reads that span users (home timelines) ask each shard that holds any of
+the authors for its newest matching rows, and merge them. Shards have no
+users table, so the author checks that Message.visible() does with a
+join become plain filters (see visible_authors()).
+
+With no SHARD_DATABASE_URLS, `shards.enabled` is false and app.py uses
+its single-database queries. So far only the main feed paths go through
+shards: posting, deleting, liking (LIKES_WRITE_BEHIND is ignored),
+profiles, timelines, message pages, message counts and purging.
+Trending and the liked-messages page still use only the main database.
+"""
+
+import bisect
+import hashlib
+import os
+import threading
+import time
+from collections import defaultdict
+from datetime import datetime
+from heapq import merge
+from itertools import islice
+from operator import itemgetter
+
+from sqlalchemy import (
+    Column, Index, MetaData, Table, create_engine, func, select, text)
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+from invalidation_bus import invalidation_bus
+from models import db, Like, Message, MessageId, User, UserShard
+from read_models import FEED_COLUMNS, older_than
+
+MAIN = "main"
+
+# Points per shard on the hash ring: more points, a more even spread
+RING_POINTS = 64
+
+# How long move_users() waits, after stopping a user's writes, for
+# requests that looked up their shard just before to finish writing
+MOVE_SETTLE_SECONDS = 5
+
+# Users stopped at a time by rebalance(); messages copied per batch
+MOVE_USERS_BATCH_SIZE = 100
+MOVE_BATCH_SIZE = 1000
+
+
+class ShardMoving(Exception):
+    """The user's messages are being moved to another shard."""
+
+
+class HashRing:
+    """Consistent hashing of user ids onto shard names."""
+
+    def __init__(self, names, points=RING_POINTS):
+        self._ring = sorted((self._hash(f"{name}:{point}"), name)
+                            for name in names
+                            for point in range(points))
+        self._hashes = [point_hash for point_hash, _ in self._ring]
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8],
+                              "big")
+
+    def shard_for(self, user_id):
+        index = bisect.bisect(self._hashes, self._hash(str(user_id)))
+        return self._ring[index % len(self._ring)][1]
+
+
+def shard_metadata():
+    """The messages and likes tables as created on a shard.
+
+    Without foreign keys: the users they refer to are on main.
+    """
+
+    metadata = MetaData()
+
+    for table in (Message.__table__, Like.__table__):
+        copy = Table(table.name, metadata, *(
+            Column(column.name, column.type,
+                   primary_key=column.primary_key,
+                   nullable=column.nullable,
+                   server_default=(column.server_default
+                                   and column.server_default.arg))
+            for column in table.columns))
+
+        for index in table.indexes:
+            Index(index.name, *(copy.c[column.name]
+                                for column in index.columns))
+
+    return metadata
+
+
+def visible_authors(author_ids):
+    """{author id: messages_deleted_before} for authors not deleted."""
+
+    return dict(db.session
+                .query(User.id, User.messages_deleted_before)
+                .filter(User.id.in_(author_ids), User.deleted_at.is_(None)))
+
+
+def visible_criteria(authors):
+    """Filters for the messages Message.visible() shows, by `authors`.
+
+    `authors` is from visible_authors().
+    """
+
+    criteria = [Message.user_id.in_(authors), Message.deleted_at.is_(None)]
+
+    for author_id, deleted_before in authors.items():
+        if deleted_before is not None:
+            criteria.append(db.or_(Message.user_id != author_id,
+                                   Message.timestamp > deleted_before))
+
+    return criteria
+
+
+class ShardRouter:
+    """Finds users' shards and runs message reads and writes on them."""
+
+    def __init__(self):
+        self.urls = {}
+        self.engine_options = {}
+        self.ring = HashRing([MAIN])
+
+        self._sessions = {}
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        """Use app.config['SHARD_DATABASE_URLS'] ({name: URL})."""
+
+        self.engine_options = app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {})
+        app.teardown_appcontext(self.remove_sessions)
+        self.configure(app.config.get('SHARD_DATABASE_URLS') or {})
+
+    def configure(self, urls):
+        """Use the databases in `urls` as shards, besides main."""
+
+        self.dispose()
+        self.urls = dict(urls)
+        self.ring = HashRing(self.names)
+
+    @property
+    def names(self):
+        return [MAIN, *sorted(self.urls)]
+
+    @property
+    def enabled(self):
+        return bool(self.urls)
+
+    # Connections
+
+    def session(self, name):
+        """Session for shard `name` (db.session for main)."""
+
+        if name == MAIN:
+            return db.session
+
+        # Don't share a parent process's connections with a fork
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._sessions = {}
+                    self._pid = os.getpid()
+
+        session = self._sessions.get(name)
+
+        if session is None:
+            with self._lock:
+                session = self._sessions.get(name)
+                if session is None:
+                    engine = create_engine(self.urls[name],
+                                           **self.engine_options)
+                    session = self._sessions[name] = scoped_session(
+                        sessionmaker(bind=engine))
+
+        return session
+
+    def remove_sessions(self, exception=None):
+        """End this thread's shard sessions (after each request)."""
+
+        for session in self._sessions.values():
+            session.remove()
+
+    def dispose(self):
+        """Close every shard connection."""
+
+        for session in self._sessions.values():
+            session.remove()
+            session.bind.dispose()
+
+        self._sessions = {}
+
+    def create_all(self):
+        """Create the messages and likes tables on every shard but main."""
+
+        metadata = shard_metadata()
+
+        for name in self.urls:
+            metadata.create_all(self.session(name).bind)
+
+    # Directory
+
+    def shards_of(self, user_ids):
+        """{user id: shard name}."""
+
+        user_ids = set(user_ids)
+        shards = dict.fromkeys(user_ids, MAIN)
+
+        if self.enabled and user_ids:
+            shards.update(db.session
+                          .query(UserShard.user_id, UserShard.shard)
+                          .filter(UserShard.user_id.in_(user_ids)))
+
+        return shards
+
+    def shard_of(self, user_id):
+        return self.shards_of([user_id])[user_id]
+
+    def by_shard(self, user_ids):
+        """{shard name: [user ids on it]}."""
+
+        grouped = defaultdict(list)
+        for user_id, shard in self.shards_of(user_ids).items():
+            grouped[shard].append(user_id)
+        return grouped
+
+    def assign(self, user_id):
+        """Place a new user on a shard, in the current transaction."""
+
+        if self.enabled:
+            db.session.add(UserShard(user_id=user_id,
+                                     shard=self.ring.shard_for(user_id)))
+
+    def _writable_shard(self, user_id):
+        entry = db.session.get(UserShard, user_id)
+
+        if entry is None:
+            return MAIN
+        if entry.moving_since is not None:
+            raise ShardMoving(user_id)
+        return entry.shard
+
+    # Writes: on main they join the current transaction; elsewhere they
+    # commit straight away.
+
+    def _next_message_id(self):
+        if db.engine.dialect.name == "postgresql":
+            return db.session.execute(text(
+                "SELECT nextval(pg_get_serial_sequence('messages', 'id'))"
+            )).scalar()
+
+        # Start above every message from before sharding
+        if db.session.query(MessageId.id).first() is None:
+            db.session.add(MessageId(id=max(
+                (self.session(name).query(func.max(Message.id)).scalar() or 0
+                 for name in self.names))))
+
+        message_id = MessageId()
+        db.session.add(message_id)
+        db.session.flush()
+        MessageId.query.filter(MessageId.id < message_id.id).delete()
+
+        return message_id.id
+
+    def allocate_message_ids(self, count):
+        """`count` new message ids, for bulk inserts that set ids themselves."""
+
+        if db.engine.dialect.name == "postgresql":
+            return list(db.session.execute(text(
+                "SELECT nextval(pg_get_serial_sequence('messages', 'id')) "
+                "FROM generate_series(1, :count)"), {"count": count}).scalars())
+
+        if self.enabled:
+            return [self._next_message_id() for _ in range(count)]
+
+        # SQLite (development): one writer at a time
+        start = (db.session.query(func.max(Message.id)).scalar() or 0) + 1
+        return list(range(start, start + count))
+
+    def add_message(self, user_id, text):
+        """Store a new message on its author's shard. Returns its id."""
+
+        shard = self._writable_shard(user_id)
+        message_id = self._next_message_id()
+
+        session = self.session(shard)
+        session.add(Message(id=message_id, text=text, user_id=user_id))
+        if shard != MAIN:
+            session.commit()
+
+        return message_id
+
+    def delete_message(self, user_id, message_id):
+        """Tombstone one of `user_id`'s messages. Returns whether it was."""
+
+        shard = self._writable_shard(user_id)
+        session = self.session(shard)
+
+        deleted = (session
+                   .query(Message)
+                   .filter(Message.id == message_id,
+                           Message.user_id == user_id,
+                           Message.deleted_at.is_(None))
+                   .update({"deleted_at": datetime.utcnow()},
+                           synchronize_session=False))
+        if shard != MAIN:
+            session.commit()
+
+        return bool(deleted)
+
+    def toggle_like(self, user_id, message_id):
+        """Like or unlike a message, on its author's shard.
+
+        Returns whether it's now liked, or None if there's no such message.
+        Users can't like their own messages.
+        """
+
+        message = self.find_message(message_id)
+        if message is None:
+            return None
+
+        author_id = message[3]
+        if author_id == user_id:
+            return False
+
+        shard = self._writable_shard(author_id)
+        session = self.session(shard)
+
+        like = session.get(Like, (user_id, message_id))
+        if like:
+            session.delete(like)
+        else:
+            session.add(Like(user_liking_id=user_id,
+                             liked_message_id=message_id))
+        Message.count_likes({message_id: -1 if like else 1}, session)
+        if shard != MAIN:
+            session.commit()
+
+        return like is None
+
+    # Reads
+
+    def feed_rows(self, author_ids, order_by=Message.timestamp,
+                  since_id=None, before=None, limit=None):
+        """Feed rows by `author_ids` from all their shards, newest first.
+
+        Newest by `order_by` (Message.timestamp or Message.id); only
+        messages after `since_id` if given, or older than `before` (a
+        (timestamp, id), with Message.timestamp); at most `limit` rows.
+        """
+
+        authors = visible_authors(author_ids)
+        if not authors:
+            return []
+
+        key = itemgetter(0) if order_by is Message.id else itemgetter(2, 0)
+        per_shard = []
+
+        for shard, shard_author_ids in self.by_shard(authors).items():
+            query = (self.session(shard)
+                     .query(*FEED_COLUMNS)
+                     .filter(*visible_criteria({
+                         author_id: authors[author_id]
+                         for author_id in shard_author_ids}))
+                     .order_by(order_by.desc(), Message.id.desc()))
+            if since_id is not None:
+                query = query.filter(Message.id > since_id)
+            if before is not None:
+                query = query.filter(*older_than(before))
+            if limit:
+                query = query.limit(limit)
+
+            per_shard.append([tuple(row) for row in query])
+
+        return list(islice(merge(*per_shard, key=key, reverse=True), limit))
+
+    def find_message(self, message_id):
+        """Feed row for a visible message, wherever it is, or None.
+
+        Only a row on its author's shard counts: another shard may still
+        have a stale copy from an interrupted move.
+        """
+
+        for shard in self.names:
+            row = (self.session(shard)
+                   .query(*FEED_COLUMNS)
+                   .filter(Message.id == message_id,
+                           Message.deleted_at.is_(None))
+                   .first())
+            if row is None or self.shard_of(row.user_id) != shard:
+                continue
+
+            authors = visible_authors([row.user_id])
+            if row.user_id not in authors:
+                return None
+
+            deleted_before = authors[row.user_id]
+            if deleted_before is not None and row.timestamp <= deleted_before:
+                return None
+
+            return tuple(row)
+
+        return None
+
+    def rows_by_id(self, message_authors):
+        """Feed rows of the visible messages among {message id: author id},
+        each read from its author's shard. In no particular order.
+        """
+
+        authors = visible_authors(set(message_authors.values()))
+        rows = []
+
+        for shard, shard_author_ids in self.by_shard(authors).items():
+            shard_author_ids = set(shard_author_ids)
+            rows.extend(tuple(row) for row in (
+                self.session(shard)
+                .query(*FEED_COLUMNS)
+                .filter(Message.id.in_([
+                            message_id for message_id, author_id
+                            in message_authors.items()
+                            if author_id in shard_author_ids]),
+                        *visible_criteria({
+                            author_id: authors[author_id]
+                            for author_id in shard_author_ids}))))
+
+        return rows
+
+    def count_messages(self, user_ids):
+        """{user id: number of visible messages}."""
+
+        authors = visible_authors(user_ids)
+        counts = dict.fromkeys(user_ids, 0)
+
+        for shard, shard_author_ids in self.by_shard(authors).items():
+            counts.update(self.session(shard)
+                          .query(Message.user_id, func.count())
+                          .filter(*visible_criteria({
+                              author_id: authors[author_id]
+                              for author_id in shard_author_ids}))
+                          .group_by(Message.user_id))
+
+        return counts
+
+    def liked_ids_among(self, user_id, message_ids):
+        """The `message_ids` that `user_id` has liked, from every shard
+        (each message's likes as its author's shard has them)."""
+
+        message_ids = list(message_ids)
+        liked = []
+
+        for shard in self.names:
+            liked.extend(
+                (shard, message_id, author_id)
+                for message_id, author_id in (
+                    self.session(shard)
+                    .query(Like.liked_message_id, Message.user_id)
+                    .join(Message, Message.id == Like.liked_message_id)
+                    .filter(Like.user_liking_id == user_id,
+                            Like.liked_message_id.in_(message_ids))))
+
+        return {message_id
+                for _, message_id, _ in self.on_author_shards(liked)}
+
+    def on_author_shards(self, rows):
+        """Those of (shard, message id, author id, ...) rows read from
+        their author's shard, not from a stale copy elsewhere."""
+
+        authors = self.shards_of({row[2] for row in rows})
+
+        return [row for row in rows if authors[row[2]] == row[0]]
+
+    # Resharding
+
+    def move_user(self, user_id, target, settle_seconds=MOVE_SETTLE_SECONDS):
+        """Move one user's messages and their likes to shard `target`."""
+
+        return self.move_users({user_id: target}, settle_seconds)
+
+    def move_users(self, targets, settle_seconds=MOVE_SETTLE_SECONDS):
+        """Move users' messages (and their likes) to new shards.
+
+        `targets` is {user id: shard name}. Their writes are refused (with
+        ShardMoving) while they're moved; reads keep going to the old shard
+        until the copy is complete, then switch. Safe to run again if
+        interrupted (see finish_moves()). Returns the number of messages
+        moved.
+        """
+
+        self.finish_moves()
+
+        sources = self.shards_of(targets)
+        targets = {user_id: target for user_id, target in targets.items()
+                   if sources[user_id] != target}
+        if not targets:
+            return 0
+
+        entries = {entry.user_id: entry for entry in (
+            UserShard.query.filter(UserShard.user_id.in_(targets)))}
+
+        for user_id in targets:
+            entry = entries.get(user_id)
+            if entry is None:
+                entry = entries[user_id] = UserShard(user_id=user_id,
+                                                     shard=sources[user_id])
+                db.session.add(entry)
+            entry.moving_since = datetime.utcnow()
+        db.session.commit()
+
+        time.sleep(settle_seconds)
+
+        moved = 0
+
+        for user_id, target in targets.items():
+            source = self.session(sources[user_id])
+            destination = self.session(target)
+
+            # Clear out anything left by an interrupted move
+            self._delete_messages(destination, user_id)
+            moved += self._copy_messages(source, destination, user_id)
+            destination.commit()
+
+            entry = entries[user_id]
+            entry.shard = target
+            entry.moving_since = None
+            entry.moved_from = sources[user_id]
+            invalidation_bus.publish(f"user:{user_id}")
+            db.session.commit()
+
+            self._delete_messages(source, user_id)
+            source.commit()
+
+            entry.moved_from = None
+            db.session.commit()
+
+        return moved
+
+    def finish_moves(self):
+        """Delete the copies an interrupted move left on users' old shards.
+
+        Reads ignore them meanwhile: they only take a user's messages
+        from the shard the directory says. Returns the number of users.
+        """
+
+        entries = (UserShard.query
+                   .filter(UserShard.moved_from.isnot(None),
+                           UserShard.moving_since.is_(None))
+                   .all())
+
+        for entry in entries:
+            if entry.moved_from != entry.shard:
+                source = self.session(entry.moved_from)
+                self._delete_messages(source, entry.user_id)
+                source.commit()
+
+            entry.moved_from = None
+            db.session.commit()
+
+        return len(entries)
+
+    def rebalance(self, settle_seconds=MOVE_SETTLE_SECONDS):
+        """Move every user the ring places on a different shard.
+
+        Returns the number of users moved.
+        """
+
+        self.finish_moves()
+
+        current = self.shards_of(
+            user_id for user_id, in db.session.query(User.id))
+        targets = {user_id: self.ring.shard_for(user_id)
+                   for user_id, shard in current.items()
+                   if shard != self.ring.shard_for(user_id)}
+
+        user_ids = sorted(targets)
+        for start in range(0, len(user_ids), MOVE_USERS_BATCH_SIZE):
+            batch = user_ids[start:start + MOVE_USERS_BATCH_SIZE]
+            self.move_users({user_id: targets[user_id] for user_id in batch},
+                            settle_seconds)
+
+        return len(targets)
+
+    @staticmethod
+    def _copy_messages(source, destination, user_id):
+        messages_table, likes_table = Message.__table__, Like.__table__
+        after_id = 0
+        copied = 0
+
+        while True:
+            messages = [dict(row._mapping) for row in source.execute(
+                select(messages_table)
+                .where(messages_table.c.user_id == user_id,
+                       messages_table.c.id > after_id)
+                .order_by(messages_table.c.id)
+                .limit(MOVE_BATCH_SIZE))]
+            if not messages:
+                return copied
+
+            message_ids = [message["id"] for message in messages]
+            likes = [dict(row._mapping) for row in source.execute(
+                select(likes_table)
+                .where(likes_table.c.liked_message_id.in_(message_ids)))]
+
+            destination.execute(messages_table.insert(), messages)
+            if likes:
+                destination.execute(likes_table.insert(), likes)
+
+            copied += len(messages)
+            after_id = message_ids[-1]
+
+    @staticmethod
+    def _delete_messages(session, user_id):
+        messages_table, likes_table = Message.__table__, Like.__table__
+        message_ids = (select(messages_table.c.id)
+                       .where(messages_table.c.user_id == user_id))
+
+        session.execute(likes_table.delete()
+                        .where(likes_table.c.liked_message_id.in_(message_ids)))
+        session.execute(messages_table.delete()
+                        .where(messages_table.c.user_id == user_id))
+
+
+shards = ShardRouter()
@@ -0,0 +1,321 @@
+"""Single-flight caching for expensive page builds.
+
+single_flight.get(key, build) returns a cached value for `key`, building
+it with build() when there is none. However many requests miss on the
+same key at once, build() runs once:
+
+- within a process, later callers wait for the first caller's build;
+- across the workers on a host, the builder holds a flock on a lock file
+  for the key (in SINGLE_FLIGHT_DIR), and the other workers wait for it
+  and then read what it stored.
+
+Entries are fresh for `fresh_for` seconds, then stale for `stale_for`
+more. A stale entry is still returned straight away, and one background
+thread (host-wide) rebuilds it. Only a missing or fully expired entry
+makes a request wait.
+
+With SINGLE_FLIGHT_DIR set, values are pickled to files there, so all
+workers on the host share them (best put on tmpfs such as /dev/shm).
+Without it, values are kept in this process only.
+
+stats counts hits, misses and coalesced waits for this process; GET
+/metrics reports them.
+"""
+
+import fcntl
+import hashlib
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future, ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+FRESH_SECONDS = 5
+STALE_SECONDS = 60
+
+# Entries are dropped once this old, whatever their expiry; checked at
+# most every PRUNE_INTERVAL_SECONDS
+MAX_AGE_SECONDS = 60 * 60
+PRUNE_INTERVAL_SECONDS = 60
+
+# How long to wait for another worker's build before building anyway
+WAIT_SECONDS = 10
+LOCK_POLL_SECONDS = 0.01
+
+
+class SingleFlight:
+    """Cache whose misses are built once, however many callers miss."""
+
+    def __init__(self):
+        self.app = None
+        self.path = None
+        self.stats = Counter()
+
+        self._entries = {}
+        self._in_flight = {}
+        self._refreshing = set()
+        self._pruned_at = time.time()
+        self._lock = threading.Lock()
+        self._refresh_pool = ThreadPoolExecutor(
+            max_workers=2, thread_name_prefix="single-flight")
+
+    def init_app(self, app):
+        """Use app.config['SINGLE_FLIGHT_DIR'] (if set) to share entries."""
+
+        self.app = app
+        self.path = app.config.get('SINGLE_FLIGHT_DIR')
+
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+
+    def get(self, key, build, fresh_for=FRESH_SECONDS, stale_for=STALE_SECONDS):
+        """Cached value for `key`, built with build() if needed."""
+
+        entry = self._read(key)
+
+        if entry is not None:
+            built_at, value = entry
+            age = time.time() - built_at
+
+            if age < fresh_for:
+                self.stats["hits"] += 1
+                return value
+
+            if age < fresh_for + stale_for:
+                self.stats["stale_hits"] += 1
+                self._refresh_in_background(key, build)
+                return value
+
+        return self._build_once(key, build, fresh_for)
+
+    def invalidate(self, *keys):
+        """Drop the entries for `keys`, so they're rebuilt on next use."""
+
+        for key in keys:
+            self._entries.pop(key, None)
+
+            if self.path:
+                try:
+                    os.remove(self._file(key))
+                except FileNotFoundError:
+                    pass
+
+    def clear(self):
+        """Drop every entry and reset stats."""
+
+        self.invalidate_all()
+        self.stats.clear()
+
+    def invalidate_all(self):
+        """Drop every entry."""
+
+        self._entries.clear()
+
+        if self.path:
+            for name in os.listdir(self.path):
+                if name.endswith(".pickle"):
+                    os.remove(os.path.join(self.path, name))
+
+    # Building
+
+    def _build_once(self, key, build, fresh_for):
+        """Build `key`, or wait for whoever is already building it."""
+
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+
+        if not leader:
+            return self._wait(future)
+
+        try:
+            value = self._build_exclusively(key, build, fresh_for)
+        except BaseException as error:
+            future.set_exception(error)
+            raise
+        else:
+            future.set_result(value)
+            return value
+        finally:
+            with self._lock:
+                self._in_flight.pop(key, None)
+
+    def _wait(self, future):
+        start = time.monotonic()
+        try:
+            return future.result()
+        finally:
+            self._count_wait(start)
+
+    def _count_wait(self, start):
+        waited_ms = int((time.monotonic() - start) * 1000)
+        self.stats["coalesced_waits"] += 1
+        self.stats["coalesced_wait_ms"] += waited_ms
+        self.stats["max_coalesced_wait_ms"] = max(
+            self.stats["max_coalesced_wait_ms"], waited_ms)
+
+    def _build_exclusively(self, key, build, fresh_for):
+        """Build under the host-wide lock for `key`.
+
+        If another worker built it while we waited for the lock, use theirs.
+        """
+
+        start = time.monotonic()
+
+        with self._file_lock(key, wait=True) as waited:
+            if waited:
+                entry = self._read(key)
+                if entry is not None and time.time() - entry[0] < fresh_for:
+                    self._count_wait(start)
+                    return entry[1]
+
+            return self._build(key, build)
+
+    def _build(self, key, build):
+        self.stats["misses"] += 1
+        value = build()
+        self._write(key, value)
+        return value
+
+    def _refresh_in_background(self, key, build):
+        """Rebuild a stale `key` in a background thread, once host-wide."""
+
+        with self._lock:
+            if key in self._in_flight or key in self._refreshing:
+                return
+            self._refreshing.add(key)
+
+        def refresh():
+            try:
+                with self.app.app_context(), \
+                        self._file_lock(key, wait=False) as locked:
+                    # Someone else (another worker) is already on it
+                    if locked is None:
+                        return
+
+                    self.stats["refreshes"] += 1
+                    self._build(key, build)
+
+            except Exception:
+                self.stats["refresh_errors"] += 1
+                logger.exception("refreshing %s failed", key)
+
+            finally:
+                with self._lock:
+                    self._refreshing.discard(key)
+
+        self._refresh_pool.submit(refresh)
+
+    # Storage
+
+    def _file(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return os.path.join(self.path, f"{digest}.pickle")
+
+    def _read(self, key):
+        """(built at, value) for `key`, or None."""
+
+        if not self.path:
+            return self._entries.get(key)
+
+        try:
+            with open(self._file(key), "rb") as f:
+                return pickle.load(f)
+        except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+            return None
+
+    def _write(self, key, value):
+        entry = (time.time(), value)
+
+        if entry[0] - self._pruned_at > PRUNE_INTERVAL_SECONDS:
+            self._prune(entry[0])
+
+        if not self.path:
+            self._entries[key] = entry
+            return
+
+        path = self._file(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(entry, f, pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, path)
+
+    def _prune(self, now):
+        """Drop entries older than MAX_AGE_SECONDS."""
+
+        self._pruned_at = now
+
+        for key, (built_at, _) in list(self._entries.items()):
+            if now - built_at > MAX_AGE_SECONDS:
+                self._entries.pop(key, None)
+
+        if self.path:
+            for entry in os.scandir(self.path):
+                try:
+                    if now - entry.stat().st_mtime > MAX_AGE_SECONDS:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _file_lock(self, key, wait):
+        return _FileLock(self._file(key) + ".lock" if self.path else None,
+                         wait)
+
+
+class _FileLock:
+    """flock on a lock file, for `with` (a no-op without a path).
+
+    Gives True if it had to wait for another process, False if not, and
+    None if `wait` is false and another process holds it.
+    """
+
+    def __init__(self, path, wait):
+        self.path = path
+        self.wait = wait
+        self.fd = None
+
+    def __enter__(self):
+        if self.path is None:
+            return False
+
+        self.fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+
+        try:
+            fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return False
+        except BlockingIOError:
+            pass
+
+        if not self.wait:
+            os.close(self.fd)
+            self.fd = None
+            return None
+
+        deadline = time.monotonic() + WAIT_SECONDS
+        while time.monotonic() < deadline:
+            time.sleep(LOCK_POLL_SECONDS)
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except BlockingIOError:
+                pass
+
+        # The other builder is stuck: build anyway, unlocked
+        os.close(self.fd)
+        self.fd = None
+        return True
+
+    def __exit__(self, *exc_info):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+
+single_flight = SingleFlight()
@@ -0,0 +1,55 @@
+// Signup form: say whether the username and email typed so far are free,
+// from /users/available (answered by the server's existence filter, so
+// it's cheap to ask as the user types).
+
+(function () {
+  "use strict";
+
+  var DEBOUNCE_MS = 300;
+
+  var form = document.getElementById("user_form");
+  if (!form || !form.dataset.availableUrl) {
+    return;
+  }
+
+  ["username", "email"].forEach(function (field) {
+    var input = form.elements[field];
+    if (!input) {
+      return;
+    }
+
+    var note = document.createElement("small");
+    input.insertAdjacentElement("afterend", note);
+    var timer = null;
+
+    function check() {
+      var value = input.value.trim();
+      if (!value) {
+        note.textContent = "";
+        return;
+      }
+
+      fetch(form.dataset.availableUrl + "?" + field + "="
+            + encodeURIComponent(value), {
+        credentials: "same-origin",
+        headers: {"Accept": "application/json"},
+      })
+        .then(function (response) { return response.ok ? response.json() : null; })
+        .then(function (available) {
+          // Only if it's still what's typed
+          if (!available || input.value.trim() !== value) {
+            return;
+          }
+          note.className = available[field] ? "text-success" : "text-danger";
+          note.textContent = available[field]
+            ? "Available" : "Already taken";
+        })
+        .catch(function () {});
+    }
+
+    input.addEventListener("input", function () {
+      clearTimeout(timer);
+      timer = setTimeout(check, DEBOUNCE_MS);
+    });
+  });
+})();
@@ -0,0 +1,72 @@
+// Live timeline: new messages from /timeline/stream (Server-Sent Events),
+// or by polling /timeline?since_id= where EventSource isn't available or
+// the server has no room for another stream.
+
+(function () {
+  "use strict";
+
+  var POLL_MS = 30000;
+
+  var list = document.getElementById("messages");
+  if (!list || !list.dataset.streamUrl) {
+    return;
+  }
+
+  var head = Number(list.dataset.head) || 0;
+  var polling = null;
+
+  function addMessages(payload) {
+    if (payload.head <= head) {
+      return;
+    }
+    head = payload.head;
+    list.insertAdjacentHTML("afterbegin", payload.html);
+  }
+
+  function poll() {
+    fetch(list.dataset.pollUrl + "?since_id=" + head, {
+      credentials: "same-origin",
+      headers: {"Accept": "application/json"},
+    })
+      .then(function (response) { return response.ok ? response.json() : null; })
+      .then(function (payload) { if (payload) { addMessages(payload); } })
+      .catch(function () {});
+  }
+
+  function startPolling() {
+    if (polling === null) {
+      polling = setInterval(poll, POLL_MS);
+    }
+  }
+
+  function stopPolling() {
+    if (polling !== null) {
+      clearInterval(polling);
+      polling = null;
+    }
+  }
+
+  function connect() {
+    var stream = new EventSource(list.dataset.streamUrl + "?since_id=" + head);
+
+    stream.addEventListener("open", stopPolling);
+
+    stream.addEventListener("messages", function (event) {
+      addMessages(JSON.parse(event.data));
+    });
+
+    // Sent instead of a stream when the server is full or busy: poll for
+    // a while, then try streaming again from wherever polling got to
+    stream.addEventListener("busy", function (event) {
+      stream.close();
+      startPolling();
+      setTimeout(connect, Number(event.data) || POLL_MS);
+    });
+  }
+
+  if (window.EventSource) {
+    connect();
+  } else {
+    startPolling();
+  }
+})();
@@ -0,0 +1,124 @@
+"""Streamed template responses for the feed pages.
+
+render_template() builds the whole page before sending anything.
+stream_template() sends it as it renders instead: everything up to a
+{{ flush() }} in the template goes out straight away (the layout and the
+aside), then the rest in STREAM_BUFFER_BYTES pieces as the message loop
+produces them. If the browser accepts gzip, each piece is compressed and
+sync-flushed on its own so it's still sent immediately.
+
+A feed page's rows (at most TIMELINE_LENGTH) come from the single-flight
+cache or one query before the response starts. Their authors and like
+state are only looked up as the template reaches them, a batch at a time
+(see feed_batches), after the top of the page has gone out.
+"""
+
+import zlib
+
+from flask import (
+    Response, current_app, get_flashed_messages, request,
+    stream_with_context)
+from markupsafe import Markup
+
+from read_models import load_like_summaries
+
+STREAM_BUFFER_BYTES = 16 * 1024
+
+# Messages whose like state is looked up per round trip
+FEED_BATCH_SIZE = 50
+
+FLUSH_MARKER = Markup("<!-- flush -->")
+
+
+def flush():
+    """Jinja global: send everything rendered so far."""
+
+    return FLUSH_MARKER
+
+
+def _buffered(chunks):
+    """Join template output into pieces, cut at flush markers and size."""
+
+    buffer = []
+    size = 0
+
+    for chunk in chunks:
+        buffer.append(chunk)
+        size += len(chunk)
+
+        if FLUSH_MARKER in chunk or size >= STREAM_BUFFER_BYTES:
+            yield "".join(buffer).encode("utf-8")
+            buffer = []
+            size = 0
+
+    if buffer:
+        yield "".join(buffer).encode("utf-8")
+
+
+def _gzipped(pieces):
+    """gzip a stream of byte strings, flushing after each one."""
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+
+    for piece in pieces:
+        yield compressor.compress(piece) + compressor.flush(zlib.Z_SYNC_FLUSH)
+
+    yield compressor.flush()
+
+
+def stream_template(template_name, **context):
+    """Like render_template, but sends the page while it renders."""
+
+    app = current_app._get_current_object()
+    app.update_template_context(context)
+
+    # The session is saved before the body is generated, so pop the flashed
+    # messages now (the template's get_flashed_messages() gets this list)
+    get_flashed_messages(with_categories=True)
+
+    template = app.jinja_env.get_template(template_name)
+    body = _buffered(template.generate(**context))
+
+    response = Response(mimetype="text/html")
+    response.vary.add("Accept-Encoding")
+
+    if request.accept_encodings["gzip"]:
+        body = _gzipped(body)
+        response.content_encoding = "gzip"
+
+    response.response = stream_with_context(body)
+    return response
+
+
+def feed_batches(messages, liked_ids, like_summaries, user,
+                 batch_size=FEED_BATCH_SIZE):
+    """Hand `messages` to the template a batch at a time.
+
+    `messages` should be lazy (read_models.feed_messages_from_rows), so
+    their authors are looked up as they're reached too. Before each batch
+    is handed on, the ids of the messages in it that `user` liked are
+    added to the `liked_ids` set, and their like counts and likers to the
+    `like_summaries` dict, so like state is still a few queries per batch
+    rather than per message.
+    """
+
+    batch = []
+
+    for message in messages:
+        batch.append(message)
+
+        if len(batch) == batch_size:
+            yield from _with_likes(batch, liked_ids, like_summaries, user)
+            batch = []
+
+    yield from _with_likes(batch, liked_ids, like_summaries, user)
+
+
+def _with_likes(batch, liked_ids, like_summaries, user):
+    if batch:
+        like_summaries.update(load_like_summaries(msg.id for msg in batch))
+
+    if user and batch:
+        liked_ids.update(user.liked_ids_among(msg.id for msg in batch))
+
+    return batch
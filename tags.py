@@ -0,0 +1,199 @@
+"""Hashtags and mentions, indexed in side tables.
+
+When a message is posted, the #tags and @usernames in its text are
+stored in `message_tags` (tag, message id) and `mentions` (mentioned user
+id, message id), next to the message's author. /tags/<tag> and
+/users/<id>/mentions page through those primary keys newest first
+(message ids only grow), then read just the messages on the page by id,
+so neither ever scans message text.
+
+Pages are cursor paginated on message id: each page links to the next
+with ?before=<the last id read from the index>. Deleted messages are
+dropped after the index is read, so a page can come out a little short.
+
+Messages posted before this existed are indexed by the index_tags job
+(`flask index-tags`), which reads them in id order a batch at a time.
+"""
+
+import logging
+import re
+
+from markupsafe import Markup, escape
+
+from jobs import job_handler, report_progress
+from models import (
+    db, insert_ignoring_duplicates, Mention, Message, MessageTag, User)
+from read_models import FEED_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+HASHTAG = re.compile(r"(?<![\w#])#(\w{1,50})")
+MENTION = re.compile(r"(?<![\w@])@(\w{1,50})")
+
+# Messages per page of a tag or mentions feed
+TAG_PAGE_SIZE = 50
+
+# Messages read (and indexed) per transaction by the index_tags job
+INDEX_BATCH_SIZE = 500
+
+
+def extract_tags(text):
+    """The hashtags in `text`, lowercased, without the '#'."""
+
+    return {tag.lower() for tag in HASHTAG.findall(text)}
+
+
+def extract_mentions(text):
+    """The usernames @mentioned in `text`."""
+
+    return set(MENTION.findall(text))
+
+
+def link_tags(text):
+    """Jinja filter: `text`, escaped, with its hashtags linked."""
+
+    parts = []
+    start = 0
+
+    for match in HASHTAG.finditer(text):
+        parts.append(escape(text[start:match.start()]))
+        parts.append(Markup('<a href="/tags/{}">#{}</a>').format(
+            match[1].lower(), match[1]))
+        start = match.end()
+
+    parts.append(escape(text[start:]))
+    return Markup("").join(parts)
+
+
+def index_messages(messages):
+    """Index the tags and mentions of (id, text, author id) `messages`.
+
+    Rows are added to the current transaction; indexing a message again
+    is harmless. Mentions are resolved in one query for all `messages`.
+    """
+
+    messages = list(messages)
+
+    tag_rows = [{"tag": tag, "message_id": message_id, "user_id": user_id}
+                for message_id, text, user_id in messages
+                for tag in extract_tags(text)]
+
+    mentioned = {message_id: extract_mentions(text)
+                 for message_id, text, _ in messages}
+    usernames = set().union(*mentioned.values())
+    user_ids = dict(db.session
+                    .query(User.username, User.id)
+                    .filter(User.username.in_(usernames),
+                            User.deleted_at.is_(None))) if usernames else {}
+
+    mention_rows = [{"user_id": user_ids[username], "message_id": message_id,
+                     "author_id": user_id}
+                    for message_id, _, user_id in messages
+                    for username in mentioned[message_id]
+                    if username in user_ids]
+
+    if tag_rows:
+        insert_ignoring_duplicates(MessageTag, tag_rows)
+    if mention_rows:
+        insert_ignoring_duplicates(Mention, mention_rows)
+
+
+def index_message(message_id, text, user_id):
+    """Index one new message's tags and mentions."""
+
+    index_messages([(message_id, text, user_id)])
+
+
+def tag_page(tag, before_id=None, limit=TAG_PAGE_SIZE):
+    """Feed rows of messages tagged `tag`, newest first.
+
+    Returns (rows, next_before_id); next_before_id is None on the last
+    page.
+    """
+
+    query = (db.session
+             .query(MessageTag.message_id, MessageTag.user_id)
+             .filter(MessageTag.tag == tag.lower()))
+    if before_id is not None:
+        query = query.filter(MessageTag.message_id < before_id)
+
+    return _page(query.order_by(MessageTag.message_id.desc()).limit(limit),
+                 limit)
+
+
+def mentions_page(user_id, before_id=None, limit=TAG_PAGE_SIZE):
+    """Feed rows of messages mentioning `user_id`, newest first.
+
+    See tag_page.
+    """
+
+    query = (db.session
+             .query(Mention.message_id, Mention.author_id)
+             .filter(Mention.user_id == user_id))
+    if before_id is not None:
+        query = query.filter(Mention.message_id < before_id)
+
+    return _page(query.order_by(Mention.message_id.desc()).limit(limit),
+                 limit)
+
+
+def _page(index_query, limit):
+    from shards import shards
+
+    message_authors = dict(index_query.all())
+    if not message_authors:
+        return [], None
+
+    if shards.enabled:
+        rows = shards.rows_by_id(message_authors)
+    else:
+        rows = [tuple(row) for row in (Message.visible()
+                                       .with_entities(*FEED_COLUMNS)
+                                       .filter(Message.id.in_(
+                                           message_authors)))]
+
+    rows.sort(reverse=True)
+    next_before_id = (min(message_authors)
+                      if len(message_authors) == limit else None)
+
+    return rows, next_before_id
+
+
+@job_handler("index_tags")
+def index_tags(batch_size=INDEX_BATCH_SIZE):
+    """Index the tags and mentions of every existing message.
+
+    Reads each database's messages in id order, `batch_size` at a time,
+    committing after each batch. Returns the number of messages read.
+    """
+
+    from shards import shards
+
+    total = 0
+
+    for shard in shards.names:
+        session = shards.session(shard)
+        after_id = 0
+
+        while True:
+            batch = [tuple(row) for row in (session
+                                            .query(Message.id,
+                                                   Message.text,
+                                                   Message.user_id)
+                                            .filter(Message.id > after_id,
+                                                    Message.deleted_at.is_(None))
+                                            .order_by(Message.id)
+                                            .limit(batch_size))]
+            if not batch:
+                break
+
+            index_messages(batch)
+            db.session.commit()
+
+            total += len(batch)
+            after_id = batch[-1][0]
+            report_progress({"shard": shard, "after_id": after_id,
+                             "messages": total})
+
+    logger.info("indexed tags of %s messages", total)
+    return total
@@ -0,0 +1,151 @@
+"""Analytics snapshot and stats tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_analytics.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+import numpy as np
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from analytics import (
+    current_snapshot, daily_active_posters, follower_distribution,
+    hourly_volume, like_ratios, snapshot_analytics, stats)
+from models import db, Follows, Job, Like, Message, User
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class AnalyticsTestCase(TestCase):
+    """Test snapshotting tables to columns and the stats over them."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.analytics_dir = tempfile.TemporaryDirectory()
+        app.config['ANALYTICS_DIR'] = self.analytics_dir.name
+
+        for user_id in (1, 2, 3, 4):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.commit()
+        db.session.get(User, 4).deleted_at = datetime.utcnow()
+
+        # Midday, so the day and hour buckets don't depend on when this runs
+        now = self.now = datetime.utcnow().replace(
+            hour=12, minute=30, second=0, microsecond=0)
+        db.session.add_all([
+            Message(id=1, text="a", user_id=1, timestamp=now, like_count=2),
+            Message(id=2, text="b", user_id=1, timestamp=now),
+            Message(id=3, text="c", user_id=2, timestamp=now, like_count=1),
+            Message(id=4, text="d", user_id=2,
+                    timestamp=now - timedelta(days=1, hours=1)),
+            Message(id=5, text="e", user_id=3,
+                    timestamp=now - timedelta(days=40)),
+            Message(id=6, text="gone", user_id=3, timestamp=now,
+                    deleted_at=now),
+            Like(user_liking_id=2, liked_message_id=1),
+            Like(user_liking_id=3, liked_message_id=1),
+            Like(user_liking_id=1, liked_message_id=3),
+            Follows(user_being_followed_id=1, user_following_id=2),
+            Follows(user_being_followed_id=1, user_following_id=3),
+            Follows(user_being_followed_id=2, user_following_id=3),
+            Follows(user_being_followed_id=1, user_following_id=4),
+        ])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.analytics_dir.cleanup()
+
+    def test_snapshot(self):
+        """Are the tables written as memory-mapped columns"""
+
+        snapshot_analytics(self.analytics_dir.name, chunk_size=2)
+        snapshot = current_snapshot(self.analytics_dir.name)
+
+        self.assertEqual(sorted(snapshot.column("users", "id")), [1, 2, 3])
+        self.assertEqual(sorted(snapshot.column("messages", "id")),
+                         [1, 2, 3, 4, 5])
+        self.assertIsInstance(snapshot.column("messages", "user_id"),
+                              np.memmap)
+        self.assertEqual(snapshot.rows("likes"), 3)
+
+        self.assertEqual(
+            Job.query.filter_by(name="snapshot_analytics").count(), 1)
+
+    def test_stats(self):
+        """Are the stats computed from the snapshot, not the database"""
+
+        snapshot_analytics(self.analytics_dir.name)
+        Message.query.delete()
+        db.session.commit()
+
+        snapshot = current_snapshot(self.analytics_dir.name)
+        snapshot.taken_at = self.now
+
+        self.assertEqual([posters for _, posters in
+                          daily_active_posters(snapshot)[-2:]], [1, 2])
+        volume = hourly_volume(snapshot)
+        self.assertEqual(sum(messages for _, messages in volume), 4)
+        self.assertEqual(volume[-1], (f"{self.now:%Y-%m-%dT%H}", 3))
+
+        # user 4 is deleted, so their follow doesn't count
+        followers = follower_distribution(snapshot)
+        self.assertEqual(followers["follows"], 3)
+        self.assertEqual(followers["buckets"],
+                         [("0", 1), ("1", 1), ("2-3", 1)])
+        self.assertEqual(followers["percentiles"]["max"], 2)
+
+        likes = like_ratios(snapshot)
+        self.assertAlmostEqual(likes["likes_per_message"], 3 / 5)
+        self.assertAlmostEqual(likes["liked_share"], 2 / 5)
+        self.assertEqual(likes["median_likes_when_liked"], 1.5)
+        self.assertAlmostEqual(likes["liker_share"], 1)
+
+        self.assertEqual(stats(self.analytics_dir.name)["rows"]["messages"], 5)
+
+    def test_old_snapshots(self):
+        """Are only the newest snapshots kept"""
+
+        self.assertIsNone(stats(self.analytics_dir.name))
+
+        paths = [snapshot_analytics(self.analytics_dir.name) for _ in range(3)]
+        kept = [path for path in paths if os.path.exists(path)]
+
+        self.assertEqual(len(set(kept)), min(len(set(paths)), 2))
+        self.assertEqual(current_snapshot(self.analytics_dir.name).path,
+                         paths[-1])
+
+    def test_admin_page(self):
+        """Can only admins see the stats page"""
+
+        snapshot_analytics(self.analytics_dir.name)
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 1
+
+        response = client.get('/admin/stats')
+        self.assertEqual(response.status_code, 302)
+
+        app.config['ADMIN_USER_IDS'] = {1}
+        try:
+            html = client.get('/admin/stats').get_data(as_text=True)
+        finally:
+            app.config['ADMIN_USER_IDS'] = set()
+
+        self.assertIn("Daily active posters", html)
+        self.assertIn("5 messages", html)
@@ -0,0 +1,76 @@
+"""Static asset pipeline tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_assets.py
+
+
+import gzip
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import assets
+
+
+class AssetTestCase(TestCase):
+    """Test building and serving fingerprinted assets."""
+
+    def setUp(self):
+        """Build a copy of static/ in a temp folder."""
+
+        self.static_folder = os.path.join(tempfile.mkdtemp(), 'static')
+        shutil.copytree(app.static_folder, self.static_folder,
+                        ignore=shutil.ignore_patterns(assets.BUILD_DIR_NAME))
+
+        assets.build_assets(self.static_folder)
+        assets.load_manifest(self.static_folder)
+
+        self.original_static_folder = app.static_folder
+        app.static_folder = self.static_folder
+        self.client = app.test_client()
+
+    def tearDown(self):
+        """Go back to the real static folder."""
+
+        app.static_folder = self.original_static_folder
+        assets.load_manifest(app.static_folder)
+
+    def test_build_assets(self):
+        """Are files fingerprinted and stylesheet urls rewritten"""
+
+        css_name = assets.manifest['stylesheets/style.css']
+        self.assertRegex(css_name, r'^stylesheets/style\.[0-9a-f]{12}\.css$')
+
+        with open(os.path.join(self.static_folder, 'build', css_name)) as f:
+            css = f.read()
+
+        self.assertIn(assets.static_url('images/nav-bg.png'), css)
+        self.assertNotIn('/static/images/nav-bg.png', css)
+
+    def test_serve_asset(self):
+        """Are assets served precompressed with long-lived caching"""
+
+        css_url = assets.static_url('stylesheets/style.css')
+
+        with self.client as client:
+            resp = client.get('/login')
+            self.assertIn(css_url, resp.get_data(as_text=True))
+
+            resp = client.get(css_url, headers={'Accept-Encoding': 'gzip'})
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertIn('Accept-Encoding', resp.headers['Vary'])
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertIn(b'General', gzip.decompress(resp.data))
+
+    def test_unbuilt_asset(self):
+        """Do files missing from the manifest fall back to /static/"""
+
+        self.assertEqual(assets.static_url('not-built.css'),
+                         '/static/not-built.css')
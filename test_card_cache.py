@@ -0,0 +1,199 @@
+"""Shared user card cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_card_cache.py
+
+
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from card_cache import CachedCard, SharedCardCache, card_cache, WAYS
+from models import db, Message, User
+from read_models import author_cards, feed_messages
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def make_cache(cache=None, slots=64, ttl=60):
+    """Set up `cache` (or a new one) with a new temp file."""
+
+    class Config:
+        config = {'CARD_CACHE_PATH': os.path.join(tempfile.mkdtemp(), 'cards'),
+                  'CARD_CACHE_SLOTS': slots,
+                  'CARD_CACHE_TTL_SECONDS': ttl}
+
+    cache = cache or SharedCardCache()
+    cache.init_app(Config)
+    return cache
+
+
+def card(user_id, username=None):
+    return CachedCard(user_id, username or f"user{user_id}",
+                      "/static/images/default-pic.png")
+
+
+class SharedCardCacheTestCase(TestCase):
+    """Test the cache file on its own."""
+
+    def setUp(self):
+        self.cache = make_cache()
+
+    def tearDown(self):
+        self.cache.close()
+
+    def test_put_and_get(self):
+        """Is a stored card read back whole"""
+
+        self.assertIsNone(self.cache.get(7))
+        self.assertTrue(self.cache.put(card(7), self.cache.version(7)))
+        self.assertEqual(self.cache.get(7), card(7))
+
+    def test_invalidate(self):
+        """Does invalidating make a card a miss, and refuse stale puts"""
+
+        version = self.cache.version(7)
+        self.cache.put(card(7), version)
+        self.cache.invalidate(7)
+
+        self.assertIsNone(self.cache.get(7))
+
+        # A card read before the invalidation can't be put back
+        self.assertFalse(self.cache.put(card(7), version))
+        self.assertTrue(self.cache.put(card(7, "renamed"),
+                                       self.cache.version(7)))
+        self.assertEqual(self.cache.get(7).username, "renamed")
+
+    def test_ttl(self):
+        """Are old cards a miss"""
+
+        cache = make_cache(ttl=0)
+        cache.put(card(7), cache.version(7))
+        time.sleep(0.01)
+
+        self.assertIsNone(cache.get(7))
+        cache.close()
+
+    def test_too_long(self):
+        """Are cards that don't fit in a slot skipped"""
+
+        self.assertFalse(self.cache.put(card(7, "x" * 100),
+                                        self.cache.version(7)))
+        self.assertIsNone(self.cache.get(7))
+
+    def test_bounded(self):
+        """Does the cache stay at its size, keeping recently read cards"""
+
+        size = os.path.getsize(self.cache.path)
+
+        for user_id in range(1, 1001):
+            self.cache.put(card(user_id), self.cache.version(user_id))
+            # Keep reading user 1, so the clock passes over it
+            self.assertEqual(self.cache.get(1), card(1))
+
+        self.assertEqual(os.path.getsize(self.cache.path), size)
+        self.assertEqual(len(self.cache.get_many(range(1, 1001))),
+                         self.cache.slots)
+
+    def test_eviction_within_set(self):
+        """Does a full set evict an unread card before a read one"""
+
+        # Users that hash to the same set as user 1
+        same_set = [user_id for user_id in range(1, 100000)
+                    if self.cache._set_slots(user_id)
+                    == self.cache._set_slots(1)][:WAYS + 1]
+
+        for user_id in same_set[:WAYS]:
+            self.cache.put(card(user_id), self.cache.version(user_id))
+
+        # Full set, none read yet: the hand evicts the first card
+        self.cache.put(card(same_set[WAYS]), self.cache.version(same_set[WAYS]))
+        self.assertIsNone(self.cache.get(same_set[0]))
+
+        # The hand is now at the second card. Read it, but not the third
+        self.cache.get(same_set[1])
+        self.cache.put(card(same_set[0]), self.cache.version(same_set[0]))
+
+        self.assertIsNotNone(self.cache.get(same_set[1]))
+        self.assertIsNone(self.cache.get(same_set[2]))
+
+    def test_shared_between_processes(self):
+        """Do other processes see cards and invalidations"""
+
+        self.cache.put(card(7), self.cache.version(7))
+
+        pid = os.fork()
+        if pid == 0:
+            # Child: read what the parent stored, then invalidate it
+            ok = self.cache.get(7) == card(7)
+            self.cache.invalidate(7)
+            os._exit(0 if ok else 1)
+
+        _, status = os.waitpid(pid, 0)
+
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+        self.assertIsNone(self.cache.get(7))
+
+
+class AuthorCardsTestCase(TestCase):
+    """Test feeds resolving their authors through the cache."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.client = app.test_client()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        user.id = 111
+        db.session.add(user)
+        db.session.add(Message(text="hello", user_id=111))
+        db.session.commit()
+
+        make_cache(card_cache)
+
+    def tearDown(self):
+        db.session.rollback()
+        card_cache.close()
+        card_cache.path = None
+
+    def test_author_cards(self):
+        """Are authors loaded once, then read from the cache"""
+
+        self.assertEqual(author_cards({111})[111].username, "testuser")
+        self.assertEqual(card_cache.get(111),
+                         CachedCard(111, "testuser",
+                                    "/static/images/default-pic.png"))
+
+        # Changed behind the cache's back: still served from it
+        User.query.filter_by(id=111).update({"username": "sneaky"})
+        [message] = feed_messages(Message.visible())
+        self.assertEqual(message.user.username, "testuser")
+
+    def test_profile_edit_invalidates(self):
+        """Does editing a profile show up in feeds straight away"""
+
+        author_cards({111})
+
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 111
+
+        resp = self.client.post('/users/profile', data={
+            'username': 'renamed',
+            'email': 'test@test.com',
+            'password': 'testuser',
+        })
+        self.assertEqual(resp.status_code, 302)
+
+        [message] = feed_messages(Message.visible())
+        self.assertEqual(message.user.username, "renamed")
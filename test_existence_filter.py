@@ -0,0 +1,150 @@
+"""Username and email existence filter tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_existence_filter.py
+
+
+import os
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from existence_filter import ExistenceFilter, existence_filter
+from invalidation_bus import invalidation_bus
+from models import db, User
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExistenceFilterTestCase(TestCase):
+    """Test the Bloom filter and the checks that use it."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for user_id in (111, 222):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.commit()
+
+        existence_filter.mark_stale()
+        existence_filter.stats.clear()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_filter(self):
+        """Are taken names possible hits, and most free ones certain misses"""
+
+        names = ExistenceFilter()
+        names.build(chunk_size=1)
+
+        self.assertTrue(names.might_be_taken("username", "user111"))
+        self.assertTrue(names.might_be_taken("email", "222@test.com"))
+        # Usernames and emails are separate
+        self.assertFalse(names.might_be_taken("email", "user111"))
+
+        misses = sum(not names.might_be_taken("username", f"free{i}")
+                     for i in range(1000))
+        self.assertGreater(misses, 950)
+
+        names.add("username", "free0")
+        self.assertTrue(names.might_be_taken("username", "free0"))
+
+        snapshot = names.snapshot()
+        self.assertEqual(snapshot["keys"], 5)
+        self.assertEqual(snapshot["hashes"], 7)
+        self.assertLess(snapshot["estimated_false_positive_rate"], 0.01)
+
+    def test_taken(self):
+        """Is the database only asked about possible hits"""
+
+        existence_filter.build()
+        # A name since freed: still in the filter, but not the table
+        existence_filter.add("username", "ghost")
+
+        self.assertEqual(existence_filter.taken(username="user111",
+                                                email="new@test.com"),
+                         {"username": True, "email": False})
+        self.assertEqual(existence_filter.taken(exclude_user_id=111,
+                                                username="user111"),
+                         {"username": False})
+        self.assertEqual(existence_filter.taken(username="ghost"),
+                         {"username": False})
+
+        stats = existence_filter.snapshot()
+        self.assertEqual(stats["possible"], 3)
+        self.assertEqual(stats["false_positives"], 2)
+
+    def test_rebuild(self):
+        """Do missed events and the rebuild command rebuild the filter"""
+
+        existence_filter.build()
+        builds = existence_filter.stats["builds"]
+
+        # Added behind the bus's back
+        db.session.add(User(username="sneaky", email="sneaky@test.com",
+                            password="x"))
+        db.session.commit()
+        self.assertFalse(existence_filter.might_be_taken("username", "sneaky"))
+
+        invalidation_bus.recover()
+        # Asks the database while the rebuild runs in the background
+        self.assertTrue(existence_filter.might_be_taken("username", "sneaky"))
+        self.assertEqual(existence_filter.stats["unbuilt"], 1)
+
+        result = app.test_cli_runner().invoke(
+            args=['rebuild-existence-filter'])
+        self.assertEqual(result.exit_code, 0, result.output)
+        self.assertIn('"keys": 6', result.output)
+        self.assertEqual(existence_filter.stats["builds"], builds + 2)
+
+    def test_available(self):
+        """Does the availability endpoint and signup see new users"""
+
+        response = self.client.get('/users/available?username=newbie'
+                                   '&email=111@test.com')
+        self.assertEqual(response.json, {"username": True, "email": False})
+
+        response = self.client.post('/signup', data={
+            "username": "newbie", "email": "newbie@test.com",
+            "password": "password"})
+        self.assertEqual(response.status_code, 302)
+
+        self.assertFalse(self.client.get(
+            '/users/available?username=newbie').json["username"])
+
+        response = self.client.post('/signup', data={
+            "username": "newbie", "email": "other@test.com",
+            "password": "password"})
+        self.assertIn("Username already taken",
+                      response.get_data(as_text=True))
+        self.assertEqual(User.query.count(), 3)
+
+    def test_edit(self):
+        """Is a profile edit checked against everyone else's names"""
+
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 111
+
+        response = self.client.post('/users/profile', data={
+            "username": "user222", "email": "111@test.com",
+            "password": "password"})
+        self.assertIn("Username or email already taken",
+                      response.get_data(as_text=True))
+
+        response = self.client.post('/users/profile', data={
+            "username": "renamed", "email": "111@test.com",
+            "password": "password"})
+        self.assertEqual(response.status_code, 302)
+        self.assertTrue(existence_filter.might_be_taken("username", "renamed"))
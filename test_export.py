@@ -0,0 +1,146 @@
+"""User data export tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_export.py
+
+
+import csv
+import gzip
+import io
+import json
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from export import InvalidCursor, export_rows, export_stream
+from models import db, Follows, Like, Message, User
+from partitions import archive_messages
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NOW = datetime(2026, 1, 15)
+
+
+class ExportTestCase(TestCase):
+    """Test streaming a user's messages, likes and follows."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.archive_dir.name
+
+        for user_id in (111, 222, 333):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.commit()
+
+        db.session.add_all([
+            Message(id=1, text="old", user_id=111,
+                    timestamp=datetime(2024, 3, 5)),
+            Message(id=2, text="first", user_id=111,
+                    timestamp=datetime(2026, 1, 1)),
+            Message(id=3, text="second, with \"quotes\"", user_id=111,
+                    timestamp=datetime(2026, 1, 2)),
+            Message(id=4, text="gone", user_id=111,
+                    timestamp=datetime(2026, 1, 3),
+                    deleted_at=datetime(2026, 1, 4)),
+            Message(id=5, text="theirs", user_id=222,
+                    timestamp=datetime(2026, 1, 5)),
+            Like(user_liking_id=111, liked_message_id=5),
+            Follows(user_being_followed_id=222, user_following_id=111),
+            Follows(user_being_followed_id=111, user_following_id=333),
+        ])
+        db.session.commit()
+
+        archive_messages(self.archive_dir.name, 365, now=NOW)
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 111
+
+    def tearDown(self):
+        db.session.rollback()
+        self.archive_dir.cleanup()
+
+    def rows(self, **kwargs):
+        user = db.session.get(User, 111)
+        return list(export_rows(user, self.archive_dir.name, **kwargs))
+
+    def test_export(self):
+        """Is everything exported, section by section in id order"""
+
+        rows = self.rows(chunk_size=1)
+
+        self.assertEqual([row["cursor"] for row in rows],
+                         ["archived_message:2024-03/1", "message:2",
+                          "message:3", "like:5", "following:222",
+                          "follower:333"])
+        self.assertEqual(rows[0]["text"], "old")
+        self.assertEqual(rows[1]["timestamp"], "2026-01-01T00:00:00")
+        self.assertEqual(rows[4]["username"], "user222")
+
+    def test_resume(self):
+        """Does resuming after a cursor send only the rest"""
+
+        cursors = [row["cursor"] for row in self.rows()]
+
+        for i, cursor in enumerate(cursors):
+            self.assertEqual([row["cursor"] for row in self.rows(after=cursor)],
+                             cursors[i + 1:])
+
+        with self.assertRaises(InvalidCursor):
+            self.rows(after="message:x")
+        with self.assertRaises(InvalidCursor):
+            export_stream(db.session.get(User, 111), self.archive_dir.name,
+                          after="nonsense:1")
+
+    def test_download(self):
+        """Is the export streamed as NDJSON, CSV and gzip"""
+
+        response = self.client.get('/users/111/export')
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertIn('attachment; filename="warbler-111.ndjson"',
+                      response.headers['Content-Disposition'])
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(json.loads(lines[2])["text"],
+                         'second, with "quotes"')
+
+        response = self.client.get('/users/111/export?format=csv')
+        self.assertEqual(response.mimetype, 'text/csv')
+        rows = list(csv.DictReader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(rows[2]["text"], 'second, with "quotes"')
+        self.assertEqual(rows[5]["type"], "follower")
+
+        response = self.client.get(
+            '/users/111/export?format=csv&after=message:3')
+        self.assertEqual(response.get_data(as_text=True).splitlines(),
+                         ["like:5,like,5,,,",
+                          "following:222,following,222,,,user222",
+                          "follower:333,follower,333,,,user333"])
+
+        response = self.client.get('/users/111/export?gzip=1')
+        self.assertEqual(response.mimetype, 'application/gzip')
+        self.assertEqual(len(gzip.decompress(response.get_data())
+                             .splitlines()), 6)
+
+    def test_unauthorized(self):
+        """Can only the user themself download their export"""
+
+        self.assertEqual(self.client.get('/users/222/export').status_code, 401)
+        self.assertEqual(
+            self.client.get('/users/111/export?format=xml').status_code, 400)
+        self.assertEqual(
+            self.client.get('/users/111/export?after=nope').status_code, 400)
@@ -0,0 +1,178 @@
+"""Bulk ingest tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_ingest.py
+
+
+import io
+import json
+import os
+from datetime import datetime, timedelta
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from ingest import ingest, read_lines
+from models import db, Follows, Like, Message, MessageTag, User
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+TOKEN = "test-token"
+
+
+def ndjson(*rows):
+    return "".join(row if isinstance(row, str) else json.dumps(row) + "\n"
+                   for row in rows).encode()
+
+
+class IngestTestCase(TestCase):
+    """Test bulk ingest of messages, follows and likes."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for user_id in (111, 222, 333):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.commit()
+
+        db.session.add(Message(id=1, text="existing", user_id=222))
+        db.session.commit()
+
+        app.config['INGEST_TOKEN'] = TOKEN
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        app.config['INGEST_TOKEN'] = None
+
+    def post(self, body, token=TOKEN):
+        response = self.client.post(
+            '/api/ingest', data=body,
+            headers={"Authorization": f"Bearer {token}"},
+            content_type='application/x-ndjson')
+        return response, [json.loads(line)
+                          for line in response.get_data(as_text=True)
+                          .splitlines()]
+
+    def test_ingest(self):
+        """Are valid rows inserted, with counts and tags kept up to date"""
+
+        timestamp = (datetime.utcnow() - timedelta(days=30)).replace(
+            microsecond=0)
+
+        response, results = self.post(ndjson(
+            {"type": "message", "user_id": 111, "text": "bulk #loaded",
+             "timestamp": timestamp.isoformat()},
+            {"type": "follow", "user_id": 111, "follows_id": 222},
+            {"type": "like", "user_id": 111, "message_id": 1},
+            {"type": "like", "user_id": 333, "message_id": 1}))
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(results[0]["inserted"],
+                         {"messages": 1, "follows": 1, "likes": 2})
+        self.assertEqual(results[0]["errors"], [])
+        self.assertEqual(results[-1]["done"], True)
+
+        message = Message.query.filter_by(text="bulk #loaded").one()
+        self.assertEqual(message.user_id, 111)
+        self.assertEqual(message.timestamp, timestamp)
+        self.assertEqual([tag.message_id for tag in MessageTag.query],
+                         [message.id])
+        self.assertEqual(Follows.query.count(), 1)
+        self.assertEqual(Message.query.get(1).like_count, 2)
+
+    def test_replay(self):
+        """Are follows and likes already there skipped"""
+
+        body = ndjson({"type": "follow", "user_id": 111, "follows_id": 222},
+                      {"type": "like", "user_id": 111, "message_id": 1},
+                      {"type": "like", "user_id": 111, "message_id": 1})
+
+        self.post(body)
+        _, results = self.post(body)
+
+        self.assertEqual(results[0]["inserted"],
+                         {"messages": 0, "follows": 0, "likes": 0})
+        self.assertEqual(results[0]["skipped"], 2)
+        self.assertEqual(Like.query.count(), 1)
+        self.assertEqual(Message.query.get(1).like_count, 1)
+
+    def test_errors(self):
+        """Are bad rows reported by line number, without stopping the rest"""
+
+        _, results = self.post(ndjson(
+            "not json\n",
+            {"type": "message", "user_id": 999, "text": "who?"},
+            {"type": "follow", "user_id": 111, "follows_id": 111},
+            {"type": "like", "user_id": 222, "message_id": 1},
+            {"type": "like", "user_id": 111, "message_id": 404},
+            {"type": "message", "user_id": 111, "text": "x" * 5000},
+            {"type": "message", "user_id": 111, "text": "still fine"}))
+
+        self.assertEqual(
+            results[0]["errors"],
+            [{"line": 1, "error": "not valid JSON"},
+             {"line": 2, "error": "no such user 999"},
+             {"line": 3, "error": "users can't follow themselves"},
+             {"line": 4, "error": "users can't like their own messages"},
+             {"line": 5, "error": "no such message 404"},
+             {"line": 6, "error": "line longer than 4096 bytes"}])
+        self.assertEqual(results[0]["inserted"]["messages"], 1)
+        self.assertEqual(results[-1]["errors"], 6)
+
+    def test_timestamps(self):
+        """Are messages from the future, or from archived months, rejected"""
+
+        now = datetime.utcnow()
+
+        _, results = self.post(ndjson(
+            {"type": "message", "user_id": 111, "text": "later",
+             "timestamp": (now + timedelta(days=1)).isoformat()},
+            {"type": "message", "user_id": 111, "text": "long ago",
+             "timestamp": (now - timedelta(days=800)).isoformat()},
+            {"type": "message", "user_id": 111, "text": "a bit slow",
+             "timestamp": (now + timedelta(minutes=1)).isoformat()},
+            {"type": "follow", "user_id": 111, "follows_id": 222}))
+
+        self.assertEqual([error["line"] for error in results[0]["errors"]],
+                         [1, 2])
+        self.assertEqual(results[0]["errors"][0]["error"],
+                         "timestamp is in the future")
+        self.assertIn("older than messages are kept",
+                      results[0]["errors"][1]["error"])
+        self.assertEqual(results[0]["inserted"],
+                         {"messages": 1, "follows": 1, "likes": 0})
+
+    def test_batches(self):
+        """Is each batch written and reported as it's read"""
+
+        body = ndjson(*({"type": "message", "user_id": 111, "text": f"m{i}"}
+                        for i in range(5)))
+
+        results = list(ingest(read_lines(io.BytesIO(body)), batch_size=2))
+
+        self.assertEqual([result.get("lines") for result in results],
+                         [[1, 2], [3, 4], [5, 5], None])
+        self.assertEqual(results[-1]["batches"], 3)
+        self.assertEqual(results[-1]["messages"], 5)
+        self.assertEqual(Message.query.count(), 6)
+
+    def test_unauthorized(self):
+        """Does ingest need the token, and stay off without one set"""
+
+        response, _ = self.post(ndjson(), token="wrong")
+        self.assertEqual(response.status_code, 401)
+
+        app.config['INGEST_TOKEN'] = None
+        response = self.client.post('/api/ingest', data=b"")
+        self.assertEqual(response.status_code, 404)
@@ -0,0 +1,221 @@
+"""Invalidation bus tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_invalidation_bus.py
+
+
+import json
+import os
+import tempfile
+import time
+from unittest import TestCase
+
+from sqlalchemy.exc import IntegrityError
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from invalidation_bus import MAX_PAYLOAD_BYTES, InvalidationBus, invalidation_bus
+from models import db, User
+from single_flight import single_flight
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def event(publisher, seq, keys):
+    return json.dumps({"p": publisher, "s": seq, "k": keys})
+
+
+def wait_for(condition, timeout=2):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+class CommitTestCase(TestCase):
+    """Test that keys are applied when, and only when, a session commits."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.applied = []
+        invalidation_bus.on("test")(self.applied.append)
+
+    def tearDown(self):
+        db.session.rollback()
+        invalidation_bus._handlers.pop("test")
+
+    def test_commit(self):
+        """Are keys applied on commit"""
+
+        invalidation_bus.publish("test:1", "test:2")
+        self.assertEqual(self.applied, [])
+
+        db.session.commit()
+
+        self.assertEqual(sorted(self.applied), ["1", "2"])
+
+        # Only once
+        db.session.commit()
+        self.assertEqual(len(self.applied), 2)
+
+    def test_rollback(self):
+        """Are keys dropped on rollback"""
+
+        invalidation_bus.publish("test:1")
+        db.session.rollback()
+        db.session.commit()
+
+        self.assertEqual(self.applied, [])
+
+    def test_failed_commit(self):
+        """Does a commit whose flush fails use up no event number"""
+
+        User.signup(username="taken", email="taken@test.com",
+                    password="password", image_url=None)
+        db.session.commit()
+
+        receiver = InvalidationBus()
+        receiver.receive(invalidation_bus._event({"test:1"}))
+
+        # (the flush fails before anything is sent, even here)
+        transport = invalidation_bus.transport
+        invalidation_bus.transport = "postgres"
+        try:
+            invalidation_bus.publish("test:2")
+            User.signup(username="taken", email="other@test.com",
+                        password="password", image_url=None)
+            with self.assertRaises(IntegrityError):
+                db.session.commit()
+            db.session.rollback()
+        finally:
+            invalidation_bus.transport = transport
+
+        receiver.receive(invalidation_bus._event({"test:3"}))
+        receiver.gap_grace = 0
+        receiver.check_gaps()
+
+        self.assertEqual(receiver.stats["recoveries"], 0)
+        self.assertEqual(self.applied, [])
+
+    def test_write_path(self):
+        """Do writes drop the cached pages they change"""
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        user.id = 111
+        db.session.commit()
+        single_flight.clear()
+
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 111
+
+        client.get('/users/111')
+        self.assertIn("profile:111", single_flight._entries)
+
+        client.post('/messages/new', data={"text": "hello"})
+
+        self.assertNotIn("profile:111", single_flight._entries)
+
+
+class DeliveryTestCase(TestCase):
+    """Test events between processes (here, two buses) and missed events."""
+
+    def setUp(self):
+        self.socket_dir = tempfile.TemporaryDirectory()
+        self.sender = InvalidationBus("socket", self.socket_dir.name)
+        self.receiver = InvalidationBus("socket", self.socket_dir.name)
+
+        self.applied = []
+        self.receiver.on("user")(self.applied.append)
+        self.recoveries = []
+        self.receiver.on_recover(lambda: self.recoveries.append(True))
+
+    def tearDown(self):
+        self.receiver.close()
+        self.socket_dir.cleanup()
+
+    def test_socket(self):
+        """Do other workers get events through their sockets"""
+
+        self.receiver.ensure_listening()
+        wait_for(lambda: os.listdir(self.socket_dir.name))
+
+        self.sender.broadcast({"user:42"})
+
+        self.assertTrue(wait_for(lambda: self.applied))
+        self.assertEqual(self.applied, ["42"])
+        self.assertEqual(self.recoveries, [])
+
+    def test_out_of_order(self):
+        """Is an event arriving late not taken as missed"""
+
+        self.receiver.receive(event("abc", 1, ["user:1"]))
+        self.receiver.receive(event("abc", 3, ["user:3"]))
+        self.receiver.receive(event("abc", 2, ["user:2"]))
+
+        self.receiver.gap_grace = 0
+        self.receiver.check_gaps()
+
+        self.assertEqual(self.applied, ["1", "3", "2"])
+        self.assertEqual(self.recoveries, [])
+
+    def test_missed(self):
+        """Does a gap that isn't filled in time trigger recovery"""
+
+        self.receiver.receive(event("abc", 1, ["user:1"]))
+        self.receiver.receive(event("abc", 3, ["user:3"]))
+
+        self.receiver.check_gaps()
+        self.assertEqual(self.recoveries, [])
+
+        self.receiver.gap_grace = 0
+        self.receiver.check_gaps()
+
+        self.assertEqual(self.recoveries, [True])
+        self.assertEqual(self.receiver.stats["gaps"], 1)
+
+        # Back in step
+        self.receiver.receive(event("abc", 4, ["user:4"]))
+        self.receiver.check_gaps()
+        self.assertEqual(self.recoveries, [True])
+
+    def test_oversized(self):
+        """Is an event too big to send turned into invalidate-everything"""
+
+        self.receiver.receive(self.sender._event(
+            {f"user:{user_id}" for user_id in range(2000)}))
+
+        self.assertEqual(self.applied, [])
+        self.assertEqual(self.recoveries, [True])
+
+    def test_split(self):
+        """Are many keys sent as several events, not invalidate-everything"""
+
+        keys = {f"user:{user_id}" for user_id in range(2000)}
+        payloads = self.sender._events(keys)
+
+        self.assertGreater(len(payloads), 1)
+        for payload in payloads:
+            self.assertLessEqual(len(payload.encode("utf-8")),
+                                 MAX_PAYLOAD_BYTES)
+            self.receiver.receive(payload)
+
+        self.assertEqual(sorted(self.applied, key=int),
+                         [str(user_id) for user_id in range(2000)])
+        self.assertEqual(self.recoveries, [])
+
+    def test_own_events(self):
+        """Are a process's own events (already applied) ignored"""
+
+        self.receiver.receive(self.receiver._event({"user:1"}))
+
+        self.assertEqual(self.applied, [])
@@ -0,0 +1,107 @@
+"""Job queue tests."""
+
+# run these tests like:
+#
+#    python3 -m unittest test_jobs.py
+
+
+import os
+from unittest import TestCase
+
+from models import db, Job
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+import jobs
+
+db.create_all()
+
+jobs.RETRY_BACKOFF_SECONDS = 0
+
+calls = []
+
+
+@jobs.job_handler("test_job")
+def record_call(value, fail_times=0):
+    """Job handler for tests: fails `fail_times` times, then records `value`."""
+
+    if len([call for call in calls if call == "failed"]) < fail_times:
+        calls.append("failed")
+        raise ValueError("job failed")
+
+    calls.append(value)
+    jobs.report_progress({"value": value})
+
+
+class JobTestCase(TestCase):
+    """Test enqueueing and running jobs."""
+
+    def setUp(self):
+        """Clear out the jobs table."""
+
+        Job.query.delete()
+        db.session.commit()
+        calls.clear()
+
+    def tearDown(self):
+        """Rollback fouled transactions from tests"""
+        db.session.rollback()
+
+    def test_run_job(self):
+        """Does the worker run queued jobs, highest priority first"""
+
+        jobs.enqueue("test_job", {"value": "low"})
+        jobs.enqueue("test_job", {"value": "high"}, priority=10)
+        db.session.commit()
+
+        jobs.run_worker(burst=True)
+
+        self.assertEqual(calls, ["high", "low"])
+        self.assertEqual(Job.query.filter_by(status="done").count(), 2)
+        self.assertEqual(Job.query.filter_by(priority=10).one().progress,
+                         {"value": "high"})
+
+    def test_idempotency_key(self):
+        """Is a job enqueued twice with the same key only run once"""
+
+        first = jobs.enqueue("test_job", {"value": 1}, idempotency_key="once")
+        db.session.commit()
+        second = jobs.enqueue("test_job", {"value": 1}, idempotency_key="once")
+        db.session.commit()
+
+        self.assertEqual(first.id, second.id)
+
+        jobs.run_worker(burst=True)
+        self.assertEqual(calls, [1])
+
+    def test_retry_then_fail(self):
+        """Are failing jobs retried up to max_attempts, then marked failed"""
+
+        jobs.enqueue("test_job", {"value": 1, "fail_times": 1})
+        jobs.enqueue("test_job", {"value": 2, "fail_times": 5}, max_attempts=2)
+        db.session.commit()
+
+        jobs.run_worker(burst=True)
+
+        statuses = {job.args["value"]: (job.status, job.attempts)
+                    for job in Job.query.all()}
+        self.assertEqual(statuses[1], ("done", 2))
+        self.assertEqual(statuses[2], ("failed", 2))
+
+    def test_delete_finished(self):
+        """Are old finished jobs deleted, and their keys free again"""
+
+        jobs.enqueue("test_job", {"value": 1}, idempotency_key="once")
+        jobs.enqueue("test_job", {"value": 2})
+        db.session.commit()
+        jobs.run_worker(burst=True)
+
+        again = jobs.enqueue("test_job", {"value": 3}, idempotency_key="once")
+        db.session.commit()
+        self.assertEqual(again.status, "queued")
+
+        self.assertEqual(jobs.delete_finished(), 0)
+        self.assertEqual(jobs.delete_finished(retention_seconds=-60,
+                                              batch_size=1), 2)
+        self.assertEqual([job.args["value"] for job in Job.query], [3])
@@ -0,0 +1,189 @@
+"""Like count and "liked by" preview tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_like_summaries.py
+
+
+import os
+from datetime import datetime
+from unittest import TestCase
+
+from sqlalchemy import event
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import read_models
+from app import app, CURR_USER_KEY
+from like_buffer import like_buffer
+from models import db, Follows, Like, Message, User
+from purge import purge_user
+from read_models import load_like_summaries
+from single_flight import single_flight
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+LIKER_IDS = (222, 333, 444)
+
+
+class LikeSummariesTestCase(TestCase):
+    """Test like counts and likers previews."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        single_flight.clear()
+
+        for user_id in (111, *LIKER_IDS):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.flush()
+
+        db.session.add_all([Message(id=11, text="popular", user_id=111),
+                            Message(id=12, text="ignored", user_id=111)])
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def like_all(self, message_id=11):
+        for user_id in LIKER_IDS:
+            User.query.get(user_id).like_or_unlike_message(message_id)
+
+    def test_counted(self):
+        """Are likes and unlikes counted on the message"""
+
+        self.like_all()
+        self.assertEqual(Message.query.get(11).like_count, 3)
+
+        User.query.get(222).like_or_unlike_message(11)
+        db.session.expire_all()
+        self.assertEqual(Message.query.get(11).like_count, 2)
+
+    def test_counted_write_behind(self):
+        """Are buffered likes counted when they're flushed"""
+
+        app.config['LIKES_WRITE_BEHIND'] = True
+        like_buffer.init_app(app)
+        like_buffer.flush_interval = 60
+
+        try:
+            self.like_all()
+            like_buffer.flush()
+        finally:
+            app.config['LIKES_WRITE_BEHIND'] = False
+
+        self.assertEqual(Message.query.get(11).like_count, 3)
+
+    def test_summaries(self):
+        """Are counts and the first few likers given per message"""
+
+        self.like_all()
+
+        summaries = load_like_summaries([11, 12])
+
+        self.assertEqual(set(summaries), {11})
+        self.assertEqual(summaries[11].count, 3)
+        self.assertEqual([liker.username for liker in summaries[11].likers],
+                         ["user444", "user333"])
+        self.assertEqual(summaries[11].others, 1)
+
+    def test_deleted_liker(self):
+        """Are deleted users left out of the likers before they're purged"""
+
+        self.like_all()
+        User.query.get(444).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        summaries = load_like_summaries([11])
+
+        self.assertEqual([liker.username for liker in summaries[11].likers],
+                         ["user333", "user222"])
+
+    def test_viral(self):
+        """Are very liked messages previewed without the window query"""
+
+        self.like_all()
+        self.like_all(12)
+        User.query.get(222).like_or_unlike_message(12)
+
+        max_likes, read_models.LIKERS_WINDOW_MAX_LIKES = (
+            read_models.LIKERS_WINDOW_MAX_LIKES, 2)
+        try:
+            summaries = load_like_summaries([11, 12])
+        finally:
+            read_models.LIKERS_WINDOW_MAX_LIKES = max_likes
+
+        self.assertEqual([liker.id for liker in summaries[11].likers],
+                         [444, 333])
+        self.assertEqual([liker.id for liker in summaries[12].likers],
+                         [444, 333])
+        self.assertEqual(summaries[12].others, 0)
+
+    def test_queries_per_page(self):
+        """Does a page cost the same few queries however many messages"""
+
+        for message_id in range(100, 150):
+            db.session.add(Message(id=message_id, text="more", user_id=111))
+        db.session.commit()
+        for message_id in range(100, 150):
+            self.like_all(message_id)
+
+        statements = []
+
+        def count(*args):
+            statements.append(args)
+
+        event.listen(db.engine, "before_cursor_execute", count)
+        try:
+            summaries = load_like_summaries(range(100, 150))
+        finally:
+            event.remove(db.engine, "before_cursor_execute", count)
+
+        self.assertEqual(len(summaries), 50)
+        self.assertEqual(len(statements), 3)
+
+    def test_pages(self):
+        """Do message, profile and timeline pages show the preview"""
+
+        self.like_all()
+        db.session.add(Follows(user_being_followed_id=111,
+                               user_following_id=222))
+        db.session.commit()
+
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 222
+
+        for url in ('/messages/11', '/users/111', '/'):
+            html = client.get(url).get_data(as_text=True)
+            self.assertIn("Liked by", html, url)
+            self.assertIn("@user444</a>, <a", html, url)
+            self.assertIn("and 1 other", html, url)
+
+    def test_recount(self):
+        """Does recounting fill in like counts from the likes table"""
+
+        db.session.add_all([Like(user_liking_id=user_id, liked_message_id=11)
+                            for user_id in LIKER_IDS])
+        db.session.commit()
+
+        self.assertEqual(Message.recount_likes(batch_size=1), 2)
+        self.assertEqual(Message.query.get(11).like_count, 3)
+        self.assertEqual(Message.query.get(12).like_count, 0)
+
+    def test_purged_liker(self):
+        """Are a purged user's likes taken off the counts"""
+
+        self.like_all()
+        User.query.get(222).deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        purge_user(222, pause=0)
+
+        self.assertEqual(Message.query.get(11).like_count, 2)
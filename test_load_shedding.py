@@ -0,0 +1,164 @@
+"""Load shedding tests, with artificial database latency."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_load_shedding.py
+
+
+import os
+import threading
+import time
+from unittest import TestCase
+
+from sqlalchemy import event, text
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from load_shedding import db_health
+from models import db, Message, User
+from single_flight import single_flight
+
+db.create_all()
+
+
+class InjectedLatency:
+    """Make every query on the app's engine take `seconds` longer.
+
+        with InjectedLatency(0.5) as latency:
+            ...
+            latency.seconds = 0.1
+    """
+
+    def __init__(self, seconds):
+        self.seconds = seconds
+
+        with app.app_context():
+            self.engine = db.engine
+
+    def _sleep(self, *args):
+        time.sleep(self.seconds)
+
+    def __enter__(self):
+        event.listen(self.engine, "before_cursor_execute", self._sleep)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, "before_cursor_execute", self._sleep)
+
+
+def run_queries(count):
+    with app.app_context():
+        for _ in range(count):
+            db.session.execute(text("SELECT 1"))
+
+
+class LoadSheddingTestCase(TestCase):
+    """Test shedding and degraded pages while the database is slow."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        single_flight.clear()
+        db_health.reset()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="testuser",
+                           image_url=None)
+        user.id = 111
+        db.session.add(user)
+        db.session.add(Message(text="old news", user_id=111))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        db_health.reset()
+
+    def test_healthy(self):
+        """Are low-priority pages served normally"""
+
+        run_queries(5)
+
+        self.assertFalse(db_health.degraded)
+        self.assertEqual(self.client.get('/users').status_code, 200)
+
+    def test_degrades_and_recovers(self):
+        """Does slowness flip the worker to degraded and back"""
+
+        with InjectedLatency(0.6):
+            run_queries(3)
+
+        self.assertTrue(db_health.degraded)
+        self.assertGreater(db_health.snapshot()["query_ms"], 250)
+
+        run_queries(20)
+
+        self.assertFalse(db_health.degraded)
+
+    def test_sheds_low_priority(self):
+        """Are concurrent low-priority requests shed with a Retry-After"""
+
+        with InjectedLatency(0.6) as latency:
+            run_queries(3)
+            latency.seconds = 0.4
+
+            responses = []
+
+            def get_users():
+                responses.append(app.test_client().get('/users'))
+
+            threads = [threading.Thread(target=get_users) for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        statuses = sorted(resp.status_code for resp in responses)
+        self.assertEqual(statuses[0], 200)
+        self.assertEqual(statuses[-1], 503)
+
+        shed = [resp for resp in responses if resp.status_code == 503]
+        self.assertEqual(shed[0].headers['Retry-After'], '10')
+        self.assertEqual(db_health.stats["shed"], len(shed))
+
+    def test_stale_profile(self):
+        """Is an old profile snapshot served, with a banner, while degraded"""
+
+        resp = self.client.get('/users/111')
+        self.assertIn('old news', resp.get_data(as_text=True))
+
+        db.session.add(Message(text="breaking news", user_id=111))
+        db.session.commit()
+
+        # Age the snapshot past its normal stale window
+        built_at, rows = single_flight._entries["profile:111"]
+        single_flight._entries["profile:111"] = (built_at - 600, rows)
+
+        with InjectedLatency(0.6) as latency:
+            run_queries(3)
+            latency.seconds = 0.2
+
+            html = self.client.get('/users/111').get_data(as_text=True)
+
+        self.assertIn('old news', html)
+        self.assertNotIn('breaking news', html)
+        self.assertIn('running behind', html)
+
+    def test_fresh_profile_when_healthy(self):
+        """Is a fully expired snapshot rebuilt when not degraded"""
+
+        self.client.get('/users/111')
+
+        db.session.add(Message(text="breaking news", user_id=111))
+        db.session.commit()
+
+        built_at, rows = single_flight._entries["profile:111"]
+        single_flight._entries["profile:111"] = (built_at - 600, rows)
+
+        html = self.client.get('/users/111').get_data(as_text=True)
+
+        self.assertIn('breaking news', html)
+        self.assertNotIn('running behind', html)
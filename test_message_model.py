@@ -8,12 +8,13 @@
 import os
 from unittest import TestCase
 
-from models import db, User, Message, Like, Follows
+from models import db, User, Message, Like, Follows, TrendingMessage
 
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
 from app import app
+from trending import refresh_trending
 
 db.create_all()
 
@@ -62,3 +63,36 @@ class MessageModelTestCase(TestCase):
 
         self.assertTrue(message)
         self.assertTrue(message.user == self.user_1)
+
+    def test_trending(self):
+        """Are liked messages in the trending list, most liked first"""
+
+        liker_1 = User(email="test@test2.com", username="testuser2",
+                       password="very_sneaky")
+        liker_2 = User(email="test@test3.com", username="testuser3",
+                       password="very_sneaky")
+        popular = Message(text="Popular", user_id=self.user_1.id)
+
+        db.session.add_all([liker_1, liker_2, popular])
+        db.session.commit()
+
+        hello = Message.query.filter(Message.text == "Hello again").one()
+
+        liker_1.like_or_unlike_message(popular.id)
+        liker_2.like_or_unlike_message(popular.id)
+        liker_1.like_or_unlike_message(hello.id)
+
+        refresh_trending()
+
+        trending = (TrendingMessage.query
+                    .order_by(TrendingMessage.score.desc())
+                    .all())
+        self.assertEqual([t.message_id for t in trending],
+                         [popular.id, hello.id])
+
+        # Unliking takes the message back out of the list
+        liker_1.like_or_unlike_message(hello.id)
+        refresh_trending()
+
+        self.assertEqual(
+            [t.message_id for t in TrendingMessage.query.all()], [popular.id])
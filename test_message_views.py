@@ -20,6 +20,7 @@ os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 # Now we can import app
 
 from app import app, CURR_USER_KEY
+from single_flight import single_flight
 
 # Create our tables (we do this here, so we only create the tables
 # once for all tests --- in each test, we'll delete the data
@@ -40,6 +41,7 @@ class MessageViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        single_flight.clear()
 
         Like.query.delete()
         Follows.query.delete()
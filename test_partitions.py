@@ -0,0 +1,206 @@
+"""Message partitioning and archive tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_partitions.py
+
+
+import os
+import tempfile
+from datetime import datetime, timedelta
+from unittest import TestCase, skipUnless
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from models import db, Like, Message, User
+from partitions import (
+    archive_messages, archive_path, archived_messages, archived_rows,
+    ensure_partitions, has_archived, partition_messages, partition_name,
+    scanned_partitions)
+from purge import purge_messages, purge_user
+from single_flight import single_flight
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+NOW = datetime(2026, 10, 15)
+
+
+class ArchiveTestCase(TestCase):
+    """Test archiving old months and reading them back."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        single_flight.clear()
+
+        self.archive_dir = tempfile.TemporaryDirectory()
+        app.config['MESSAGE_ARCHIVE_DIR'] = self.archive_dir.name
+
+        for user_id in (111, 222):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.flush()
+
+        for message_id, when in ((1, datetime(2024, 3, 5)),
+                                 (2, datetime(2024, 3, 20)),
+                                 (3, datetime(2025, 11, 2)),
+                                 (4, datetime(2026, 10, 1))):
+            db.session.add(Message(id=message_id, text=f"message {message_id}",
+                                   timestamp=when, user_id=111))
+        db.session.add(Message(id=5, text="other user", user_id=222,
+                               timestamp=datetime(2024, 3, 6)))
+        db.session.add(Like(user_liking_id=222, liked_message_id=2))
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.rollback()
+        self.archive_dir.cleanup()
+
+    def test_archive(self):
+        """Are whole months past retention moved out of the database"""
+
+        archived = archive_messages(self.archive_dir.name, 365, now=NOW)
+
+        self.assertEqual(archived, 3)
+        self.assertEqual([message_id for message_id, in
+                          db.session.query(Message.id).order_by(Message.id)],
+                         [3, 4])
+        self.assertEqual(Like.query.count(), 0)
+        self.assertTrue(os.path.exists(
+            archive_path(self.archive_dir.name, datetime(2024, 3, 1))))
+
+    def test_read_back(self):
+        """Are archived messages read back newest first, and paged"""
+
+        archive_messages(self.archive_dir.name, 365, now=NOW)
+
+        rows = archived_rows(self.archive_dir.name, 111)
+        self.assertEqual([row[0] for row in rows], [2, 1])
+
+        rows = archived_rows(self.archive_dir.name, 111, limit=1)
+        self.assertEqual([row[0] for row in rows], [2])
+        rows = archived_rows(self.archive_dir.name, 111,
+                             before=(rows[0][2], rows[0][0]))
+        self.assertEqual([row[0] for row in rows], [1])
+
+        self.assertTrue(has_archived(self.archive_dir.name, 222))
+        self.assertFalse(has_archived(self.archive_dir.name, 333))
+
+    def test_archive_again(self):
+        """Does archiving a month again keep what's already archived"""
+
+        archive_messages(self.archive_dir.name, 365, now=NOW)
+
+        # Left behind by an interrupted run
+        db.session.add(Message(id=6, text="straggler", user_id=111,
+                               timestamp=datetime(2024, 3, 30)))
+        db.session.commit()
+
+        self.assertEqual(archive_messages(self.archive_dir.name, 365, now=NOW),
+                         1)
+        self.assertEqual([row[0] for row in
+                          archived_rows(self.archive_dir.name, 111)],
+                         [6, 2, 1])
+
+    def test_purge(self):
+        """Are purged users' and cleared messages dropped from the archive"""
+
+        archive_messages(self.archive_dir.name, 365, now=NOW)
+
+        user = User.query.get(111)
+        user.messages_deleted_before = datetime(2024, 3, 10)
+        db.session.commit()
+        purge_messages(111, pause=0, archive_dir=self.archive_dir.name)
+
+        self.assertEqual([row[0] for row in
+                          archived_rows(self.archive_dir.name, 111)], [2])
+
+        self.assertTrue(has_archived(self.archive_dir.name, 222))
+        User.query.get(222).deleted_at = datetime.utcnow()
+        db.session.commit()
+        purge_user(222, pause=0, archive_dir=self.archive_dir.name)
+
+        self.assertFalse(has_archived(self.archive_dir.name, 222))
+        self.assertEqual([(month, row["id"]) for month, row in
+                          archived_messages(self.archive_dir.name, 111)],
+                         [("2024-03", 2)])
+
+    def test_archive_page(self):
+        """Does the profile link to the archive, and the archive page work"""
+
+        archive_messages(self.archive_dir.name, 365, now=NOW)
+
+        client = app.test_client()
+        with client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 222
+
+        html = client.get('/users/111').get_data(as_text=True)
+        self.assertIn('/users/111/archive', html)
+        self.assertNotIn('message 1', html)
+
+        html = client.get('/users/111/archive').get_data(as_text=True)
+        self.assertIn('message 1', html)
+        self.assertIn('message 2', html)
+        self.assertNotIn('message 4', html)
+
+        app_module.ARCHIVE_PAGE_SIZE, page_size = 1, app_module.ARCHIVE_PAGE_SIZE
+        try:
+            html = client.get('/users/111/archive').get_data(as_text=True)
+        finally:
+            app_module.ARCHIVE_PAGE_SIZE = page_size
+        self.assertIn('before_id=2', html)
+
+
+@skipUnless(db.engine.dialect.name == "postgresql", "needs PostgreSQL")
+class PartitionTestCase(TestCase):
+    """Test partitioning the messages table and pruning hot queries."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="password",
+                           image_url=None)
+        user.id = 111
+        db.session.add(Message(text="old", user_id=111,
+                               timestamp=datetime.utcnow() - timedelta(days=90)))
+        db.session.commit()
+
+        partition_messages()
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def test_partitions(self):
+        """Are there partitions from the oldest message to months ahead"""
+
+        months = ensure_partitions()
+
+        self.assertEqual(len(months), 3)
+        self.assertEqual(Message.query.count(), 1)
+
+        db.session.add(Message(text="new", user_id=111))
+        db.session.commit()
+
+    def test_timeline_pruning(self):
+        """Does a full timeline page only read the newest partition"""
+
+        now = datetime.utcnow()
+        for minutes in range(app_module.TIMELINE_LENGTH + 10):
+            db.session.add(Message(text="recent", user_id=111,
+                                   timestamp=now - timedelta(minutes=minutes)))
+        db.session.commit()
+        db.session.execute(db.text("ANALYZE messages"))
+
+        scanned = scanned_partitions(app_module.timeline_query(111))
+
+        self.assertEqual(scanned, {partition_name(now)})
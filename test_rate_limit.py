@@ -0,0 +1,184 @@
+"""Rate limit tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_rate_limit.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from models import db, Message, User
+from rate_limit import Limit, SharedRateLimiter, rate_limiter
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+PER_MINUTE = Limit("ip", 60, 60, 3)
+
+
+class TokenBucketTestCase(TestCase):
+    """Test the shared token buckets."""
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp_dir.name, "rate-limits")
+        self.limiters = []
+
+    def tearDown(self):
+        for limiter in self.limiters:
+            limiter.close()
+        self.tmp_dir.cleanup()
+
+    def limiter(self, slots=64):
+        limiter = SharedRateLimiter()
+        app_config = {'RATE_LIMIT_PATH': self.path, 'RATE_LIMIT_SLOTS': slots}
+        limiter.init_app(type("App", (), {"config": app_config}))
+        self.limiters.append(limiter)
+        return limiter
+
+    def test_bucket(self):
+        """Is a burst allowed, then one request per refill"""
+
+        limiter = self.limiter()
+        take = lambda now: limiter.take([("a", PER_MINUTE)], now)[0]
+
+        self.assertEqual([take(100).remaining for _ in range(3)], [2, 1, 0])
+
+        denied = take(100)
+        self.assertFalse(denied.allowed)
+        self.assertEqual(denied.retry_after, 1)
+        self.assertEqual(denied.reset, 3)
+
+        self.assertTrue(take(101).allowed)
+        self.assertFalse(take(101).allowed)
+        self.assertEqual(take(200).remaining, 2)
+
+    def test_all_or_nothing(self):
+        """Does an empty bucket stop the others being charged"""
+
+        limiter = self.limiter()
+        tight = Limit("user", 1, 60, 1)
+
+        limiter.take([("tight", tight)], 100)
+        results = limiter.take([("loose", PER_MINUTE), ("tight", tight)], 100)
+
+        self.assertEqual([result.allowed for result in results], [False, False])
+        self.assertEqual(limiter.take([("loose", PER_MINUTE)], 100)[0].remaining,
+                         2)
+
+    def test_shared(self):
+        """Do workers mapping the same file share buckets"""
+
+        worker1, worker2 = self.limiter(), self.limiter()
+
+        worker1.take([("a", PER_MINUTE)], 100)
+        worker1.take([("a", PER_MINUTE)], 100)
+
+        self.assertEqual(worker2.take([("a", PER_MINUTE)], 100)[0].remaining,
+                         0)
+        self.assertFalse(worker1.take([("a", PER_MINUTE)], 100)[0].allowed)
+
+    def test_full_set(self):
+        """Does a full set drop its least recently used bucket"""
+
+        limiter = self.limiter(slots=8)
+        hourly = Limit("ip", 1, 60 * 60, 3)
+
+        for i in range(8):
+            limiter.take([(f"key{i}", hourly)], 100 + i)
+        limiter.take([("key0", hourly)], 110)
+        limiter.take([("new", hourly)], 110)
+
+        # key1 was dropped and starts again full; key0 was kept
+        self.assertEqual(limiter.take([("key1", hourly)], 110)[0].remaining, 2)
+        self.assertEqual(limiter.take([("key0", hourly)], 110)[0].remaining, 0)
+
+
+class RateLimitedViewsTestCase(TestCase):
+    """Test limits on views."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        rate_limiter.reset()
+
+        user = User.signup(username="testuser",
+                           email="test@test.com",
+                           password="password",
+                           image_url=None)
+        db.session.commit()
+        self.user_id = user.id
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        rate_limiter.reset()
+
+    def test_login(self):
+        """Are login attempts limited per IP, with rate limit headers"""
+
+        self.assertNotIn('RateLimit-Limit', self.client.get('/login').headers)
+
+        for remaining in range(9, -1, -1):
+            resp = self.client.post('/login', data={"username": "testuser",
+                                                    "password": "wrong"})
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.headers['RateLimit-Limit'], "10")
+            self.assertEqual(resp.headers['RateLimit-Remaining'],
+                             str(remaining))
+
+        resp = self.client.post('/login', data={"username": "testuser",
+                                                "password": "password"})
+        self.assertEqual(resp.status_code, 429)
+        self.assertEqual(resp.headers['Retry-After'], "6")
+
+        # Other clients aren't affected
+        resp = self.client.post('/login',
+                                data={"username": "testuser",
+                                      "password": "password"},
+                                environ_base={'REMOTE_ADDR': "10.0.0.2"})
+        self.assertEqual(resp.status_code, 302)
+
+        self.assertEqual(rate_limiter.stats["limited"], 1)
+
+    def test_posting(self):
+        """Are messages limited per user"""
+
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+
+        statuses = [self.client.post('/messages/new',
+                                     data={"text": f"hi {i}"}).status_code
+                    for i in range(21)]
+
+        self.assertEqual(statuses, [302] * 20 + [429])
+
+    def test_liking_from_message_page(self):
+        """Are likes through the message page limited like any other"""
+
+        author = User.signup(username="author", email="author@test.com",
+                             password="password", image_url=None)
+        db.session.commit()
+        db.session.add(Message(id=1, text="like me", user_id=author.id))
+        db.session.commit()
+
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = self.user_id
+
+        limits = rate_limiter.limits
+        rate_limiter.limits = {**limits, "like": [Limit("user", 1, 60 * 60, 3)]}
+        try:
+            statuses = [self.client.post('/messages/1').status_code
+                        for _ in range(4)]
+        finally:
+            rate_limiter.limits = limits
+
+        self.assertEqual(statuses, [302] * 3 + [429])
+        self.assertEqual(self.client.get('/messages/1').status_code, 200)
@@ -0,0 +1,73 @@
+"""Recommendation tests."""
+
+# run these tests like:
+#
+#    python3 -m unittest test_recommendations.py
+
+
+import os
+from unittest import TestCase
+
+import numpy as np
+
+from models import db, User, Message, Follows, Like, Recommendation
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from recommendations import (
+    FollowGraph, score_chunk, compute_all_recommendations)
+
+db.create_all()
+
+
+class RecommendationTestCase(TestCase):
+    """Test friends-of-friends scoring."""
+
+    def setUp(self):
+        """Create users 1-5 where 1 follows 2 and 3, who follow 4 and 5."""
+
+        Recommendation.query.delete()
+        Like.query.delete()
+        Message.query.delete()
+        Follows.query.delete()
+        User.query.delete()
+
+        for user_id in range(1, 6):
+            db.session.add(User(id=user_id,
+                                username=f"user{user_id}",
+                                email=f"user{user_id}@test.com",
+                                password="HASHED_PASSWORD"))
+        db.session.commit()
+
+        for follower, followed in [(1, 2), (1, 3), (2, 4), (3, 4), (3, 5)]:
+            db.session.add(Follows(user_following_id=follower,
+                                   user_being_followed_id=followed))
+        db.session.commit()
+
+    def tearDown(self):
+        """Rollback fouled transactions from tests"""
+        db.session.rollback()
+
+    def test_score_chunk(self):
+        """Are candidates reached by more paths ranked first"""
+
+        graph = FollowGraph(np.arange(6),
+                            np.array([1, 1, 2, 3, 3]),
+                            np.array([2, 3, 4, 4, 5]))
+
+        owners, candidates, scores = score_chunk(graph, np.array([1]))
+
+        self.assertEqual(list(owners), [1, 1])
+        self.assertEqual(list(candidates), [4, 5])
+        self.assertGreater(scores[0], scores[1])
+
+    def test_compute_all_recommendations(self):
+        """Are recommendations stored, skipping users already followed"""
+
+        compute_all_recommendations()
+
+        user = User.query.get(1)
+        self.assertEqual([card.username for card in user.recommended_users()],
+                         ["user4", "user5"])
+        self.assertEqual(Recommendation.query.filter_by(user_id=2).count(), 0)
@@ -0,0 +1,105 @@
+"""Production server warm-up and readiness tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_server.py
+
+
+import os
+import tempfile
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from card_cache import card_cache
+from models import db, Follows, Message, User
+import server
+
+db.create_all()
+
+
+class ServerTestCase(TestCase):
+    """Test worker sizing, warm-up and the readiness check."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        for user_id in (111, 222, 333):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+            db.session.add(user)
+        db.session.commit()
+
+        db.session.add_all([
+            Follows(user_being_followed_id=111, user_following_id=222),
+            Follows(user_being_followed_id=111, user_following_id=333),
+            Message(text="hello", user_id=333),
+        ])
+        db.session.commit()
+
+        card_cache.init_app(type("Config", (), {"config": {
+            'CARD_CACHE_PATH': os.path.join(tempfile.mkdtemp(), 'cards')}}))
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        card_cache.close()
+        card_cache.path = None
+        server.warmed.clear()
+
+    def test_worker_counts(self):
+        """Are workers capped by CPUs and by database connections"""
+
+        self.assertEqual(server.worker_counts(cpus=2, pool_size=5,
+                                              max_connections=90), (5, 25, 5))
+        self.assertEqual(server.worker_counts(cpus=16, pool_size=10,
+                                              max_connections=90), (9, 30, 10))
+        self.assertEqual(server.worker_counts(cpus=4, pool_size=10,
+                                              max_connections=5), (1, 30, 10))
+
+    def test_warm_up(self):
+        """Are templates compiled and popular and recent authors cached"""
+
+        server.warm_up(app)
+
+        self.assertTrue(server.warmed.is_set())
+        self.assertIn('home.html',
+                      {name for _, name in app.jinja_env.cache.keys()})
+        self.assertEqual(card_cache.get(111).username, "user111")
+        self.assertIsNone(card_cache.get(222))
+
+    def test_readyz(self):
+        """Is the app only ready once warmed up"""
+
+        resp = self.client.get('/readyz')
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(resp.json, {"warm": False, "database": True})
+
+        server.warm_up(app)
+
+        resp = self.client.get('/readyz')
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(resp.json, {"warm": True, "database": True})
+
+    def test_metrics(self):
+        """Are the metrics only shown to admins"""
+
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 111
+        self.assertEqual(self.client.get('/metrics').status_code, 401)
+
+        app.config['ADMIN_USER_IDS'] = {111}
+        try:
+            resp = self.client.get('/metrics')
+        finally:
+            app.config['ADMIN_USER_IDS'] = set()
+        self.assertEqual(resp.status_code, 200)
+        self.assertIn("database", resp.json)
@@ -0,0 +1,329 @@
+"""Sharding tests, with extra SQLite databases as the shards."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_shards.py
+
+
+import os
+import tempfile
+from collections import Counter
+from datetime import datetime, timedelta
+from unittest import TestCase
+from unittest.mock import patch
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from models import db, Follows, Like, Message, User, UserShard
+from purge import purge_messages, purge_user
+from analytics import current_snapshot, snapshot_analytics
+from export import export_rows
+from read_models import load_like_summaries
+from shards import HashRing, MAIN, shards
+from single_flight import single_flight
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class HashRingTestCase(TestCase):
+    """Test placing users on shards."""
+
+    def test_spread(self):
+        """Are users spread over every shard"""
+
+        ring = HashRing(["main", "a", "b"])
+        counts = Counter(ring.shard_for(user_id) for user_id in range(3000))
+
+        self.assertEqual(set(counts), {"main", "a", "b"})
+        self.assertGreater(min(counts.values()), 600)
+
+    def test_adding_a_shard(self):
+        """Does adding a shard only move users onto the new one"""
+
+        before = HashRing(["main", "a"])
+        after = HashRing(["main", "a", "b"])
+
+        moved = [user_id for user_id in range(3000)
+                 if before.shard_for(user_id) != after.shard_for(user_id)]
+
+        self.assertTrue(all(after.shard_for(user_id) == "b"
+                            for user_id in moved))
+        self.assertLess(len(moved), 1500)
+
+
+class ShardsTestCase(TestCase):
+    """Test routing writes and merging reads across shards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        single_flight.clear()
+
+        self.shard_dir = tempfile.TemporaryDirectory()
+        shards.configure({
+            name: f"sqlite:///{self.shard_dir.name}/{name}.db"
+            for name in ("a", "b")})
+        shards.create_all()
+
+        for user_id in (111, 222, 333):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.flush()
+
+        # One user on each shard
+        db.session.add_all([UserShard(user_id=222, shard="a"),
+                            UserShard(user_id=333, shard="b")])
+        db.session.add_all([Follows(user_being_followed_id=222,
+                                    user_following_id=111),
+                            Follows(user_being_followed_id=333,
+                                    user_following_id=111)])
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.login(111)
+
+    def tearDown(self):
+        db.session.rollback()
+        shards.configure({})
+        self.shard_dir.cleanup()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = user_id
+
+    def post(self, user_id, text):
+        self.login(user_id)
+        self.client.post('/messages/new', data={"text": text})
+        self.login(111)
+
+    def stored_on(self, shard):
+        return [text for text, in (shards.session(shard)
+                                   .query(Message.text)
+                                   .order_by(Message.id))]
+
+    def test_signup_assigns(self):
+        """Are new users placed on a shard by the ring"""
+
+        client = app.test_client()
+        client.post('/signup', data={"username": "newbie",
+                                     "email": "newbie@test.com",
+                                     "password": "password"})
+
+        user = User.query.filter_by(username="newbie").one()
+        self.assertEqual(shards.shard_of(user.id),
+                         shards.ring.shard_for(user.id))
+
+    def test_writes_routed(self):
+        """Are messages stored on their author's shard, with unique ids"""
+
+        self.post(111, "on main")
+        self.post(222, "on a")
+        self.post(333, "on b")
+
+        self.assertEqual(self.stored_on(MAIN), ["on main"])
+        self.assertEqual(self.stored_on("a"), ["on a"])
+        self.assertEqual(self.stored_on("b"), ["on b"])
+
+        ids = [message_id for shard in shards.names
+               for message_id, in shards.session(shard).query(Message.id)]
+        self.assertEqual(len(set(ids)), 3)
+
+    def test_timeline_merged(self):
+        """Does the home timeline merge every shard, newest first"""
+
+        now = datetime.utcnow()
+        for shard, user_id, text, minutes_ago in (
+                (MAIN, 111, "mine", 3),
+                ("a", 222, "newest", 1),
+                ("b", 333, "oldest", 5)):
+            session = shards.session(shard)
+            session.add(Message(id=minutes_ago, text=text, user_id=user_id,
+                                timestamp=now - timedelta(minutes=minutes_ago)))
+            session.commit()
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertLess(html.index("newest"), html.index("mine"))
+        self.assertLess(html.index("mine"), html.index("oldest"))
+
+        delta = self.client.get('/timeline?since_id=2').json
+        self.assertEqual(delta["count"], 2)
+        self.assertEqual(delta["head"], 5)
+
+    def test_profile_and_show(self):
+        """Are a sharded user's profile and message pages served"""
+
+        self.post(222, "hello from a")
+        [message_id] = [message_id for message_id, in
+                        shards.session("a").query(Message.id)]
+
+        self.assertIn("hello from a",
+                      self.client.get('/users/222').get_data(as_text=True))
+        self.assertIn("hello from a",
+                      self.client.get(f'/messages/{message_id}')
+                      .get_data(as_text=True))
+        self.assertEqual(User.query.get(222).num_messages, 1)
+
+    def test_likes_and_deletes(self):
+        """Are likes stored with the message, and deletes routed"""
+
+        self.post(222, "like me")
+        [message_id] = [message_id for message_id, in
+                        shards.session("a").query(Message.id)]
+
+        self.client.post(f'/messages/{message_id}/like')
+
+        self.assertEqual(shards.session("a").query(Like).count(), 1)
+        self.assertEqual(db.session.query(Like).count(), 0)
+        self.assertEqual(User.query.get(111).liked_ids_among([message_id]),
+                         {message_id})
+
+        self.login(222)
+        self.client.post(f'/messages/{message_id}/delete')
+
+        self.assertEqual(self.client.get(f'/messages/{message_id}')
+                         .status_code, 404)
+
+    def test_like_with_write_behind(self):
+        """Is a like on another shard committed there, not buffered"""
+
+        self.post(333, "elsewhere")
+        [message_id] = [message_id for message_id, in
+                        shards.session("b").query(Message.id)]
+
+        app.config['LIKES_WRITE_BEHIND'] = True
+        try:
+            self.login(222)
+            resp = self.client.post(f'/messages/{message_id}/like')
+        finally:
+            app.config['LIKES_WRITE_BEHIND'] = False
+
+        self.assertEqual(resp.status_code, 302)
+        self.assertEqual(shards.session("b").query(Like).count(), 1)
+
+    def test_purge(self):
+        """Are purged users' and deleted messages removed from the shards"""
+
+        self.post(222, "going away")
+        self.post(333, "staying")
+        [message_id] = [message_id for message_id, in
+                        shards.session("b").query(Message.id)]
+        self.login(222)
+        self.client.post(f'/messages/{message_id}/like')
+
+        User.query.get(222).deleted_at = datetime.utcnow()
+        db.session.commit()
+        counts = purge_user(222, pause=0)
+
+        self.assertEqual(counts, {"likes": 1, "follows": 1, "messages": 1})
+        self.assertEqual(self.stored_on("a"), [])
+        self.assertEqual(shards.session("b").query(Like).count(), 0)
+        self.assertEqual(shards.session("b").query(Message.like_count)
+                         .scalar(), 0)
+
+        self.login(333)
+        self.client.post(f'/messages/{message_id}/delete')
+        self.assertEqual(purge_messages(pause=0), 1)
+        self.assertEqual(self.stored_on("b"), [])
+
+    def test_move_user(self):
+        """Are a user's messages and their likes moved, and pages kept"""
+
+        self.post(222, "moving house")
+        [message_id] = [message_id for message_id, in
+                        shards.session("a").query(Message.id)]
+        self.client.post(f'/messages/{message_id}/like')
+
+        moved = shards.move_user(222, "b", settle_seconds=0)
+
+        self.assertEqual(moved, 1)
+        self.assertEqual(shards.shard_of(222), "b")
+        self.assertEqual(self.stored_on("a"), [])
+        self.assertEqual(self.stored_on("b"), ["moving house"])
+        self.assertEqual(shards.session("b").query(Like).count(), 1)
+        self.assertIn("moving house",
+                      self.client.get('/users/222').get_data(as_text=True))
+
+    def test_interrupted_move(self):
+        """Are copies left by an interrupted move ignored, then deleted"""
+
+        self.post(222, "half moved")
+        [message_id] = [message_id for message_id, in
+                        shards.session("a").query(Message.id)]
+        self.client.post(f'/messages/{message_id}/like')
+
+        # Killed after switching shards, before deleting the old copy
+        with patch.object(shards, "_delete_messages",
+                          side_effect=[None, RuntimeError("killed")]):
+            with self.assertRaises(RuntimeError):
+                shards.move_user(222, "b", settle_seconds=0)
+        self.assertEqual(UserShard.query.get(222).moved_from, "a")
+        self.assertEqual(self.stored_on("a"), ["half moved"])
+
+        self.client.post(f'/messages/{message_id}/like')
+        self.assertEqual(load_like_summaries([message_id]), {})
+
+        self.login(222)
+        self.client.post(f'/messages/{message_id}/delete')
+        self.assertEqual(self.client.get(f'/messages/{message_id}')
+                         .status_code, 404)
+
+        self.assertEqual(shards.move_user(222, "b", settle_seconds=0), 0)
+        self.assertEqual(self.stored_on("a"), [])
+        self.assertEqual(shards.session("a").query(Like).count(), 0)
+        self.assertIsNone(UserShard.query.get(222).moved_from)
+
+    def test_stale_copies_not_exported(self):
+        """Do exports and analytics leave out an interrupted move's copies"""
+
+        self.post(222, "half moved")
+        [message_id] = [message_id for message_id, in
+                        shards.session("a").query(Message.id)]
+        self.client.post(f'/messages/{message_id}/like')
+
+        with patch.object(shards, "_delete_messages",
+                          side_effect=[None, RuntimeError("killed")]):
+            with self.assertRaises(RuntimeError):
+                shards.move_user(222, "b", settle_seconds=0)
+
+        rows = list(export_rows(User.query.get(111), self.shard_dir.name,
+                                chunk_size=1))
+        self.assertEqual([row["cursor"] for row in rows
+                          if row["type"] == "like"], [f"like:{message_id}"])
+
+        snapshot_analytics(self.shard_dir.name, chunk_size=1)
+        snapshot = current_snapshot(self.shard_dir.name)
+        self.assertEqual(list(snapshot.column("messages", "id")),
+                         [message_id])
+        self.assertEqual(snapshot.rows("likes"), 1)
+
+    def test_writes_refused_while_moving(self):
+        """Are writes refused while a user is being moved"""
+
+        UserShard.query.get(222).moving_since = datetime.utcnow()
+        db.session.commit()
+
+        self.login(222)
+        resp = self.client.post('/messages/new', data={"text": "too soon"})
+
+        self.assertEqual(resp.status_code, 503)
+        self.assertEqual(self.stored_on("a"), [])
+
+    def test_rebalance(self):
+        """Does rebalancing put everyone where the ring says"""
+
+        self.post(111, "legacy")
+
+        shards.rebalance(settle_seconds=0)
+
+        for user_id in (111, 222, 333):
+            self.assertEqual(shards.shard_of(user_id),
+                             shards.ring.shard_for(user_id))
+        self.assertEqual(
+            sum(len(self.stored_on(shard)) for shard in shards.names), 1)
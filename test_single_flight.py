@@ -0,0 +1,174 @@
+"""Single-flight cache tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_single_flight.py
+
+
+import os
+import tempfile
+import threading
+import time
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app
+from single_flight import SingleFlight
+
+
+def make_single_flight(shared=False):
+    """A SingleFlight for the app, sharing entries in a temp dir if asked."""
+
+    app.config['SINGLE_FLIGHT_DIR'] = tempfile.mkdtemp() if shared else None
+
+    flight = SingleFlight()
+    flight.init_app(app)
+
+    app.config['SINGLE_FLIGHT_DIR'] = None
+    return flight
+
+
+class SlowBuild:
+    """A build function that counts its calls and takes a while."""
+
+    def __init__(self, seconds=0.2):
+        self.seconds = seconds
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        time.sleep(self.seconds)
+        return f"built {self.calls}"
+
+
+class SingleFlightTestCase(TestCase):
+    """Test coalescing, staleness and invalidation."""
+
+    def get_concurrently(self, flight, build, callers=10):
+        results = []
+        threads = [threading.Thread(
+                       target=lambda: results.append(flight.get("key", build)))
+                   for _ in range(callers)]
+
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return results
+
+    def test_coalesces_in_process(self):
+        """Do concurrent misses wait for one build"""
+
+        flight = make_single_flight()
+        build = SlowBuild()
+
+        results = self.get_concurrently(flight, build)
+
+        self.assertEqual(build.calls, 1)
+        self.assertEqual(results, ["built 1"] * 10)
+        self.assertEqual(flight.stats["misses"], 1)
+        self.assertEqual(flight.stats["coalesced_waits"], 9)
+        self.assertGreater(flight.stats["max_coalesced_wait_ms"], 100)
+
+        # And then it's cached
+        self.assertEqual(flight.get("key", build), "built 1")
+        self.assertEqual(flight.stats["hits"], 1)
+
+    def test_coalesces_across_processes(self):
+        """Does a worker wait for another worker's build and use it"""
+
+        flight = make_single_flight(shared=True)
+        started = os.path.join(flight.path, "started")
+
+        def build():
+            open(started, "w").close()
+            time.sleep(0.3)
+            return os.getpid()
+
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0 if flight.get("key", build) == os.getpid() else 1)
+
+        while not os.path.exists(started):
+            time.sleep(0.01)
+
+        # The child is building: we get its value
+        self.assertEqual(flight.get("key", build), pid)
+        self.assertEqual(flight.stats["misses"], 0)
+        self.assertEqual(flight.stats["coalesced_waits"], 1)
+
+        _, status = os.waitpid(pid, 0)
+        self.assertEqual(os.waitstatus_to_exitcode(status), 0)
+
+    def test_stale_while_revalidate(self):
+        """Is a stale entry served at once while it's rebuilt once"""
+
+        flight = make_single_flight()
+        build = SlowBuild(seconds=0.1)
+
+        self.assertEqual(flight.get("key", build, fresh_for=0), "built 1")
+
+        # Stale: served straight away, one rebuild in the background
+        start = time.monotonic()
+        results = [flight.get("key", build, fresh_for=0) for _ in range(5)]
+        self.assertLess(time.monotonic() - start, 0.1)
+        self.assertEqual(results, ["built 1"] * 5)
+
+        time.sleep(0.3)
+        self.assertEqual(build.calls, 2)
+        self.assertEqual(flight.stats["refreshes"], 1)
+        self.assertEqual(flight.get("key", build), "built 2")
+
+    def test_expired(self):
+        """Is a fully expired entry rebuilt before it's returned"""
+
+        flight = make_single_flight()
+        build = SlowBuild(seconds=0)
+
+        flight.get("key", build, fresh_for=0, stale_for=0)
+
+        self.assertEqual(flight.get("key", build, fresh_for=0, stale_for=0),
+                         "built 2")
+
+    def test_build_error(self):
+        """Do waiters get the builder's error, and is nothing cached"""
+
+        flight = make_single_flight()
+
+        def build():
+            time.sleep(0.1)
+            raise ValueError("no")
+
+        errors = []
+
+        def get():
+            try:
+                flight.get("key", build)
+            except ValueError as error:
+                errors.append(error)
+
+        threads = [threading.Thread(target=get) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(errors), 3)
+        self.assertEqual(flight.get("key", lambda: "ok"), "ok")
+
+    def test_invalidate(self):
+        """Does invalidating make the next get rebuild, for every worker"""
+
+        flight = make_single_flight(shared=True)
+        other_worker = SingleFlight()
+        other_worker.path = flight.path
+
+        build = SlowBuild(seconds=0)
+        flight.get("key", build)
+        self.assertEqual(other_worker.get("key", build), "built 1")
+
+        other_worker.invalidate("key")
+
+        self.assertEqual(flight.get("key", build), "built 2")
@@ -0,0 +1,190 @@
+"""Hashtag and mention tests."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_tags.py
+
+
+import os
+import tempfile
+from datetime import datetime
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+from app import app, CURR_USER_KEY
+from models import db, Mention, Message, MessageTag, User, UserShard
+from shards import shards
+from single_flight import single_flight
+from tags import (
+    extract_mentions, extract_tags, index_tags, link_tags, mentions_page,
+    tag_page)
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+class ExtractTestCase(TestCase):
+    """Test finding tags and mentions in text."""
+
+    def test_extract(self):
+        """Are tags lowercased, and emails and entities skipped"""
+
+        text = "#Flask and #python3 with @alice, mail bob@example.com #c#d"
+
+        self.assertEqual(extract_tags(text), {"flask", "python3", "c"})
+        self.assertEqual(extract_mentions(text), {"alice"})
+
+    def test_link_tags(self):
+        """Are tags linked and the rest escaped"""
+
+        html = link_tags("it's <b>#Fun</b>")
+
+        self.assertIn('<a href="/tags/fun">#Fun</a>', html)
+        self.assertIn("&lt;b&gt;", html)
+        self.assertIn("it&#39;s", html)
+        self.assertNotIn("/tags/39", html)
+
+
+class TagsTestCase(TestCase):
+    """Test indexing messages and reading tag and mention feeds."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        single_flight.clear()
+
+        for user_id, username in ((111, "alice"), (222, "bob")):
+            user = User.signup(username=username,
+                               email=f"{username}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.commit()
+
+        self.client = app.test_client()
+        self.login(111)
+
+    def tearDown(self):
+        db.session.rollback()
+
+    def login(self, user_id):
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = user_id
+
+    def post(self, text):
+        self.client.post('/messages/new', data={"text": text})
+        return (db.session
+                .query(Message.id)
+                .filter(Message.text == text)
+                .scalar())
+
+    def test_posting_indexes(self):
+        """Are a new message's tags and mentions indexed"""
+
+        message_id = self.post("Hello @bob and @nobody #Warbler")
+
+        self.assertEqual(
+            [(tag.tag, tag.user_id) for tag in MessageTag.query],
+            [("warbler", 111)])
+        self.assertEqual(
+            [(mention.user_id, mention.message_id, mention.author_id)
+             for mention in Mention.query],
+            [(222, message_id, 111)])
+
+    def test_tag_feed(self):
+        """Is a tag feed paged newest first, without deleted messages"""
+
+        first = self.post("one #topic")
+        second = self.post("two #topic")
+        third = self.post("three #Topic")
+        self.post("other #elsewhere")
+
+        rows, before_id = tag_page("topic", limit=2)
+        self.assertEqual([row[0] for row in rows], [third, second])
+        self.assertEqual(before_id, second)
+
+        rows, before_id = tag_page("topic", before_id, limit=2)
+        self.assertEqual([row[0] for row in rows], [first])
+        self.assertIsNone(before_id)
+
+        Message.query.get(third).deleted_at = datetime.utcnow()
+        db.session.commit()
+        self.assertEqual([row[0] for row in tag_page("TOPIC")[0]],
+                         [second, first])
+
+        html = self.client.get('/tags/topic').get_data(as_text=True)
+        self.assertIn("two", html)
+        self.assertNotIn("three", html)
+        self.assertNotIn("elsewhere", html)
+
+    def test_mentions_feed(self):
+        """Does a user's mentions feed list messages mentioning them"""
+
+        message_id = self.post("hi @bob")
+        self.post("hi @alice")
+
+        self.assertEqual([row[0] for row in mentions_page(222)[0]],
+                         [message_id])
+
+        html = self.client.get('/users/222/mentions').get_data(as_text=True)
+        self.assertIn("hi @bob", html)
+        self.assertNotIn("hi @alice", html)
+
+    def test_backfill(self):
+        """Does the backfill index messages posted before tags existed"""
+
+        db.session.add_all([Message(id=1, text="old #news for @bob",
+                                    user_id=111),
+                            Message(id=2, text="older #news", user_id=222),
+                            Message(id=3, text="gone #news", user_id=222,
+                                    deleted_at=datetime.utcnow())])
+        db.session.commit()
+
+        self.assertEqual(index_tags(batch_size=1), 2)
+        self.assertEqual(index_tags(batch_size=1), 2)
+
+        self.assertEqual([row[0] for row in tag_page("news")[0]], [2, 1])
+        self.assertEqual(Mention.query.count(), 1)
+
+
+class ShardedTagsTestCase(TestCase):
+    """Test tag feeds over messages on shards."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+
+        self.shard_dir = tempfile.TemporaryDirectory()
+        shards.configure({"a": f"sqlite:///{self.shard_dir.name}/a.db"})
+        shards.create_all()
+
+        for user_id in (111, 222):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+        db.session.flush()
+        db.session.add(UserShard(user_id=222, shard="a"))
+        db.session.commit()
+
+        self.client = app.test_client()
+
+    def tearDown(self):
+        db.session.rollback()
+        shards.configure({})
+        self.shard_dir.cleanup()
+
+    def test_tag_feed(self):
+        """Are tagged messages read from their authors' shards"""
+
+        for user_id, text in ((111, "main #both"), (222, "shard #both")):
+            with self.client.session_transaction() as change_session:
+                change_session[CURR_USER_KEY] = user_id
+            self.client.post('/messages/new', data={"text": text})
+
+        rows, _ = tag_page("both")
+
+        self.assertEqual([row[1] for row in rows], ["shard #both", "main #both"])
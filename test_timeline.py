@@ -0,0 +1,208 @@
+"""Live timeline tests: since_id deltas and the event stream."""
+
+# run these tests like:
+#
+#    FLASK_ENV=production python -m unittest test_timeline.py
+
+
+import json
+import os
+import threading
+import time
+from unittest import TestCase
+
+os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
+
+import app as app_module
+from app import app, CURR_USER_KEY
+from models import db, Follows, Message, User
+from single_flight import single_flight
+from timeline_bus import MessageBus, timeline_bus
+
+db.create_all()
+
+app.config['WTF_CSRF_ENABLED'] = False
+
+
+def parse_events(body):
+    """[(event, data)] from a text/event-stream body."""
+
+    events = []
+    for block in body.split("\n\n"):
+        fields = dict(line.split(": ", 1) for line in block.splitlines()
+                      if ": " in line and not line.startswith(":"))
+        if "event" in fields:
+            events.append((fields["event"], fields.get("data")))
+    return events
+
+
+class MessageBusTestCase(TestCase):
+    """Test the in-process pub/sub."""
+
+    def test_publish(self):
+        """Are only subscribers to the author woken"""
+
+        bus = MessageBus()
+        followers = bus.subscribe([1, 2])
+        others = bus.subscribe([3])
+
+        bus.publish(2)
+
+        self.assertTrue(followers.wait(0))
+        self.assertFalse(others.wait(0))
+        # Woken once per publish
+        self.assertFalse(followers.wait(0))
+
+    def test_capacity(self):
+        """Is there a limit on subscribers, freed by closing"""
+
+        bus = MessageBus(max_subscribers=1)
+
+        with bus.subscribe([1]):
+            self.assertIsNone(bus.subscribe([1]))
+
+        self.assertEqual(bus.subscribers, 0)
+        self.assertIsNotNone(bus.subscribe([1]))
+
+
+class TimelineViewTestCase(TestCase):
+    """Test /timeline and /timeline/stream."""
+
+    def setUp(self):
+        db.drop_all()
+        db.create_all()
+        single_flight.clear()
+
+        for user_id in (111, 222, 333):
+            user = User.signup(username=f"user{user_id}",
+                               email=f"{user_id}@test.com",
+                               password="password",
+                               image_url=None)
+            user.id = user_id
+            db.session.add(user)
+        db.session.commit()
+
+        db.session.add(Follows(user_being_followed_id=222,
+                               user_following_id=111))
+        db.session.add(Message(id=1, text="before", user_id=222))
+        db.session.commit()
+
+        self.client = app.test_client()
+        with self.client.session_transaction() as change_session:
+            change_session[CURR_USER_KEY] = 111
+
+        self.stream_seconds = app_module.STREAM_SECONDS
+
+    def tearDown(self):
+        db.session.rollback()
+        app_module.STREAM_SECONDS = self.stream_seconds
+        timeline_bus.max_subscribers = MessageBus().max_subscribers
+
+    def post(self, user_id, text, message_id):
+        db.session.add(Message(id=message_id, text=text, user_id=user_id))
+        db.session.commit()
+        timeline_bus.publish(user_id)
+
+    def test_homepage_head(self):
+        """Does the homepage tell the script where the timeline starts"""
+
+        html = self.client.get('/').get_data(as_text=True)
+
+        self.assertIn('data-head="1"', html)
+        self.assertIn('scripts/timeline.js', html)
+
+    def test_since_id(self):
+        """Are only newer messages on the timeline returned"""
+
+        self.post(222, "followed", 2)
+        self.post(333, "not followed", 3)
+        self.post(111, "mine", 4)
+
+        resp = self.client.get('/timeline?since_id=1')
+        delta = resp.json
+
+        self.assertEqual(delta["head"], 4)
+        self.assertEqual(delta["count"], 2)
+        self.assertIn("followed", delta["html"])
+        self.assertIn("mine", delta["html"])
+        self.assertNotIn("not followed", delta["html"])
+        self.assertLess(delta["html"].index("mine"),
+                        delta["html"].index("followed"))
+
+        self.assertEqual(self.client.get('/timeline?since_id=4').json["count"],
+                         0)
+
+    def test_logged_out(self):
+        """Do logged out users get a 401"""
+
+        client = app.test_client()
+
+        self.assertEqual(client.get('/timeline').status_code, 401)
+        self.assertEqual(client.get('/timeline/stream').status_code, 401)
+
+    def test_stream_catches_up(self):
+        """Does a stream start with what's new since the client's head"""
+
+        self.post(222, "missed", 2)
+        app_module.STREAM_SECONDS = 0
+
+        resp = self.client.get('/timeline/stream?since_id=1')
+
+        self.assertEqual(resp.mimetype, 'text/event-stream')
+        [(event, data)] = parse_events(resp.get_data(as_text=True))
+        self.assertEqual(event, "messages")
+        self.assertEqual(json.loads(data)["head"], 2)
+        self.assertIn("id: 2\n", resp.get_data(as_text=True))
+
+        # Reconnecting with Last-Event-ID: nothing new
+        resp = self.client.get('/timeline/stream?since_id=1',
+                               headers={'Last-Event-ID': '2'})
+        self.assertEqual(parse_events(resp.get_data(as_text=True)), [])
+
+    def test_stream_push(self):
+        """Is a new post pushed to the stream without waiting to poll"""
+
+        app_module.STREAM_SECONDS = 1
+
+        resp = self.client.get('/timeline/stream?since_id=1', buffered=False)
+        chunks = iter(resp.response)
+        next(chunks)  # retry:
+
+        posted_at = []
+
+        def post_later():
+            time.sleep(0.2)
+            with app.app_context():
+                posted_at.append(time.monotonic())
+                self.post(222, "live", 2)
+
+        threading.Thread(target=post_later).start()
+
+        chunk = next(chunks)
+        received_at = time.monotonic()
+        resp.close()
+
+        chunk = chunk.decode() if isinstance(chunk, bytes) else chunk
+        [(event, data)] = parse_events(chunk)
+        self.assertIn("live", json.loads(data)["html"])
+        self.assertLess(received_at - posted_at[0], 1)
+        self.assertEqual(timeline_bus.subscribers, 0)
+
+    def test_stream_closed_early(self):
+        """Is a stream's slot freed if it's closed before it starts"""
+
+        resp = self.client.get('/timeline/stream?since_id=1', buffered=False)
+        self.assertEqual(timeline_bus.subscribers, 1)
+
+        resp.close()
+        self.assertEqual(timeline_bus.subscribers, 0)
+
+    def test_stream_busy(self):
+        """Are clients told to poll when the worker has no room"""
+
+        timeline_bus.max_subscribers = 0
+
+        resp = self.client.get('/timeline/stream?since_id=1')
+
+        self.assertEqual(parse_events(resp.get_data(as_text=True)),
+                         [("busy", "60000")])
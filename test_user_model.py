@@ -6,11 +6,14 @@
 
 
 import os
+from datetime import datetime
 from unittest import TestCase
 
 from sqlalchemy.exc import IntegrityError
 
 from models import db, User, Message, Follows, Like
+from purge import purge_user
+from like_buffer import like_buffer
 from flask_bcrypt import Bcrypt
 
 bcrypt = Bcrypt()
@@ -117,6 +120,33 @@ class UserModelTestCase(TestCase):
         self.assertTrue(self.user_1.is_followed_by(self.user_2))
         self.assertFalse(self.user_2.is_followed_by(self.user_1))
 
+    def test_following_ids_among(self):
+        """Does following_ids_among return only the ids being followed"""
+
+        new_follow = Follows(user_being_followed_id = self.user_1.id,
+                            user_following_id = self.user_2.id)
+
+        db.session.add(new_follow)
+        db.session.commit()
+
+        self.assertEqual(
+            self.user_2.following_ids_among([self.user_1.id, self.user_2.id]),
+            {self.user_1.id})
+        self.assertEqual(self.user_1.following_ids_among([self.user_2.id]), set())
+
+    def test_followers_page(self):
+        """Does followers_page return a keyset-paginated page of user cards"""
+
+        new_follow = Follows(user_being_followed_id = self.user_1.id,
+                            user_following_id = self.user_2.id)
+
+        db.session.add(new_follow)
+        db.session.commit()
+
+        cards, next_after_id = self.user_1.followers_page(limit=1)
+        self.assertEqual([card.username for card in cards], ["testuser2"])
+        self.assertIsNone(next_after_id)
+
     def test_user_signup(self):
         """Does User.signup class method create a new user instance
         with valid credentials"""
@@ -190,3 +220,54 @@ class UserModelTestCase(TestCase):
 
         self.assertTrue(user_liking.user_liking_id == self.user_2.id)
 
+    def test_like_write_behind(self):
+        """With LIKES_WRITE_BEHIND, are likes buffered, visible to the liker,
+        and written on flush"""
+
+        new_message = Message(text="Heyo", user_id=self.user_1.id)
+
+        db.session.add(new_message)
+        db.session.commit()
+
+        message_id = new_message.id
+
+        app.config['LIKES_WRITE_BEHIND'] = True
+        like_buffer.init_app(app)
+        like_buffer.flush_interval = 60
+
+        try:
+            self.user_2.like_or_unlike_message(message_id)
+
+            self.assertEqual(Like.query.count(), 0)
+            self.assertEqual(self.user_2.liked_ids_among([message_id]),
+                             {message_id})
+            self.assertEqual(self.user_2.num_likes, 1)
+
+            self.assertEqual(like_buffer.flush(), 1)
+            self.assertEqual(like_buffer.pending_for(self.user_2.id), {})
+            self.assertTrue(Like.query.get((self.user_2.id, message_id)))
+
+        finally:
+            app.config['LIKES_WRITE_BEHIND'] = False
+
+    def test_purge_user(self):
+        """Does purge_user remove a tombstoned user and their rows"""
+
+        new_message = Message(text="Heyo", user_id=self.user_1.id)
+        new_follow = Follows(user_being_followed_id = self.user_2.id,
+                            user_following_id = self.user_1.id)
+
+        db.session.add_all([new_message, new_follow])
+        db.session.commit()
+
+        user_1_id = self.user_1.id
+        self.assertIsNone(purge_user(user_1_id, pause=0))
+
+        self.user_1.deleted_at = datetime.utcnow()
+        db.session.commit()
+
+        counts = purge_user(user_1_id, batch_size=1, pause=0)
+
+        self.assertEqual(counts, {"likes": 0, "follows": 1, "messages": 1})
+        self.assertIsNone(User.query.get(user_1_id))
+        self.assertEqual(Message.query.filter_by(user_id=user_1_id).count(), 0)
@@ -5,14 +5,26 @@
 #    FLASK_ENV=production python -m unittest test_user_views.py
 
 
+import gzip
 import os
+import re
+import tempfile
+from datetime import datetime
+from io import BytesIO
 from unittest import TestCase
+from unittest.mock import patch
+
+from PIL import Image
+
+from flask import session
 
 from models import db, connect_db, Message, User, Follows, Like
 
 os.environ['DATABASE_URL'] = "postgresql:///warbler_test"
 
+import app as app_module
 from app import app, CURR_USER_KEY
+from single_flight import single_flight
 
 db.create_all()
 
@@ -26,6 +38,7 @@ class UserViewTestCase(TestCase):
 
         db.drop_all()
         db.create_all()
+        single_flight.clear()
 
         Like.query.delete()
         Follows.query.delete()
@@ -87,6 +100,79 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn("testuser</a>", html)
 
+    def test_users_show_streamed(self):
+        """Test if the profile page streams, gzipped when accepted"""
+
+        with self.client as client:
+            resp = client.get(f'/users/{self.testuser1_id}',
+                              headers={'Accept-Encoding': 'gzip'},
+                              buffered=False)
+
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.content_encoding, 'gzip')
+            self.assertTrue(resp.is_streamed)
+
+            html = gzip.decompress(resp.get_data()).decode()
+            self.assertIn('test message from user 1', html)
+
+    def test_streamed_flash(self):
+        """Is a flashed message shown once on a streamed page"""
+
+        with self.client as client:
+            client.post('/login', data={"username": "testuser",
+                                        "password": "testuser"})
+
+            pages = [client.get(url).get_data(as_text=True)
+                     for url in ('/', '/', '/users')]
+
+            self.assertEqual([html.count("Hello, testuser!") for html in pages],
+                             [1, 0, 0])
+
+    def test_users_show_pages(self):
+        """Is the profile paged, with ties in timestamp kept in order"""
+
+        same_time = datetime(2026, 1, 1)
+        db.session.add_all([Message(text=f"paged {i}!", user_id=111,
+                                    timestamp=same_time)
+                            for i in range(100)])
+        db.session.commit()
+
+        with self.client as client:
+            html = client.get(f'/users/{self.testuser1_id}').get_data(
+                as_text=True)
+            older_url = re.search(r'href="(/users/111\?before=[^"]+)"',
+                                  html).group(1).replace("&amp;", "&")
+
+            older_html = client.get(older_url).get_data(as_text=True)
+
+        texts = [f"paged {i}!" for i in range(100)]
+        self.assertEqual(sum(text in html for text in texts), 99)
+        self.assertEqual(sum(text in older_html for text in texts), 1)
+        self.assertIn('test message from user 1', html)
+        self.assertNotIn('Older messages', older_html)
+
+    def test_profile_counts(self):
+        """Are profile stats built once, and rebuilt when follows change"""
+
+        followers = re.compile(r'/followers">(\d+)</a>')
+
+        with patch.object(app_module, "load_user_counts",
+                          wraps=app_module.load_user_counts) as load:
+            with self.client as client:
+                for _ in range(2):
+                    html = client.get(f'/users/{self.testuser1_id}'
+                                      ).get_data(as_text=True)
+                    self.assertEqual(followers.findall(html), ["1"])
+                self.assertEqual(load.call_count, 1)
+
+                with client.session_transaction() as sess:
+                    sess[CURR_USER_KEY] = self.testuser2_id
+                client.post(f'/users/stop-following/{self.testuser1_id}')
+
+                html = client.get(f'/users/{self.testuser1_id}'
+                                  ).get_data(as_text=True)
+                self.assertEqual(followers.findall(html), ["0"])
+
     def test_non_existing_users_show(self):
         """Test get request to non-existing user page - checks if 404 is returned"""
         with self.client as client:
@@ -197,6 +283,38 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('i am a new bio', html)
 
+    def test_update_profile_image_upload(self):
+        """Test if an uploaded avatar is stored and its thumbnails served"""
+
+        app.config['IMAGE_STORE'] = tempfile.mkdtemp()
+
+        image = BytesIO()
+        Image.new('RGB', (300, 200), 'blue').save(image, 'PNG')
+        image.seek(0)
+
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2_id
+            resp = client.post('/users/profile',
+                               data={"username": "testuser2",
+                                     "email": "test@test2.com",
+                                     "image_file": (image, "avatar.png")},
+                               content_type='multipart/form-data')
+
+            self.assertEqual(resp.status_code, 302)
+
+            image_url = User.query.get(self.testuser2_id).image_url
+            self.assertRegex(image_url, r'^/images/[0-9a-f]{64}$')
+
+            resp = client.get(f'/users/{self.testuser2_id}')
+            self.assertIn(f'{image_url}/avatar', resp.get_data(as_text=True))
+
+            resp = client.get(f'{image_url}/timeline')
+            self.assertEqual(resp.status_code, 200)
+            self.assertEqual(resp.mimetype, 'image/jpeg')
+            self.assertIn('immutable', resp.headers['Cache-Control'])
+            self.assertEqual(Image.open(BytesIO(resp.data)).size, (96, 96))
+
     def test_unauthorized_update_profile(self):
         """Test if html is updated with new user details"""
 
@@ -207,17 +325,19 @@ class UserViewTestCase(TestCase):
             self.assertEqual(resp.status_code, 200)
             self.assertIn('Access unauthorized', html)
 
-    # def test_delete_profile(self):
-    #     """Test if user is deleted from post route"""
+    def test_delete_profile(self):
+        """Test if user is tombstoned and hidden right away when deleted"""
 
-    #     with self.client as client:
-    #         with client.session_transaction() as sess:
-    #             sess[CURR_USER_KEY] = self.testuser2_id
-    #         resp = client.post('/users/delete', follow_redirects=True)
-    #         html = resp.get_data(as_text=True)
+        with self.client as client:
+            with client.session_transaction() as sess:
+                sess[CURR_USER_KEY] = self.testuser2_id
+            resp = client.post('/users/delete', follow_redirects=True)
 
-    #         self.assertEqual(resp.status_code, 200)
-            # self.assertRaises(IntegrityError)
+            self.assertEqual(resp.status_code, 200)
+            self.assertNotIn(CURR_USER_KEY, session)
+
+            resp = client.get(f'/users/{self.testuser2_id}')
+            self.assertEqual(resp.status_code, 404)
 
     # def test_unauthorized_delete_profile(self):
     #     """Test if user is not deleted from post route if unauthorized"""
@@ -0,0 +1,120 @@
+"""In-process pub/sub for new messages, for live timelines.
+
+/timeline/stream subscribes with the ids of the authors on the viewer's
+timeline and sleeps until one of them posts (publish() is called once
+the new message commits) or a heartbeat comes round, then asks the
+database for what's new. Subscribers only wake for their own authors.
+
+Posts made through other workers arrive through the invalidation bus
+(see invalidation_bus.py); if it drops any, the stream's heartbeat query
+still picks them up within HEARTBEAT_SECONDS.
+"""
+
+import threading
+from collections import defaultdict
+
+# Streams per worker process. Each holds a thread (not a DB connection)
+# while it waits; gunicorn.conf.py adds this many threads per worker.
+MAX_SUBSCRIBERS = 20
+
+HEARTBEAT_SECONDS = 15
+
+
+class Subscription:
+    """One stream's interest in a set of authors."""
+
+    def __init__(self, bus, author_ids):
+        self.bus = bus
+        self.author_ids = frozenset(author_ids)
+        self._event = threading.Event()
+        self._closed = False
+
+    def wait(self, timeout=HEARTBEAT_SECONDS):
+        """Sleep until one of our authors posts or `timeout` passes.
+
+        Returns whether anything was published.
+        """
+
+        published = self._event.wait(timeout)
+        self._event.clear()
+        return published
+
+    def notify(self):
+        self._event.set()
+
+    def close(self):
+        self.bus.unsubscribe(self)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class MessageBus:
+    """Subscriptions, indexed by the authors they follow."""
+
+    def __init__(self, max_subscribers=MAX_SUBSCRIBERS):
+        self.max_subscribers = max_subscribers
+
+        self._by_author = defaultdict(set)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def subscribe(self, author_ids):
+        """A new Subscription, or None if this process has no room."""
+
+        subscription = Subscription(self, author_ids)
+
+        with self._lock:
+            if self._count >= self.max_subscribers:
+                return None
+
+            self._count += 1
+            for author_id in subscription.author_ids:
+                self._by_author[author_id].add(subscription)
+
+        return subscription
+
+    def unsubscribe(self, subscription):
+        """Give `subscription`'s slot back (once, however often called)."""
+
+        with self._lock:
+            if subscription._closed:
+                return
+            subscription._closed = True
+
+            self._count -= 1
+            for author_id in subscription.author_ids:
+                subscribers = self._by_author[author_id]
+                subscribers.discard(subscription)
+                if not subscribers:
+                    del self._by_author[author_id]
+
+    def publish(self, author_id):
+        """Wake the subscriptions interested in `author_id`."""
+
+        with self._lock:
+            subscribers = list(self._by_author.get(author_id, ()))
+
+        for subscription in subscribers:
+            subscription.notify()
+
+    def publish_all(self):
+        """Wake every subscription (something may have been missed)."""
+
+        with self._lock:
+            subscribers = [subscription
+                           for subscriptions in self._by_author.values()
+                           for subscription in subscriptions]
+
+        for subscription in set(subscribers):
+            subscription.notify()
+
+    @property
+    def subscribers(self):
+        return self._count
+
+
+timeline_bus = MessageBus()
@@ -0,0 +1,142 @@
+"""Trending messages, from likes in a sliding time window.
+
+Likes aren't counted per request. Instead each like/unlike adds +1/-1 to the
+message's counter for the current TRENDING_BUCKET_SECONDS bucket in
+`like_buckets`, and a job periodically scores the buckets inside the window
+and saves the top TRENDING_SIZE messages in `trending_messages`. The
+/trending page only reads that list.
+
+A bucket's likes count for less as it ages: its weight halves every
+TRENDING_HALF_LIFE_SECONDS.
+"""
+
+import logging
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy.exc import IntegrityError
+
+from jobs import enqueue, job_handler
+from models import db, LikeBucket, TrendingMessage
+
+logger = logging.getLogger(__name__)
+
+TRENDING_BUCKET_SECONDS = 5 * 60
+TRENDING_WINDOW_SECONDS = 24 * 60 * 60
+TRENDING_HALF_LIFE_SECONDS = 2 * 60 * 60
+TRENDING_SIZE = 100
+
+# The trending list is recomputed at most once per this many seconds
+TRENDING_REFRESH_SECONDS = 60
+
+
+def bucket_start(when):
+    """Start of the bucket `when` falls in."""
+
+    epoch_seconds = int((when - datetime(1970, 1, 1)).total_seconds())
+    return datetime(1970, 1, 1) + timedelta(
+        seconds=epoch_seconds - epoch_seconds % TRENDING_BUCKET_SECONDS)
+
+
+def record_like(message_id, delta, when=None):
+    """Count a like (delta=1) or unlike (delta=-1) of a message.
+
+    Changes are added to the caller's session, so they're committed along
+    with the like itself. Also makes sure a trending refresh is queued.
+    """
+
+    when = when or datetime.utcnow()
+    start = bucket_start(when)
+
+    updated = (LikeBucket.query
+               .filter_by(liked_message_id=message_id, bucket_start=start)
+               .update({"likes": LikeBucket.likes + delta},
+                       synchronize_session=False))
+
+    if not updated:
+        try:
+            with db.session.begin_nested():
+                db.session.add(LikeBucket(liked_message_id=message_id,
+                                          bucket_start=start,
+                                          likes=delta))
+        except IntegrityError:
+            # Someone else created the bucket since we looked
+            (LikeBucket.query
+             .filter_by(liked_message_id=message_id, bucket_start=start)
+             .update({"likes": LikeBucket.likes + delta},
+                     synchronize_session=False))
+
+    schedule_refresh(when)
+
+
+def schedule_refresh(when):
+    """Queue a trending refresh for the end of the current refresh period."""
+
+    epoch_seconds = int((when - datetime(1970, 1, 1)).total_seconds())
+    period = epoch_seconds // TRENDING_REFRESH_SECONDS
+
+    enqueue("refresh_trending",
+            priority=-2,
+            idempotency_key=f"refresh_trending:{period}",
+            delay=TRENDING_REFRESH_SECONDS - epoch_seconds % TRENDING_REFRESH_SECONDS)
+
+
+def score_buckets(message_ids, starts, likes, now):
+    """Decayed scores per message for parallel arrays of bucket rows.
+
+    Returns (message ids, scores) sorted best first.
+    """
+
+    age = (now - starts).astype("timedelta64[s]").astype(np.float64)
+    weights = likes * np.exp2(-age / TRENDING_HALF_LIFE_SECONDS)
+
+    ids, inverse = np.unique(message_ids, return_inverse=True)
+    scores = np.bincount(inverse.ravel(), weights=weights)
+
+    order = np.argsort(-scores, kind="stable")
+    return ids[order], scores[order]
+
+
+@job_handler("refresh_trending")
+def refresh_trending():
+    """Recompute the trending list from the like buckets in the window."""
+
+    now = datetime.utcnow()
+    window_start = now - timedelta(seconds=TRENDING_WINDOW_SECONDS)
+
+    rows = (db.session
+            .query(LikeBucket.liked_message_id,
+                   LikeBucket.bucket_start,
+                   LikeBucket.likes)
+            .filter(LikeBucket.bucket_start >= window_start,
+                    LikeBucket.likes != 0)
+            .all())
+
+    message_ids, scores = score_buckets(
+        np.array([row.liked_message_id for row in rows], dtype=np.int64),
+        np.array([row.bucket_start for row in rows], dtype="datetime64[us]"),
+        np.array([row.likes for row in rows], dtype=np.float64),
+        np.datetime64(now, "us"),
+    )
+
+    top = scores > 0
+    message_ids = message_ids[top][:TRENDING_SIZE]
+    scores = scores[top][:TRENDING_SIZE]
+
+    TrendingMessage.query.delete(synchronize_session=False)
+    db.session.bulk_insert_mappings(TrendingMessage, [
+        {"message_id": int(message_id), "score": float(score),
+         "computed_at": now}
+        for message_id, score in zip(message_ids, scores)
+    ])
+
+    # Buckets that slid out of the window are never read again
+    (LikeBucket.query
+     .filter(LikeBucket.bucket_start < window_start)
+     .delete(synchronize_session=False))
+
+    db.session.commit()
+
+    logger.info("trending: %s messages from %s buckets",
+                len(message_ids), len(rows))
+    return len(message_ids)
@@ -0,0 +1,20 @@
+"""Background job worker.
+
+Runs the jobs queued with jobs.enqueue(). Start it next to the web process:
+
+    python worker.py
+
+(pass --burst to exit once the queue is empty).
+"""
+
+import logging
+import sys
+
+from app import app
+from jobs import run_worker
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.INFO)
+
+    with app.app_context():
+        run_worker(burst="--burst" in sys.argv)